@@ -1,5 +1,6 @@
 -- SmartThings Edge Driver for TV App Launch
--- Sends HTTP request to local Python utility to launch TV app
+-- Sends launch requests to the local Python utility over its hub channel
+-- (one persistent TCP connection per device), falling back to HTTP
 
 local capabilities = require "st.capabilities"
 local Driver = require "st.driver"
@@ -16,6 +17,10 @@ local initialized = false
 -- Configuration - these should be set via device preferences
 local DEFAULT_SERVER_URL = "http://192.168.1.100:5000"  -- Fallback if preferences not set
 local DEFAULT_ENDPOINT = "/launch-tv-app"
+local DEFAULT_CHANNEL_PORT = 0  -- HUB_CHANNEL_PORT on the utility (e.g. 5001), 0 = HTTP only
+local CHANNEL_TIMEOUT = 30  -- Seconds to wait for the utility's reply on the channel
+
+local channel_seq = 0
 
 -- Device lifecycle handlers
 local function device_init(driver, device)
@@ -33,8 +38,118 @@ local function device_added(driver, device)
   device:online()
 end
 
+-- Hub channel helpers
+local function url_escape(value)
+  return (string.gsub(tostring(value), "[^%w%-_%.~]", function(c)
+    return string.format("%%%02X", string.byte(c))
+  end))
+end
+
+local function url_unescape(value)
+  return (string.gsub(value, "%%(%x%x)", function(hex)
+    return string.char(tonumber(hex, 16))
+  end))
+end
+
+local function channel_close(device)
+  local sock = device:get_field("channel")
+  if sock then
+    sock:close()
+    device:set_field("channel", nil)
+  end
+end
+
+-- Send one request line and wait for the reply with the same sequence number
+local function channel_exchange(sock, line, seq)
+  local ok, err = sock:send(line .. "\n")
+  if not ok then
+    return nil, nil, err
+  end
+  while true do
+    local reply, recv_err = sock:receive("*l")
+    if not reply then
+      return nil, nil, recv_err
+    end
+    local reply_seq, code, rest = string.match(reply, "^(%d+) (%d+) ?(.*)$")
+    -- Connection-level errors (sequence 0) are followed by the utility closing the socket
+    if reply_seq == tostring(seq) then
+      return tonumber(code), rest
+    end
+  end
+end
+
+local function channel_connect(device, server_url, port, token)
+  local host = string.match(server_url, "^%a+://([^/:]+)")
+  if not host then
+    return nil, "cannot parse host from " .. server_url
+  end
+  
+  local sock = socket.tcp()
+  sock:settimeout(CHANNEL_TIMEOUT)
+  local ok, err = sock:connect(host, port)
+  if not ok then
+    sock:close()
+    return nil, err
+  end
+  sock:setoption("tcp-nodelay", true)
+  sock:setoption("keepalive", true)
+  
+  -- HUB_CHANNEL_TOKEN: the utility expects it before anything else on the connection
+  if token and token ~= "" then
+    channel_seq = channel_seq + 1
+    local code, _, auth_err = channel_exchange(sock, channel_seq .. " auth token=" .. url_escape(token), channel_seq)
+    if code ~= 200 then
+      sock:close()
+      return nil, "hub channel authentication failed (" .. tostring(code or auth_err) .. ")"
+    end
+  end
+  
+  log.info("Hub channel connected to " .. host .. ":" .. port)
+  device:set_field("channel", sock)
+  return sock
+end
+
+-- Launch over the hub channel; returns (code, reply) or (nil, nil, err) when the channel is unusable
+local function send_channel_request(device, server_url, port, token, fields)
+  channel_seq = channel_seq + 1
+  local seq = channel_seq
+  local parts = { tostring(seq), "launch", url_escape(fields.target) }
+  for _, key in ipairs({ "action", "rid", "idem", "async", "ack" }) do
+    if fields[key] ~= nil then
+      table.insert(parts, key .. "=" .. url_escape(fields[key]))
+    end
+  end
+  local line = table.concat(parts, " ")
+  
+  -- Reuse the open connection; reconnect once if the utility restarted or dropped it
+  local sock = device:get_field("channel")
+  for attempt = 1, 2 do
+    if not sock then
+      local err
+      sock, err = channel_connect(device, server_url, port, token)
+      if not sock then
+        return nil, nil, err
+      end
+    end
+    local code, reply, err = channel_exchange(sock, line, seq)
+    if code then
+      return code, reply
+    end
+    log.warn("Hub channel error (attempt " .. attempt .. "): " .. tostring(err))
+    channel_close(device)
+    sock = nil
+  end
+  return nil, nil, "hub channel unavailable"
+end
+
 local function device_removed(driver, device)
   log.info("TV App Launcher device removed: " .. device.id)
+  channel_close(device)
+end
+
+local function device_info_changed(driver, device, event, args)
+  -- Server URL or channel port may have changed; the next launch reconnects
+  channel_close(device)
 end
 
 -- HTTP request helper
@@ -46,13 +161,49 @@ local function send_http_request(device, action)
   -- Get target device from preferences
   local target_device = (device.preferences and device.preferences.targetDevice) or "s95"
   
-  log.info("Sending request to: " .. url)
+  -- Async launch: the utility answers 202 right away and launches in the background
+  local async_launch = device.preferences and device.preferences.asyncLaunch == true
+  
+  -- Minimal ack: the utility only reports the outcome, not the SmartThings response
+  local minimal_ack = not (device.preferences and device.preferences.minimalAck == false)
+  
+  local channel_port = (device.preferences and device.preferences.channelPort) or DEFAULT_CHANNEL_PORT
+  local channel_token = device.preferences and device.preferences.channelToken
+  
+  -- Sent as X-Request-ID so the utility's logs for this launch can be matched with ours.
+  -- Also the idempotency key, so a launch resent after a dropped connection runs once
+  local request_id = string.format("%s-%d-%04x", string.sub(device.id, 1, 8), os.time(), math.random(0, 0xffff))
+  
   log.info("Target device: " .. target_device)
   
+  if channel_port > 0 then
+    log.info("Sending request over hub channel (request " .. request_id .. ")")
+    local code, reply, err = send_channel_request(device, server_url, channel_port, channel_token, {
+      target = target_device,
+      action = action,
+      rid = request_id,
+      idem = request_id,
+      async = async_launch and "1" or nil,
+      ack = (not minimal_ack) and "full" or nil
+    })
+    if code == 200 or code == 202 then
+      log.info("Request successful: " .. code)
+      return true, reply
+    elseif code then
+      log.error("Request failed with code: " .. code .. " " .. url_unescape(reply))
+      return false, "HTTP " .. code
+    end
+    log.warn("Hub channel unavailable (" .. tostring(err) .. "), falling back to HTTP")
+  end
+  
+  log.info("Sending request to: " .. url .. " (request " .. request_id .. ")")
+  
   local request_body = json.encode({
     action = action,
     device_id = device.id,
     target_device = target_device,
+    mode = async_launch and "async" or nil,
+    idempotency_key = request_id,
     timestamp = os.time()
   })
   
@@ -63,13 +214,15 @@ local function send_http_request(device, action)
     method = "POST",
     headers = {
       ["Content-Type"] = "application/json",
-      ["Content-Length"] = tostring(#request_body)
+      ["Content-Length"] = tostring(#request_body),
+      ["X-Request-ID"] = request_id,
+      ["Prefer"] = minimal_ack and "return=minimal" or nil
     },
     source = ltn12.source.string(request_body),
     sink = ltn12.sink.table(response_body)
   })
   
-  if code == 200 then
+  if code == 200 or code == 202 then
     log.info("Request successful: " .. code)
     return true, table.concat(response_body)
   else
@@ -142,6 +295,7 @@ local tv_app_launcher_driver = Driver("tv-app-launcher", {
   lifecycle_handlers = {
     init = device_init,
     added = device_added,
+    infoChanged = device_info_changed,
     removed = device_removed
   },
   capability_handlers = {
@@ -0,0 +1,124 @@
+"""
+One SmartThings API client per account
+"""
+
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+
+from settings import config
+from credentials import AccountCredentials, DEFAULT_ACCOUNT
+from smartthings import SmartThingsAPI
+
+logger = logging.getLogger(__name__)
+
+class AccountManager:
+    """One SmartThingsAPI per SmartThings account served by this process
+    
+    The ST_* settings are the "default" account. More accounts are read once
+    at startup from ACCOUNTS_FILE or the ACCOUNTS variable::
+    
+        {
+          "accounts": {
+            "smith": {"refresh_token": "...", "installed_app_id": "..."},
+            "jones": {"client_id": "...", "client_secret": "...",
+                      "token_file": "/app/data/jones_tokens.json"}
+          }
+        }
+    
+    Every account has its own token file, refresh scheduler, pooled HTTP
+    session, caches and command journal; registry devices name theirs with
+    "account". Planned refreshes are TOKEN_REFRESH_STAGGER seconds apart per
+    account (wrapping within TOKEN_REFRESH_LEAD), so accounts authorized at
+    the same time do not all call /oauth/token together.
+    """
+    
+    def __init__(self, path=None, inline_json=''):
+        self.path = Path(path) if path else None
+        self.inline_json = inline_json
+        self.source = None
+        self.apis = {}
+        for index, credentials in enumerate(self._load()):
+            if credentials.use_oauth:
+                logger.info(f"Account {credentials.name}: using OAuth authentication")
+            elif credentials.pat:
+                logger.info(f"Account {credentials.name}: using PAT authentication (OAuth not configured)")
+            elif credentials.name == DEFAULT_ACCOUNT or not credentials.client_id:
+                logger.warning(f"Account {credentials.name}: neither OAuth nor PAT configured! Authentication will fail.")
+            stagger = (index * config.TOKEN_REFRESH_STAGGER) % max(config.TOKEN_REFRESH_LEAD, 1)
+            self.apis[credentials.name] = SmartThingsAPI(use_oauth=credentials.use_oauth, credentials=credentials, stagger=stagger)
+        self.default = self.apis[DEFAULT_ACCOUNT]
+    
+    def _load(self):
+        """Default account from the environment plus the configured ones"""
+        accounts = [AccountCredentials.from_config()]
+        try:
+            if self.path is not None and self.path.exists():
+                with open(self.path, 'r') as f:
+                    document = json.load(f)
+                source = str(self.path)
+            elif self.inline_json:
+                document = json.loads(self.inline_json)
+                source = 'ACCOUNTS'
+            else:
+                return accounts
+            for name, data in (document.get('accounts') or {}).items():
+                credentials = AccountCredentials.from_dict(name, data)
+                if credentials.name == DEFAULT_ACCOUNT:
+                    raise ValueError(f"Account name '{DEFAULT_ACCOUNT}' is reserved for the ST_* settings")
+                accounts.append(credentials)
+        except Exception as e:
+            logger.error(f"Failed to load accounts, serving the default account only: {e}")
+            return accounts[:1]
+        self.source = source
+        logger.info(f"Accounts loaded from {source} ({len(accounts)} accounts)")
+        return accounts
+    
+    def get(self, name=None):
+        """Client for an account name (default account if empty), None if unknown"""
+        return self.apis.get((name or DEFAULT_ACCOUNT).lower())
+    
+    def api_for(self, name=None):
+        """Like get(), but raises KeyError for an account that is not configured"""
+        api = self.get(name)
+        if api is None:
+            raise KeyError(f"Unknown account '{name}'")
+        return api
+    
+    def names(self):
+        return sorted(self.apis)
+    
+    def active(self):
+        """Accounts with credentials (a bare default account only counts when it is the only one)"""
+        return {
+            name: api for name, api in sorted(self.apis.items())
+            if len(self.apis) == 1 or api.use_oauth or api.credentials.pat or api.credentials.client_id
+        }
+    
+    def start(self):
+        """Start each account's token refresh scheduler and command replayer"""
+        for api in self.apis.values():
+            if api.use_oauth:
+                api.refresher.start()
+            if api.replayer is not None:
+                api.replayer.start()
+    
+    def secrets(self):
+        """Live tokens and configured secrets of every account, for the log redactor"""
+        secrets = []
+        for api in self.apis.values():
+            secrets.extend((api.access_token, api.refresh_token, *api.credentials.secrets()))
+        return secrets
+    
+    def stats(self):
+        return {
+            name: {
+                'auth_method': 'OAuth' if api.use_oauth else 'PAT',
+                'token_expires_at': datetime.fromtimestamp(api.token_expires_at).isoformat() if api.token_expires_at else None,
+                'token_refresh': api.refresher.status(),
+                'status_cache': api.status_cache.stats(),
+                'http_pool': api.http.stats()
+            }
+            for name, api in sorted(self.apis.items())
+        }
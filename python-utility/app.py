@@ -3,345 +3,717 @@ TV App Launcher Utility
 Receives HTTP requests from SmartThings Edge Driver and launches TV app via SmartThings API
 """
 
-from flask import Flask, request, jsonify, redirect, session
-import requests
-import os
-import json
+import contextvars
+import hmac
 import logging
+import math
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait as wait_futures
 from datetime import datetime
-from dotenv import load_dotenv
-from pathlib import Path
+from urllib.parse import urlparse
+
+import requests
+from flask import Flask, Response, g, jsonify, request
 
-# Load environment variables from .env file
-load_dotenv()
+from settings import config, parse_bool
+from logs import log_context, log_redactor, start_log_context
+from resilience import error_status, upstream_guard
+from credentials import DEFAULT_ACCOUNT
+from registry import device_registry
+from metrics import HTTP_IN_FLIGHT, HTTP_REQUESTS, HTTP_REQUEST_LATENCY, metrics_payload
+from dns_cache import dns_cache
+from http_client import UpstreamWarmer
+from hub_channel import HubChannel
+from discovery import DeviceCatalog
+from journal import launch_queued
+from launches import LaunchDeduplicator, LaunchJobQueue
+from accounts import AccountManager
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-# Configuration
-class Config:
-    # SmartThings API configuration
-    ST_API_BASE_URL = "https://api.smartthings.com/v1"
-    ST_PAT = os.environ.get('SMARTTHINGS_PAT', '')  # Personal Access Token (fallback only)
+# Initialize one SmartThings API client per account
+# Each uses OAuth by default, falls back to PAT if OAuth is not configured
+started_at = datetime.now()
+accounts = AccountManager(config.ACCOUNTS_FILE, config.ACCOUNTS_JSON)
+st_api = accounts.default
+log_redactor.secrets_source = accounts.secrets
+launch_dedup = LaunchDeduplicator(config.DEDUP_STATE_DIR)
+device_catalogs = {
+    name: DeviceCatalog(api, api.credentials.scoped_path(config.DISCOVERY_CACHE_FILE))
+    for name, api in accounts.apis.items()
+}
+upstream_warmer = UpstreamWarmer([api.http for api in accounts.apis.values()], dns_cache)
+
+# Set Flask secret key for sessions
+app.secret_key = config.SECRET_KEY
+
+# Helpers shared by the Flask routes below and the async server in asgi_app.py
+
+def resolve_target(target):
+    """Look up a target in the device registry; returns (entry, error, status_code)"""
+    entry = device_registry.get(target)
+    if entry is None:
+        known = ', '.join(device_registry.targets()) or 'none'
+        return None, f"Unknown or unconfigured target device '{target or device_registry.default_target}' (known: {known})", 404
+    if accounts.get(entry.account) is None:
+        return None, f"{entry.name} belongs to unconfigured account '{entry.account}' (known: {', '.join(accounts.names())})", 500
+    return entry, None, None
+
+def resolve_account(name):
+    """Look up an account by name (default account if empty); returns (api, error, status_code)"""
+    api = accounts.get(name)
+    if api is None:
+        return None, f"Unknown account '{name}' (known: {', '.join(accounts.names())})", 404
+    return api, None, None
+
+def plan_launch(data, headers=None):
+    """Turn a launch request body into (plan, error, status_code)
+    
+    The plan holds the resolved device, app ID, rendered command payload and
+    idempotency key (if the caller supplied or implied one).
+    """
+    target_device = data.get('target_device') or data.get('target')
+    action = data.get('action') or 'launch'
+    entry, error, status_code = resolve_target(target_device)
+    if entry is None:
+        return None, error, status_code
+    
+    logger.info(f"Target device: {entry.name} ({entry.key})")
+    
+    app_id = data.get('app_id') or entry.app_id
+    if not app_id:
+        return None, f'No app ID configured for {entry.name} (set TV_APP_ID or app_id in the registry)', 500
+    
+    payload = entry.build_payload(action, app_id)
+    if payload is None:
+        return None, f"Action '{action}' is not defined for {entry.name}", 400
+    if not valid_replay_deadline(data.get('replay_deadline')):
+        return None, '"replay_deadline" must be a number of seconds', 400
+    smart = config.SMART_LAUNCH if data.get('smart') is None else parse_bool(data['smart'])
+    if smart is None:
+        return None, '"smart" must be true or false', 400
+    
+    return {
+        'target': entry.key,
+        'device_id': entry.device_id,
+        'device_name': entry.name,
+        'account': entry.account,
+        'app_id': app_id,
+        'action': action,
+        'payload': payload,
+        'smart': smart,
+        'replay_deadline': data.get('replay_deadline'),
+        'idempotency_key': idempotency_key_for(data, headers or {}, entry.key, action)
+    }, None, None
+
+def valid_replay_deadline(value):
+    """replay_deadline is optional; when given it must be a non-negative number of seconds"""
+    if value is None:
+        return True
+    try:
+        return float(value) >= 0
+    except (TypeError, ValueError):
+        return False
+
+def idempotency_key_for(data, headers, target, action):
+    """Idempotency-Key header, idempotency_key field, or the Edge Driver's device_id + timestamp"""
+    key = headers.get('Idempotency-Key') or data.get('idempotency_key')
+    if key:
+        return str(key)
+    if data.get('device_id') and data.get('timestamp') is not None:
+        return f"{data['device_id']}:{data['timestamp']}:{target}:{action}"
+    return None
+
+def status_attribute(status, capability, attribute, component='main'):
+    """Value of component/capability/attribute in a /devices/{id}/status document"""
+    try:
+        return status['components'][component][capability][attribute]['value']
+    except (KeyError, TypeError):
+        return None
+
+def smart_launch_payload(plan):
+    """Drop commands the cached device state makes redundant
     
-    # OAuth configuration
-    ST_CLIENT_ID = os.environ.get('ST_CLIENT_ID', '')
-    ST_CLIENT_SECRET = os.environ.get('ST_CLIENT_SECRET', '')
-    ST_REFRESH_TOKEN = os.environ.get('ST_REFRESH_TOKEN', '')
+    Returns (payload, report); payload is None when nothing needs sending.
+    The in-sync device-state mirror is preferred over the status cache;
+    without either every command is sent.
+    """
+    commands = plan['payload']['commands']
+    api = accounts.api_for(plan.get('account'))
+    status, age = api.mirror.snapshot(plan['device_id'])
+    source = 'mirror'
+    if status is None:
+        status, age = api.status_cache.peek(plan['device_id'], config.SMART_LAUNCH_MAX_AGE)
+        source = 'status_cache'
+    report = {
+        'state_source': source if status is not None else None,
+        'state_age_seconds': round(age, 1) if age is not None else None,
+        'commands_sent': [],
+        'commands_skipped': []
+    }
+    if status is None:
+        report['note'] = 'No fresh cached device state, sending all commands'
+        report['commands_sent'] = [f"{c.get('capability')}.{c.get('command')}" for c in commands]
+        return plan['payload'], report
     
-    # OAuth token storage
-    TOKEN_FILE = os.environ.get('TOKEN_FILE', '/app/data/oauth_tokens.json')
+    app_capability, _, app_attribute = config.SMART_LAUNCH_APP_ATTRIBUTE.rpartition('.')
+    switch_value = status_attribute(status, 'switch', 'switch')
+    current_app = status_attribute(status, app_capability, app_attribute) if app_capability else None
     
-    # OAuth callback configuration
-    # Use external callback page (GitHub Pages) since this service runs on local NAS
-    OAUTH_REDIRECT_URI = os.environ.get('OAUTH_REDIRECT_URI', 'https://tatuvlak.github.io/tv-weather-oauth/callback.html')
-    # Note: Authorization code from external callback must be manually entered via /oauth/token endpoint
+    to_send = []
+    for command in commands:
+        name = f"{command.get('capability')}.{command.get('command')}"
+        reason = None
+        if command.get('component', 'main') == 'main':
+            if name == 'switch.on' and switch_value == 'on':
+                reason = 'switch is already on'
+            elif name == 'switch.off' and switch_value == 'off':
+                reason = 'switch is already off'
+            elif (name == 'custom.launchapp.launchApp' and switch_value == 'on' and current_app
+                    and current_app in (command.get('arguments') or [])):
+                reason = f'app {current_app} is already running'
+        if reason:
+            report['commands_skipped'].append({'command': name, 'reason': reason})
+        else:
+            report['commands_sent'].append(name)
+            to_send.append(command)
     
-    # TV/Monitor configuration
-    # S95 TV (default)
-    TV_DEVICE_ID_S95 = os.environ.get('TV_DEVICE_ID_S95', os.environ.get('TV_DEVICE_ID', ''))
-    # M7 Monitor
-    TV_DEVICE_ID_M7 = os.environ.get('TV_DEVICE_ID_M7', '')
+    if to_send and len(to_send) < len(commands):
+        logger.info(f"Smart launch: skipping {len(commands) - len(to_send)} redundant command(s)")
+    return ({'commands': to_send} if to_send else None), report
+
+def launch_dedup_key(plan):
+    return f"launch:{plan['device_id']}:{plan['app_id']}:{plan['action']}:{'smart' if plan.get('smart') else 'full'}"
+
+def launch_with_dedup(plan):
+    """Launch a plan through the idempotency and dedup layers; returns (success, result, dedup_state)"""
+    def launch():
+        api = accounts.api_for(plan.get('account'))
+        if not plan.get('smart'):
+            return api.launch_app(plan['device_id'], plan['app_id'], plan['payload'], plan.get('replay_deadline'))
+        payload, report = smart_launch_payload(plan)
+        if payload is None:
+            logger.info(f"Smart launch: {plan['device_name']} already in the requested state, nothing sent")
+            return True, dict(report, response=None)
+        success, result = api.launch_app(plan['device_id'], plan['app_id'], payload, plan.get('replay_deadline'))
+        return success, dict(report, response=result) if success else result
     
-    TV_APP_ID = os.environ.get('TV_APP_ID', '')  # Your weather app ID
+    def deduplicated():
+        success, result, state = launch_dedup.run(launch_dedup_key(plan), config.LAUNCH_DEDUP_WINDOW, launch)
+        states.append(state)
+        return success, result
     
-    # Server configuration
-    PORT = int(os.environ.get('PORT', 5000))
-    HOST = os.environ.get('HOST', '0.0.0.0')
-    SECRET_KEY = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
+    states = []
+    if plan.get('idempotency_key'):
+        success, result, state = launch_dedup.run(f"idem:{plan['idempotency_key']}", config.IDEMPOTENCY_TTL, deduplicated)
+    else:
+        success, result = deduplicated()
+        state = None
+    # Report the outer (idempotency) state first, else whatever the device-level layer did
+    return success, result, state or (states[0] if states else None)
+
+launch_jobs = LaunchJobQueue(launch_with_dedup, config.JOB_STATE_DIR, workers=config.JOB_WORKERS, maxsize=config.JOB_QUEUE_SIZE)
 
-config = Config()
+BATCH_POLICIES = ('all', 'any', 'best_effort')
 
-class SmartThingsAPI:
-    """SmartThings API client with OAuth support"""
+def plan_batch(data):
+    """Validate a batch launch body; returns (batch, error, status_code)
     
-    def __init__(self, use_oauth=True):
-        self.use_oauth = use_oauth
-        self.access_token = None
-        self.refresh_token = None
-        self.token_expires_at = None
-        
-        # Load tokens from file if they exist
-        if use_oauth:
-            self._load_tokens()
-            # If we have a refresh token but no valid access token, refresh immediately
-            if self.refresh_token and (not self.access_token or self.is_token_expired()):
-                logger.info("Initial token refresh on startup")
-                self.refresh_oauth_token()
-    
-    def _load_tokens(self):
-        """Load OAuth tokens from file"""
-        try:
-            token_file = Path(config.TOKEN_FILE)
-            if token_file.exists():
-                with open(token_file, 'r') as f:
-                    data = json.load(f)
-                    self.access_token = data.get('access_token')
-                    self.refresh_token = data.get('refresh_token')
-                    self.token_expires_at = data.get('expires_at')
-                    self._token_created_at = data.get('created_at', datetime.now().timestamp())
-                    logger.info("OAuth tokens loaded from file")
-                    logger.info(f"Loaded: has_access_token={bool(self.access_token)}, has_refresh_token={bool(self.refresh_token)}")
-            else:
-                # Try to use refresh token from environment if file doesn't exist
-                if config.ST_REFRESH_TOKEN:
-                    self.refresh_token = config.ST_REFRESH_TOKEN
-                    logger.info("Using refresh token from environment")
-        except Exception as e:
-            logger.error(f"Failed to load tokens from file: {e}")
+    Accepts either "launches": [{"target_device", "app_id", "action"}, ...]
+    or "targets": [...] with a shared "app_id"/"action". Items that do not
+    resolve are kept as per-device "invalid" results rather than failing
+    the whole batch.
+    """
+    launches = data.get('launches')
+    if launches is None and data.get('targets') is not None:
+        launches = [
+            {'target_device': target, 'app_id': data.get('app_id'), 'action': data.get('action')}
+            for target in data['targets']
+        ]
+    if not isinstance(launches, list) or not launches:
+        return None, 'Request body must contain a non-empty "launches" or "targets" list', 400
+    if len(launches) > config.BATCH_MAX_TARGETS:
+        return None, f'Too many launches in one batch (max {config.BATCH_MAX_TARGETS})', 400
     
-    def _save_tokens(self):
-        """Save OAuth tokens to file"""
-        try:
-            token_file = Path(config.TOKEN_FILE)
-            token_file.parent.mkdir(parents=True, exist_ok=True)
-            
-            # Store token creation timestamp for age tracking
-            self._token_created_at = datetime.now().timestamp()
-            
-            data = {
-                'access_token': self.access_token,
-                'refresh_token': self.refresh_token,
-                'expires_at': self.token_expires_at,
-                'created_at': self._token_created_at,
-                'updated_at': datetime.now().isoformat()
-            }
-            
-            with open(token_file, 'w') as f:
-                json.dump(data, f, indent=2)
-            logger.info("OAuth tokens saved to file")
-            logger.info(f"Saved: has_access_token={bool(self.access_token)}, has_refresh_token={bool(self.refresh_token)}")
-        except Exception as e:
-            logger.error(f"Failed to save tokens to file: {e}")
-    
-    def get_headers(self):
-        """Get API request headers"""
-        if self.use_oauth:
-            if not self.access_token or self.is_token_expired():
-                logger.info("Token missing or expired, refreshing...")
-                self.refresh_oauth_token()
-            token = self.access_token
+    policy = data.get('policy') or 'all'
+    if policy not in BATCH_POLICIES:
+        return None, f"Unknown policy '{policy}' (expected one of: {', '.join(BATCH_POLICIES)})", 400
+    
+    deadline = data.get('deadline')
+    if deadline is None:
+        deadline = config.BATCH_DEFAULT_DEADLINE
+        if config.LAUNCH_TIME_BUDGET > 0:
+            deadline = min(deadline, config.LAUNCH_TIME_BUDGET)
+    try:
+        if isinstance(deadline, bool):
+            raise TypeError
+        deadline = float(deadline)
+    except (TypeError, ValueError):
+        return None, '"deadline" must be a number of seconds', 400
+    if not math.isfinite(deadline) or deadline <= 0:
+        return None, '"deadline" must be a positive, finite number of seconds', 400
+    if config.LAUNCH_TIME_BUDGET > 0 and deadline > config.LAUNCH_TIME_BUDGET:
+        # The request waits for the whole batch, so it must end before the worker timeout
+        return None, f'"deadline" must not exceed LAUNCH_TIME_BUDGET ({config.LAUNCH_TIME_BUDGET:g} seconds)', 400
+    
+    items = []
+    for index, launch in enumerate(launches):
+        if isinstance(launch, str):
+            launch = {'target_device': launch}
+        if not isinstance(launch, dict):
+            items.append({'index': index, 'plan': None, 'error': 'Launch entry must be an object or target name', 'status_code': 400})
+            continue
+        plan, error, status_code = plan_launch(launch)
+        items.append({'index': index, 'plan': plan, 'error': error, 'status_code': status_code,
+                      'target': launch.get('target_device') or launch.get('target')})
+    
+    return {
+        'items': items,
+        'policy': policy,
+        'fail_fast': bool(data.get('fail_fast', False)),
+        'deadline': deadline
+    }, None, None
+
+def batch_result(item, status, success=False, result=None, error=None, duration_ms=None, deduplicated=None):
+    """Per-device entry of a batch launch response"""
+    plan = item['plan'] or {}
+    entry = {
+        'index': item['index'],
+        'target': plan.get('target', item.get('target')),
+        'device': plan.get('device_name'),
+        'app_id': plan.get('app_id'),
+        'status': status,
+        'success': success,
+        'duration_ms': duration_ms
+    }
+    if error is not None:
+        entry['error'] = error
+    if result is not None:
+        entry['result'] = result
+    if deduplicated:
+        entry['deduplicated'] = deduplicated
+    return entry
+
+def summarize_batch(batch, results, started):
+    """Apply the batch policy to per-device results; returns (payload, status_code)"""
+    results = sorted(results, key=lambda r: r['index'])
+    launched = sum(1 for r in results if r['success'])
+    if batch['policy'] == 'all':
+        success = launched == len(results)
+    elif batch['policy'] == 'any':
+        success = launched > 0
+    else:
+        success = True
+    counts = {}
+    for r in results:
+        counts[r['status']] = counts.get(r['status'], 0) + 1
+    return {
+        'success': success,
+        'policy': batch['policy'],
+        'launched': launched,
+        'total': len(results),
+        'counts': counts,
+        'duration_ms': round((time.monotonic() - started) * 1000, 1),
+        'timestamp': datetime.now().isoformat(),
+        'results': results
+    }, 200 if success else 500
+
+# Shared by all batch requests in this worker so the upstream fan-out stays bounded
+batch_executor = ThreadPoolExecutor(max_workers=config.BATCH_MAX_WORKERS, thread_name_prefix='batch-launch')
+
+def run_batch(batch):
+    """Launch every planned item concurrently on batch_executor within the batch deadline"""
+    started = time.monotonic()
+    deadline_at = started + batch['deadline']
+    results = []
+    pending = {}
+    
+    def launch(item):
+        t0 = time.monotonic()
+        success, result, dedup_state = launch_with_dedup(item['plan'])
+        duration_ms = round((time.monotonic() - t0) * 1000, 1)
+        if success:
+            status = 'deferred' if launch_queued(result) else 'launched'
+            return batch_result(item, status, True, result=result, duration_ms=duration_ms, deduplicated=dedup_state)
+        return batch_result(item, 'failed', error=result, duration_ms=duration_ms)
+    
+    for item in batch['items']:
+        if item['plan'] is None:
+            results.append(batch_result(item, 'invalid', error=item['error']))
         else:
-            token = config.ST_PAT
-            
-        if not token:
-            raise ValueError("No authentication token available")
-            
-        return {
-            'Authorization': f'Bearer {token}',
-            'Content-Type': 'application/json'
-        }
+            # Each launch thread logs under the batch request's ID
+            pending[batch_executor.submit(contextvars.copy_context().run, launch, item)] = item
     
-    def is_token_expired(self):
-        """Check if current OAuth token is expired"""
-        if not self.token_expires_at:
-            return True
-        # Add 5-minute buffer before expiration
-        buffer_seconds = 300
-        return datetime.now().timestamp() >= (self.token_expires_at - buffer_seconds)
-    
-    def refresh_oauth_token(self):
-        """Refresh OAuth access token using refresh token"""
-        if not self.refresh_token:
-            logger.error("No refresh token available")
-            return False
-            
-        if not config.ST_CLIENT_ID:
-            logger.error("OAuth client ID not configured")
-            return False
-        
-        # Calculate token age for logging
-        if hasattr(self, '_token_created_at'):
-            token_age_hours = (datetime.now().timestamp() - self._token_created_at) / 3600
-            logger.info(f"Attempting token refresh (token age: {token_age_hours:.2f} hours)")
+    aborted = False
+    while pending:
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            break
+        done, _ = wait_futures(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
+            item = pending.pop(future)
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.exception("Unexpected error in batch launch")
+                results.append(batch_result(item, 'failed', error=str(e)))
+            if batch['fail_fast'] and not results[-1]['success']:
+                aborted = True
+        if aborted:
+            break
+    
+    # Whatever is left missed the deadline or was skipped by fail_fast;
+    # launches already running upstream finish in the background
+    for future, item in pending.items():
+        if future.cancel():
+            results.append(batch_result(item, 'cancelled', error='Skipped after an earlier failure' if aborted else 'Batch deadline reached before launch started'))
         else:
-            logger.info("Attempting token refresh")
-        
-        logger.info(f"Token status: has_refresh_token={bool(self.refresh_token)}")
-            
-        # SmartThings uses /oauth/token endpoint
-        token_url = "https://api.smartthings.com/oauth/token"
-        
-        # Prepare form data
-        data = {
-            'grant_type': 'refresh_token',
-            'refresh_token': self.refresh_token
-        }
+            results.append(batch_result(item, 'timeout', error='Batch deadline reached' if not aborted else 'Abandoned after an earlier failure'))
+    
+    return summarize_batch(batch, results, started)
+
+def plan_commands(data):
+    """Validate a /commands body and merge its steps per device; returns (plan, error, status_code)
+    
+    Steps keep their order within each device (steps for different devices
+    have no ordering). Each device's commands are split into requests of at
+    most COMMAND_BATCH_MAX commands, so a routine costs one upstream call per
+    device instead of one per step.
+    """
+    steps = data.get('steps')
+    if not isinstance(steps, list) or not steps:
+        return None, "'steps' must be a non-empty list of commands", 400
+    if len(steps) > config.COMMAND_MAX_STEPS:
+        return None, f"Too many steps ({len(steps)}, max {config.COMMAND_MAX_STEPS})", 400
+    
+    groups = {}
+    errors = []
+    for index, step in enumerate(steps):
+        if not isinstance(step, dict) or not step.get('capability') or not step.get('command'):
+            errors.append(f"step {index}: 'capability' and 'command' are required")
+            continue
+        arguments = step.get('arguments', [])
+        if not isinstance(arguments, list):
+            errors.append(f"step {index}: 'arguments' must be a list")
+            continue
+        entry, error, _ = resolve_target(step.get('target') or data.get('target'))
+        if entry is None:
+            errors.append(f"step {index}: {error}")
+            continue
         
-        # Use Basic Auth if client_secret is available
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded'
+        group = groups.get(entry.key)
+        if group is None:
+            group = groups[entry.key] = {
+                'target': entry.key,
+                'device_id': entry.device_id,
+                'device_name': entry.name,
+                'account': entry.account,
+                'steps': [],
+                'commands': []
+            }
+        command = {
+            'component': step.get('component') or 'main',
+            'capability': step['capability'],
+            'command': step['command']
         }
-        
-        auth = None
-        if config.ST_CLIENT_SECRET:
-            # Use HTTP Basic Authentication with client credentials
-            auth = (config.ST_CLIENT_ID, config.ST_CLIENT_SECRET)
-            logger.info("Using Basic Auth for token refresh")
-        else:
-            # Include client_id in body if no client_secret
-            data['client_id'] = config.ST_CLIENT_ID
-            logger.info("Using client_id in body for token refresh")
-        
+        if arguments:
+            command['arguments'] = arguments
+        group['steps'].append(index)
+        group['commands'].append(command)
+    
+    if errors:
+        return None, 'Invalid steps: ' + '; '.join(errors), 400
+    
+    size = max(1, config.COMMAND_BATCH_MAX)
+    for group in groups.values():
+        group['batches'] = [group['commands'][i:i + size] for i in range(0, len(group['commands']), size)]
+    if not valid_replay_deadline(data.get('replay_deadline')):
+        return None, '"replay_deadline" must be a number of seconds', 400
+    return {
+        'groups': list(groups.values()),
+        'steps': len(steps),
+        'replay_deadline': data.get('replay_deadline'),
+        'validate': data.get('validate', True) is not False,
+        'dry_run': bool(data.get('dry_run'))
+    }, None, None
+
+def command_capability_errors(group, capabilities):
+    """Steps whose capability the device does not have on that component"""
+    errors = []
+    for index, command in zip(group['steps'], group['commands']):
+        available = capabilities.get(command['component'])
+        if available is None:
+            errors.append(f"step {index}: {group['device_name']} has no component '{command['component']}'")
+        elif command['capability'] not in available:
+            errors.append(f"step {index}: {group['device_name']} does not support {command['capability']} on {command['component']}")
+    return errors
+
+def command_group_result(group, status, success, **fields):
+    result = {
+        'target': group['target'],
+        'device': group['device_name'],
+        'steps': group['steps'],
+        'commands': len(group['commands']),
+        'status': status,
+        'success': success
+    }
+    result.update(fields)
+    return result
+
+def check_command_group(group, capabilities, cache_state, dry_run):
+    """Result for a group that should not be sent (invalid or dry run), else None"""
+    if capabilities is not None:
+        errors = command_capability_errors(group, capabilities)
+        if errors:
+            return command_group_result(group, 'invalid', False, requests=0, errors=errors, capabilities_cache=cache_state)
+    if dry_run:
+        return command_group_result(group, 'planned', True, requests=len(group['batches']),
+                                    validated=capabilities is not None, batches=[{'commands': b} for b in group['batches']])
+    return None
+
+def summarize_commands(plan, results, started):
+    """Overall /commands response; returns (payload, status_code)"""
+    results = sorted(results, key=lambda r: r['steps'][0])
+    success = all(r['success'] for r in results)
+    if success:
+        # Accepted, but some commands only reach the device when the journal replays them
+        status_code = 202 if any(r['status'] == 'deferred' for r in results) else 200
+    elif not any(r['status'] in ('sent', 'deferred', 'failed') for r in results):
+        # Rejected by validation before anything was sent
+        status_code = 400
+    else:
+        status_code = 500
+    return {
+        'success': success,
+        'dry_run': plan['dry_run'],
+        'steps': plan['steps'],
+        'devices': len(results),
+        'upstream_requests': 0 if plan['dry_run'] else sum(r['requests'] for r in results),
+        'duration_ms': round((time.monotonic() - started) * 1000, 1),
+        'timestamp': datetime.now().isoformat(),
+        'results': results
+    }, status_code
+
+def run_command_group(group, validate, dry_run, replay_deadline=None):
+    """Validate one device's commands against its cached capabilities, then send its batches in order"""
+    api = accounts.api_for(group['account'])
+    capabilities = cache_state = None
+    if validate:
+        # If the description cannot be fetched, send anyway and let SmartThings validate
+        capabilities, cache_state = api.get_device_capabilities(group['device_id'])
+    skipped = check_command_group(group, capabilities, cache_state, dry_run)
+    if skipped is not None:
+        return skipped
+    
+    responses = []
+    for batch in group['batches']:
+        success, response = api.send_commands(group['device_id'], batch, replay_deadline)
+        if not success:
+            return command_group_result(group, 'failed', False, requests=len(responses) + 1,
+                                        validated=capabilities is not None, error=response, results=responses)
+        responses.append(response)
+    status = 'deferred' if any(launch_queued(r) for r in responses) else 'sent'
+    return command_group_result(group, status, True, requests=len(responses),
+                                validated=capabilities is not None, results=responses)
+
+def run_commands(plan):
+    """Run every device group concurrently on batch_executor"""
+    started = time.monotonic()
+    futures = {
+        batch_executor.submit(contextvars.copy_context().run, run_command_group, group,
+                              plan['validate'], plan['dry_run'], plan['replay_deadline']): group
+        for group in plan['groups']
+    }
+    results = []
+    for future, group in futures.items():
         try:
-            logger.info("Refreshing OAuth token...")
-            response = requests.post(
-                token_url,
-                data=data,
-                headers=headers,
-                auth=auth,
-                timeout=10
-            )
-            
-            if response.status_code != 200:
-                logger.error(f"Token refresh failed: {response.status_code}")
-                logger.error(f"Response: {response.text}")
-                return False
-            
-            token_data = response.json()
-            self.access_token = token_data.get('access_token')
-            
-            # Calculate expiration time
-            expires_in = token_data.get('expires_in', 86400)  # Default 24 hours
-            self.token_expires_at = datetime.now().timestamp() + expires_in
-            
-            # Preserve existing refresh_token if new one not provided
-            # SmartThings typically doesn't return refresh_token on refresh flow
-            new_refresh_token = token_data.get('refresh_token')
-            if new_refresh_token:
-                self.refresh_token = new_refresh_token
-                logger.info("Refresh token updated with new value")
-            else:
-                logger.info("Preserving existing refresh_token (not returned in response)")
-            
-            # Validate we have a refresh token
-            if not self.refresh_token:
-                logger.warning("No refresh_token available - tokens may not be refreshable")
-            
-            # Save tokens to file
-            self._save_tokens()
-            
-            logger.info(f"OAuth token refreshed successfully (expires in {expires_in}s)")
-            logger.info(f"Token status: has_access_token={bool(self.access_token)}, has_refresh_token={bool(self.refresh_token)}")
-            return True
-            
+            results.append(future.result())
         except Exception as e:
-            logger.error(f"Failed to refresh OAuth token: {e}")
-            return False
+            logger.exception("Unexpected error in command pipeline")
+            results.append(command_group_result(group, 'failed', False, requests=0, error=str(e)))
+    return summarize_commands(plan, results, started)
+
+def wants_async_launch(data, args, headers):
+    """True if the caller asked for a 202 + job ID instead of waiting for SmartThings"""
+    if str(data.get('mode', '')).lower() == 'async':
+        return True
+    if parse_bool(args.get('async'), False):
+        return True
+    return 'respond-async' in headers.get('Prefer', '').lower()
+
+def wants_minimal_ack(data, args, headers):
+    """True if the caller only wants to know the outcome, not the upstream response (Prefer: return=minimal)"""
+    if str(data.get('ack', '')).lower() in ('min', 'minimal'):
+        return True
+    if args.get('ack', '').lower() in ('min', 'minimal'):
+        return True
+    return 'return=minimal' in headers.get('Prefer', '').lower()
+
+def accept_launch_job(plan, minimal=False):
+    """Queue a launch; returns (payload, status_code, location)"""
+    job = launch_jobs.submit(plan)
+    if job is None:
+        return {'success': False, 'error': 'Launch queue is full, try again later'}, 503, None
+    location = f"/jobs/{job['job_id']}"
+    if minimal:
+        return {'success': True, 'status': 'accepted', 'job_id': job['job_id']}, 202, location
+    return {
+        'success': True,
+        'accepted': True,
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'status_url': location,
+        'device': plan['device_name'],
+        'timestamp': datetime.now().isoformat()
+    }, 202, location
+
+def launch_payload(plan, success, result, dedup_state, minimal=False):
+    """Response document for a finished launch; returns (payload, status_code)
     
-    def launch_app(self, device_id, app_id):
-        """Launch app on Samsung TV - sends power on + app launch commands"""
-        url = f"{config.ST_API_BASE_URL}/devices/{device_id}/commands"
-        
-        # Send both power on and app launch commands
-        # Based on your existing tv-app-launch.py implementation
-        payload = {
-            "commands": [
-                {
-                    "component": "main",
-                    "capability": "switch",
-                    "command": "on"
-                },
-                {
-                    "component": "main",
-                    "capability": "custom.launchapp",
-                    "command": "launchApp",
-                    "arguments": [app_id]
-                }
-            ]
+    The minimal ack only carries the outcome (launched, queued for replay or
+    failed), leaving out the device name, message and upstream result. A
+    launch that gave up waiting for an identical one in flight is a 409.
+    """
+    if not success:
+        status_code = 409 if dedup_state == 'in_progress' else 500
+        if minimal:
+            return {'success': False, 'status': 'failed', 'error': result}, status_code
+        return {'success': False, 'error': result, 'deduplicated': dedup_state}, status_code
+    queued = launch_queued(result)
+    status_code = 202 if queued else 200
+    if minimal:
+        return {'success': True, 'status': 'queued' if queued else 'launched', 'deduplicated': dedup_state}, status_code
+    device_name = plan['device_name']
+    payload = {'success': True}
+    if queued:
+        payload.update(queued=True, message=f'SmartThings unavailable, launch on {device_name} queued for replay')
+    else:
+        payload['message'] = f'TV app launched successfully on {device_name}'
+    payload.update({
+        'device': device_name,
+        'timestamp': datetime.now().isoformat(),
+        'deduplicated': dedup_state,
+        'result': result
+    })
+    return payload, status_code
+
+def hub_channel_launch(fields):
+    """Launch for one hub channel line; returns (payload, status_code, minimal)"""
+    request_id, token = start_log_context({'X-Request-ID': fields.get('rid', '')}, 'hub-channel')
+    started = time.perf_counter()
+    minimal = fields.get('ack', 'min').lower() != 'full'
+    status_code = 500
+    HTTP_IN_FLIGHT.labels('hub-channel').inc()
+    try:
+        data = {
+            'target': fields.get('target'),
+            'action': fields.get('action'),
+            'app_id': fields.get('app'),
+            'replay_deadline': fields.get('deadline'),
+            'idempotency_key': fields.get('idem')
         }
-        
-        try:
-            # Try with current token
-            response = requests.post(
-                url,
-                json=payload,
-                headers=self.get_headers(),
-                timeout=10
-            )
-            
-            # If unauthorized and using OAuth, try refreshing token
-            if response.status_code == 401 and self.use_oauth:
-                logger.info("Token expired (401), attempting to refresh")
-                if self.refresh_oauth_token():
-                    response = requests.post(
-                        url,
-                        json=payload,
-                        headers=self.get_headers(),
-                        timeout=10
-                    )
-            
-            response.raise_for_status()
-            logger.info(f"Successfully launched app {app_id} on device {device_id}")
-            return True, response.json()
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to launch app: {e}")
-            if hasattr(e, 'response') and e.response is not None:
-                logger.error(f"Response: {e.response.text}")
-            return False, str(e)
-    
-    def get_device_status(self, device_id):
-        """Get device status"""
-        url = f"{config.ST_API_BASE_URL}/devices/{device_id}/status"
-        
-        try:
-            response = requests.get(
-                url,
-                headers=self.get_headers(),
-                timeout=10
-            )
-            response.raise_for_status()
-            return response.json()
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to get device status: {e}")
-            return None
-
-# Initialize SmartThings API client
-# Uses OAuth by default, falls back to PAT if OAuth is not configured
-use_oauth = bool(config.ST_CLIENT_ID and (config.ST_REFRESH_TOKEN or Path(config.TOKEN_FILE).exists()))
-if not use_oauth and not config.ST_PAT:
-    logger.warning("Neither OAuth nor PAT configured! Authentication will fail.")
-elif use_oauth:
-    logger.info("Using OAuth authentication")
-else:
-    logger.info("Using PAT authentication (OAuth not configured)")
-    
-st_api = SmartThingsAPI(use_oauth=use_oauth)
+        if 'smart' in fields:
+            data['smart'] = fields['smart']
+        plan, error, status_code = plan_launch(data)
+        if plan is None:
+            return {'success': False, 'error': error}, status_code, minimal
+        if parse_bool(fields.get('async'), False):
+            payload, status_code, _ = accept_launch_job(plan, minimal)
+            return payload, status_code, minimal
+        success, result, dedup_state = launch_with_dedup(plan)
+        payload, status_code = launch_payload(plan, success, result, dedup_state, minimal)
+        return payload, status_code, minimal
+    finally:
+        duration = time.perf_counter() - started
+        HTTP_IN_FLIGHT.labels('hub-channel').dec()
+        HTTP_REQUEST_LATENCY.labels('hub-channel', 'LAUNCH').observe(duration)
+        HTTP_REQUESTS.labels('hub-channel', 'LAUNCH', str(status_code)).inc()
+        logger.info(f"LAUNCH hub-channel {status_code} {duration * 1000:.1f}ms",
+                    extra={'method': 'LAUNCH', 'status': status_code, 'duration_ms': round(duration * 1000, 1)})
+        log_context.reset(token)
 
-# Set Flask secret key for sessions
-app.secret_key = config.SECRET_KEY
+hub_channel = HubChannel(config.HUB_CHANNEL_PORT, hub_channel_launch)
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    """Health check endpoint"""
-    return jsonify({
-        'status': 'healthy',
+def start_services():
+    """Start this process's background threads and listeners; called by the serving entry points, not at import
+    
+    gunicorn calls it from post_worker_init (gunicorn.conf.py), the async
+    server from its lifespan and `python app.py` before serving, so scripts
+    and tests importing app.py start no threads and bind no ports: token
+    refresh schedulers and journal replayers, keep-warm and the hub channel.
+    Safe to call more than once.
+    """
+    accounts.start()
+    upstream_warmer.start()
+    hub_channel.start()
+
+def health_payload():
+    """Health check document (without the serving-mode specific pool stats)"""
+    open_circuits = upstream_guard.open_circuits()
+    return {
+        # Still served with 200: a SmartThings outage is no reason to restart the container
+        'status': 'degraded' if open_circuits else 'healthy',
+        'open_circuits': open_circuits,
         'timestamp': datetime.now().isoformat(),
         'version': '2.0.0',
-        'auth_method': 'OAuth' if st_api.use_oauth else 'PAT'
-    })
+        'auth_method': 'OAuth' if st_api.use_oauth else 'PAT',
+        'status_cache': st_api.status_cache.stats(),
+        'capability_cache': st_api.capability_cache.stats(),
+        'state_mirror': st_api.mirror.stats(),
+        'discovery': device_catalogs[DEFAULT_ACCOUNT].stats(),
+        'command_journal': dict(st_api.journal.stats(), replayer=st_api.replayer.stats()) if st_api.journal else None,
+        'launch_jobs': launch_jobs.stats(),
+        'launch_dedup': launch_dedup.stats(),
+        'upstream': upstream_guard.stats(),
+        'local_control': st_api.local.stats(),
+        'keep_warm': upstream_warmer.stats(),
+        'hub_channel': hub_channel.stats(),
+        'accounts': accounts.stats()
+    }
 
-@app.route('/oauth/authorize', methods=['GET'])
-def oauth_authorize():
-    """Get OAuth authorization URL (manual flow for local NAS deployment)"""
-    if not config.ST_CLIENT_ID:
-        return jsonify({
-            'success': False,
-            'error': 'OAuth client ID not configured'
-        }), 500
+def auth_readiness(api):
+    """Readiness check for one account's credentials"""
+    if api.use_oauth:
+        api.ensure_tokens_loaded()
+        token_valid = bool(api.access_token) and not api.is_token_expired(buffer_seconds=0)
+        if token_valid:
+            detail = 'access token valid'
+        elif api.refresh_token:
+            detail = 'waiting for token refresh'
+        else:
+            detail = 'not authorized, see /oauth/authorize'
+        return {'ready': token_valid, 'method': 'OAuth', 'detail': detail}
+    pat = api.credentials.pat
+    return {'ready': bool(pat), 'method': 'PAT',
+            'detail': 'PAT configured' if pat else 'no credentials configured'}
+
+def readiness_payload():
+    """Readiness document and status code (200 ready, 503 not yet)
     
-    # Build authorization URL
-    auth_url = "https://api.smartthings.com/oauth/authorize"
+    /health only says the process is alive. /ready also requires usable
+    credentials (a valid OAuth access token or a PAT) for every configured
+    account and at least one launch target, so it stays 503 while the
+    startup token refresh is still running in the background.
+    """
+    checks = {}
+    for name, api in accounts.active().items():
+        checks['auth' if name == DEFAULT_ACCOUNT else f'auth:{name}'] = auth_readiness(api)
+    targets = device_registry.targets()
+    checks['device_registry'] = {'ready': bool(targets), 'targets': len(targets)}
+    ready = all(check['ready'] for check in checks.values())
+    return {
+        'ready': ready,
+        'started_at': started_at.isoformat(),
+        'uptime_seconds': round((datetime.now() - started_at).total_seconds(), 1),
+        'checks': checks
+    }, 200 if ready else 503
+
+def authorization_payload(api):
+    """Authorization URL and instructions for the manual OAuth flow of one account"""
     params = {
-        'client_id': config.ST_CLIENT_ID,
+        'client_id': api.credentials.client_id,
         'response_type': 'code',
         'redirect_uri': config.OAUTH_REDIRECT_URI,
         'scope': 'r:devices:* x:devices:*'  # Adjust scopes as needed
@@ -350,24 +722,282 @@ def oauth_authorize():
     # Create query string
     from urllib.parse import urlencode
     query = urlencode(params)
-    full_url = f"{auth_url}?{query}"
-    
-    logger.info(f"Authorization URL requested")
+    full_url = f"{config.ST_OAUTH_AUTHORIZE_URL}?{query}"
+    body = '{"code": "your-code"}' if api.account == DEFAULT_ACCOUNT else f'{{"code": "your-code", "account": "{api.account}"}}'
     
-    # Return JSON with instructions for manual OAuth flow
-    return jsonify({
+    return {
         'success': True,
+        'account': api.account,
         'authorization_url': full_url,
         'instructions': [
             '1. Open the authorization_url in your browser',
             '2. Log in with your SmartThings account and authorize',
             '3. You will be redirected to the callback page with the code',
             '4. Copy the authorization code from the callback page',
-            '5. POST the code to /oauth/token endpoint: {"code": "your-code"}'
+            f'5. POST the code to /oauth/token endpoint: {body}'
         ],
         'callback_url': config.OAUTH_REDIRECT_URI,
         'token_endpoint': '/oauth/token'
-    })
+    }
+
+def code_exchange_request(code, credentials):
+    """Keyword arguments for the authorization_code POST to ST_OAUTH_TOKEN_URL"""
+    token_data = {
+        'grant_type': 'authorization_code',
+        'code': code,
+        'redirect_uri': config.OAUTH_REDIRECT_URI
+    }
+    
+    headers = {
+        'Content-Type': 'application/x-www-form-urlencoded'
+    }
+    
+    auth = None
+    if credentials.client_secret:
+        auth = (credentials.client_id, credentials.client_secret)
+    else:
+        token_data['client_id'] = credentials.client_id
+    
+    return {'data': token_data, 'headers': headers, 'auth': auth}
+
+def refresh_status_payload(api):
+    """Background token refresh schedule and recent refresh outcomes of one account"""
+    api.ensure_tokens_loaded()
+    return {
+        'success': True,
+        'account': api.account,
+        'accounts': accounts.names(),
+        'auth_method': 'OAuth' if api.use_oauth else 'PAT',
+        'token_expires_at': datetime.fromtimestamp(api.token_expires_at).isoformat() if api.token_expires_at else None,
+        'scheduler': api.refresher.status(),
+        'history': list(reversed(api.refresh_history))
+    }
+
+def webhook_rejection(token):
+    """Check the ?token= on a webhook call; returns (error, status_code), or (None, None) if allowed
+    
+    SmartThings request signatures are not verified, so the token is the only
+    thing keeping strangers from rewriting the mirror or (re)installing
+    subscriptions: without ST_WEBHOOK_TOKEN the webhook is disabled.
+    """
+    if not config.ST_WEBHOOK_TOKEN:
+        return 'Webhook disabled: set ST_WEBHOOK_TOKEN and register the target URL with ?token=', 503
+    if not token or not hmac.compare_digest(str(token), config.ST_WEBHOOK_TOKEN):
+        return 'Invalid webhook token', 403
+    return None, None
+
+def handle_lifecycle(data, api):
+    """Answer one SmartThings webhook SmartApp lifecycle call; returns (payload, status_code)
+    
+    EVENT feeds the account's device-state mirror, INSTALL/UPDATE (re)register
+    the subscriptions for the account's devices with the token SmartThings
+    sends along, and CONFIRMATION confirms the webhook target URL.
+    """
+    lifecycle = data.get('lifecycle')
+    if lifecycle == 'PING':
+        return {'pingData': {'challenge': (data.get('pingData') or {}).get('challenge')}}, 200
+    
+    if lifecycle == 'CONFIRMATION':
+        confirmation_url = (data.get('confirmationData') or {}).get('confirmationUrl', '')
+        host = urlparse(confirmation_url).hostname or ''
+        if urlparse(confirmation_url).scheme != 'https' or not (host == 'smartthings.com' or host.endswith('.smartthings.com')):
+            return {'error': 'Confirmation URL is not a SmartThings URL'}, 400
+        response = api.http.get(confirmation_url, call='webhook_confirm')
+        response.raise_for_status()
+        logger.info("Webhook target confirmed with SmartThings")
+        return {'targetUrl': (data.get('confirmationData') or {}).get('targetUrl')}, 200
+    
+    if lifecycle == 'CONFIGURATION':
+        if (data.get('configurationData') or {}).get('phase') == 'INITIALIZE':
+            return {'configurationData': {'initialize': {
+                'name': 'TV App Launcher',
+                'description': 'Mirrors TV state for the TV App Launcher utility',
+                'id': 'tv-app-launcher',
+                'permissions': ['r:devices:*'],
+                'firstPageId': '1'
+            }}}, 200
+        return {'configurationData': {'page': {
+            'pageId': '1',
+            'name': 'TV App Launcher',
+            'complete': True,
+            'sections': []
+        }}}, 200
+    
+    if lifecycle in ('INSTALL', 'UPDATE'):
+        key = 'installData' if lifecycle == 'INSTALL' else 'updateData'
+        lifecycle_data = data.get(key) or {}
+        installed_app_id = (lifecycle_data.get('installedApp') or {}).get('installedAppId')
+        if not installed_app_id:
+            return {'error': 'installedAppId missing'}, 400
+        api.register_subscriptions(installed_app_id, device_registry.device_ids(api.account), lifecycle_data.get('authToken'))
+        return {key: {}}, 200
+    
+    if lifecycle == 'EVENT':
+        events = (data.get('eventData') or {}).get('events') or []
+        applied = api.mirror.apply_events(events)
+        logger.debug(f"Webhook: applied {applied}/{len(events)} device event(s)")
+        return {'eventData': {}}, 200
+    
+    if lifecycle == 'UNINSTALL':
+        api.mirror.mark_gap(None, 'uninstalled')
+        logger.warning("SmartApp uninstalled; device-state mirror falls back to polling")
+        return {'uninstallData': {}}, 200
+    
+    return {'error': f'Unsupported lifecycle {lifecycle!r}'}, 400
+
+def subscriptions_request(data):
+    """Register subscriptions for POST /subscriptions; returns (payload, status_code)"""
+    api, error, status_code = resolve_account(data.get('account'))
+    if api is None:
+        return {'success': False, 'error': error}, status_code
+    installed_app_id = data.get('installed_app_id') or api.credentials.installed_app_id
+    if not installed_app_id:
+        return {'success': False, 'error': 'Set ST_INSTALLED_APP_ID (or the account\'s installed_app_id) or pass installed_app_id'}, 400
+    results = api.register_subscriptions(installed_app_id, device_registry.device_ids(api.account))
+    success = all(r['success'] for r in results)
+    return {
+        'success': success,
+        'account': api.account,
+        'installed_app_id': installed_app_id,
+        'timestamp': datetime.now().isoformat(),
+        'results': results
+    }, 200 if success else 500
+
+def discovery_payload(args):
+    """GET /devices: query the cached device listing; returns (payload, status_code)
+    
+    Filters: label (all words), room, capability (comma-separated, all
+    required), manufacturer and q (substring of label, name, room,
+    manufacturer or device ID). refresh=1 revalidates before answering;
+    account selects whose devices are listed.
+    """
+    try:
+        limit = max(1, min(int(args.get('limit', 100)), 1000))
+        offset = max(0, int(args.get('offset', 0)))
+    except ValueError:
+        return {'success': False, 'error': '"limit" and "offset" must be integers'}, 400
+    api, error, status_code = resolve_account(args.get('account'))
+    if api is None:
+        return {'success': False, 'error': error}, status_code
+    device_catalog = device_catalogs[api.account]
+    
+    started = time.perf_counter()
+    force = parse_bool(args.get('refresh'), False)
+    try:
+        cache_state = device_catalog.ensure_fresh(force=force)
+    except requests.exceptions.RequestException as e:
+        return {'success': False, 'error': f'Device discovery failed: {e}'}, 502
+    
+    capabilities = [c.strip() for c in (args.get('capability') or '').split(',') if c.strip()]
+    matches = device_catalog.query(label=args.get('label'), room=args.get('room'), capabilities=capabilities,
+                                   manufacturer=args.get('manufacturer'), text=args.get('q'))
+    targets = {}
+    for key in device_registry.targets():
+        entry = device_registry.get(key)
+        if entry.account == api.account:
+            targets.setdefault(entry.device_id, key)
+    devices = [dict(device, registry_target=targets.get(device['device_id'])) for device in matches[offset:offset + limit]]
+    catalog_stats = device_catalog.stats()
+    return {
+        'success': True,
+        'account': api.account,
+        'cache': cache_state,
+        'total': len(matches),
+        'offset': offset,
+        'limit': limit,
+        'devices': devices,
+        'query_ms': round((time.perf_counter() - started) * 1000, 2),
+        'truncated': catalog_stats['truncated'],
+        'validated_at': catalog_stats['validated_at']
+    }, 200
+
+def config_payload():
+    """Current configuration and auth status (device IDs truncated)"""
+    logger.debug(f"Config check - S95: {config.TV_DEVICE_ID_S95 or 'Not set'}, M7: {config.TV_DEVICE_ID_M7 or 'Not set'}, "
+                 f"app: {config.TV_APP_ID or 'Not set'}, PAT set: {bool(config.ST_PAT)}")
+    st_api.ensure_tokens_loaded()
+    
+    return {
+        's95_tv_device_id': config.TV_DEVICE_ID_S95[:8] + '...' if config.TV_DEVICE_ID_S95 else 'Not set',
+        'm7_monitor_device_id': config.TV_DEVICE_ID_M7[:8] + '...' if config.TV_DEVICE_ID_M7 else 'Not set',
+        'tv_app_id': config.TV_APP_ID if config.TV_APP_ID else 'Not set',
+        'auth_method': 'OAuth' if st_api.use_oauth else 'PAT',
+        'auth_configured': bool(st_api.use_oauth and st_api.refresh_token) or bool(config.ST_PAT),
+        'oauth_token_valid': st_api.access_token and not st_api.is_token_expired() if st_api.use_oauth else None,
+        'token_expires_at': datetime.fromtimestamp(st_api.token_expires_at).isoformat() if st_api.token_expires_at else None,
+        'accounts': {name: 'OAuth' if api.use_oauth else 'PAT' for name, api in sorted(accounts.apis.items())},
+        'device_registry': device_registry.summary()
+    }
+
+def route_label():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+@app.before_request
+def start_request_timer():
+    g.request_id, g.log_token = start_log_context(request.headers, route_label())
+    g.request_started = time.perf_counter()
+    HTTP_IN_FLIGHT.labels(route_label()).inc()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = route_label()
+        duration = time.perf_counter() - started
+        HTTP_REQUEST_LATENCY.labels(route, request.method).observe(duration)
+        HTTP_REQUESTS.labels(route, request.method, str(response.status_code)).inc()
+        logger.info(f"{request.method} {request.path} {response.status_code} {duration * 1000:.1f}ms",
+                    extra={'method': request.method, 'status': response.status_code, 'duration_ms': round(duration * 1000, 1)})
+    if g.get('request_id'):
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+@app.teardown_request
+def finish_request_timer(exc):
+    if g.pop('request_started', None) is not None:
+        HTTP_IN_FLIGHT.labels(route_label()).dec()
+    token = g.pop('log_token', None)
+    if token is not None:
+        log_context.reset(token)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics endpoint"""
+    body, content_type = metrics_payload()
+    return Response(body, content_type=content_type)
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Health check endpoint"""
+    payload = health_payload()
+    payload['http_pool'] = st_api.http.stats()
+    return jsonify(payload)
+
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness endpoint (liveness stays on /health)"""
+    payload, status_code = readiness_payload()
+    return jsonify(payload), status_code
+
+@app.route('/oauth/authorize', methods=['GET'])
+def oauth_authorize():
+    """Get OAuth authorization URL (manual flow for local NAS deployment)"""
+    api, error, status_code = resolve_account(request.args.get('account'))
+    if api is None:
+        return jsonify({
+            'success': False,
+            'error': error
+        }), status_code
+    if not api.credentials.client_id:
+        return jsonify({
+            'success': False,
+            'error': 'OAuth client ID not configured'
+        }), 500
+    
+    logger.info(f"Authorization URL requested (account {api.account})")
+    
+    # Return JSON with instructions for manual OAuth flow
+    return jsonify(authorization_payload(api))
 
 @app.route('/oauth/token', methods=['POST'])
 def oauth_token_exchange():
@@ -387,33 +1017,17 @@ def oauth_token_exchange():
                 'error': 'Authorization code is required in request body: {"code": "your-code"}'
             }), 400
         
-        logger.info("Exchanging authorization code for tokens...")
-        
-        # Exchange code for tokens
-        token_url = "https://api.smartthings.com/oauth/token"
-        token_data = {
-            'grant_type': 'authorization_code',
-            'code': code,
-            'redirect_uri': config.OAUTH_REDIRECT_URI
-        }
-        
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
+        api, error, status_code = resolve_account(data.get('account'))
+        if api is None:
+            return jsonify({
+                'success': False,
+                'error': error
+            }), status_code
         
-        auth = None
-        if config.ST_CLIENT_SECRET:
-            auth = (config.ST_CLIENT_ID, config.ST_CLIENT_SECRET)
-        else:
-            token_data['client_id'] = config.ST_CLIENT_ID
+        logger.info(f"Exchanging authorization code for tokens (account {api.account})...")
         
-        response = requests.post(
-            token_url,
-            data=token_data,
-            headers=headers,
-            auth=auth,
-            timeout=10
-        )
+        # Exchange code for tokens
+        response = api.http.post(config.ST_OAUTH_TOKEN_URL, call='token_exchange', **code_exchange_request(code, api.credentials))
         
         if response.status_code != 200:
             logger.error(f"Token exchange failed: {response.status_code}")
@@ -424,27 +1038,16 @@ def oauth_token_exchange():
             }), 400
         
         token_response = response.json()
-        
-        # Update API client with new tokens
-        st_api.access_token = token_response.get('access_token')
-        st_api.refresh_token = token_response.get('refresh_token')
-        
-        expires_in = token_response.get('expires_in', 86400)
-        st_api.token_expires_at = datetime.now().timestamp() + expires_in
-        
-        # Enable OAuth mode now that we have tokens
-        st_api.use_oauth = True
-        
-        # Save tokens
-        st_api._save_tokens()
+        expires_in = api.store_exchanged_tokens(token_response)
         
         logger.info("OAuth authorization successful! Tokens saved.")
         
         return jsonify({
             'success': True,
             'message': 'OAuth authorization successful! Tokens saved.',
+            'account': api.account,
             'expires_in': expires_in,
-            'expires_at': datetime.fromtimestamp(st_api.token_expires_at).isoformat()
+            'expires_at': datetime.fromtimestamp(api.token_expires_at).isoformat()
         })
         
     except Exception as e:
@@ -452,88 +1055,206 @@ def oauth_token_exchange():
         return jsonify({
             'success': False,
             'error': str(e)
-        }), 500
+        }), error_status(e)
+
+@app.route('/oauth/refresh-status', methods=['GET'])
+def oauth_refresh_status():
+    """Background token refresh schedule and recent refresh outcomes"""
+    api, error, status_code = resolve_account(request.args.get('account'))
+    if api is None:
+        return jsonify({
+            'success': False,
+            'error': error
+        }), status_code
+    return jsonify(refresh_status_payload(api))
 
 @app.route('/launch-tv-app', methods=['POST'])
 def launch_tv_app():
     """Launch TV app endpoint - called by Edge Driver"""
     try:
         data = request.get_json(silent=True) or {}
-        # Determine which device to use based on target_device parameter
-        target_device = data.get('target_device') or data.get('target') or 's95'  # Default to S95 TV
+        # Resolve target_device / action / app_id against the device registry
+        plan, error, status_code = plan_launch(data, request.headers)
+        if plan is None:
+            return jsonify({
+                'success': False,
+                'error': error
+            }), status_code
+        minimal = wants_minimal_ack(data, request.args, request.headers)
         
-        if target_device == 'm7':
-            device_id = config.TV_DEVICE_ID_M7
-            device_name = "M7 Monitor"
-        else:
-            device_id = config.TV_DEVICE_ID_S95
-            device_name = "S95 TV"
+        # Fire-and-forget: answer 202 right away and launch from the job queue
+        if wants_async_launch(data, request.args, request.headers):
+            payload, status_code, location = accept_launch_job(plan, minimal)
+            response = jsonify(payload)
+            if location:
+                response.headers['Location'] = location
+            return response, status_code
+        
+        # Authentication check is now handled in get_headers()
+        # which will automatically refresh token if needed
         
-        logger.info(f"Target device: {device_name} ({target_device})")
+        # Launch the app (identical requests in the dedup window share one upstream call)
+        success, result, dedup_state = launch_with_dedup(plan)
         
-        # Validate configuration
-        if not device_id:
+        payload, status_code = launch_payload(plan, success, result, dedup_state, minimal)
+        return jsonify(payload), status_code
+    except Exception as e:
+        logger.exception("Unexpected error while launching TV app")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), error_status(e)
+
+@app.route('/launch-batch', methods=['POST'])
+def launch_batch():
+    """Launch apps on many devices concurrently (scene requests from the hub)"""
+    try:
+        data = request.get_json(silent=True)
+        if not data:
             return jsonify({
                 'success': False,
-                'error': f'Device ID not configured for {device_name}'
-            }), 500
+                'error': 'Request body must be JSON'
+            }), 400
         
-        if not config.TV_APP_ID:
+        batch, error, status_code = plan_batch(data)
+        if batch is None:
             return jsonify({
                 'success': False,
-                'error': 'TV_APP_ID not configured'
-            }), 500
+                'error': error
+            }), status_code
         
-        # Authentication check is now handled in get_headers()
-        # which will automatically refresh token if needed
+        payload, status_code = run_batch(batch)
+        logger.info(f"Batch launch: {payload['launched']}/{payload['total']} launched in {payload['duration_ms']} ms")
+        return jsonify(payload), status_code
+    except Exception as e:
+        logger.exception("Unexpected error during batch launch")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), error_status(e)
+
+@app.route('/commands', methods=['POST'])
+def device_commands():
+    """Send ordered capability commands to one or more devices, merged per device"""
+    try:
+        data = request.get_json(silent=True)
+        if not data:
+            return jsonify({
+                'success': False,
+                'error': 'Request body must be JSON'
+            }), 400
         
-        # Launch the app
-        success, result = st_api.launch_app(device_id, config.TV_APP_ID)
+        plan, error, status_code = plan_commands(data)
+        if plan is None:
+            return jsonify({
+                'success': False,
+                'error': error
+            }), status_code
         
-        if success:
+        payload, status_code = run_commands(plan)
+        logger.info(f"Commands: {payload['steps']} steps on {payload['devices']} device(s) in {payload['upstream_requests']} request(s)")
+        return jsonify(payload), status_code
+    except Exception as e:
+        logger.exception("Unexpected error while sending commands")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), error_status(e)
+
+@app.route('/smartthings/webhook', methods=['POST'])
+def smartthings_webhook():
+    """SmartThings webhook SmartApp lifecycle calls (subscription events feed the state mirror)"""
+    error, status_code = webhook_rejection(request.args.get('token'))
+    if error:
+        return jsonify({
+            'success': False,
+            'error': error
+        }), status_code
+    # Each account's SmartApp installation points at ?account=<name>
+    api, error, status_code = resolve_account(request.args.get('account'))
+    if api is None:
+        return jsonify({
+            'success': False,
+            'error': error
+        }), status_code
+    try:
+        data = request.get_json(silent=True)
+        if not data:
             return jsonify({
-                'success': True,
-                'message': f'TV app launched successfully on {device_name}',
-                'device': device_name,
-                'timestamp': datetime.now().isoformat(),
-                'result': result
-            })
+                'success': False,
+                'error': 'Request body must be JSON'
+            }), 400
         
+        payload, status_code = handle_lifecycle(data, api)
+        return jsonify(payload), status_code
+    except Exception as e:
+        logger.exception("Unexpected error in webhook lifecycle")
         return jsonify({
             'success': False,
-            'error': result
-        }), 500
+            'error': str(e)
+        }), error_status(e)
+
+@app.route('/subscriptions', methods=['POST'])
+def register_subscriptions():
+    """Subscribe the installed SmartApp to every registry device of an account"""
+    try:
+        payload, status_code = subscriptions_request(request.get_json(silent=True) or {})
+        return jsonify(payload), status_code
     except Exception as e:
-        logger.exception("Unexpected error while launching TV app")
+        logger.exception("Failed to register subscriptions")
         return jsonify({
             'success': False,
             'error': str(e)
-        }), 500
+        }), error_status(e)
+
+@app.route('/devices', methods=['GET'])
+def discover_devices():
+    """Search the account's devices (cached listing with label/room/capability/manufacturer indexes)"""
+    try:
+        payload, status_code = discovery_payload(request.args)
+        return jsonify(payload), status_code
+    except Exception as e:
+        logger.exception("Unexpected error in device discovery")
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), error_status(e)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Status of a fire-and-forget launch"""
+    job = launch_jobs.get(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'error': f'Unknown job {job_id}'
+        }), 404
+    return jsonify({
+        'success': True,
+        'job': job
+    })
 
 @app.route('/device-status', methods=['GET'])
 def device_status():
     """Get TV device status"""
     try:
-        target = request.args.get('target', 's95')
-        if target == 'm7':
-            device_id = config.TV_DEVICE_ID_M7
-            device_name = "M7 Monitor"
-        else:
-            device_id = config.TV_DEVICE_ID_S95
-            device_name = "S95 TV"
-        
-        if not device_id:
+        entry, error, status_code = resolve_target(request.args.get('target'))
+        if entry is None:
             return jsonify({
                 'success': False,
-                'error': f'Device ID not configured for {device_name}'
-            }), 500
+                'error': error
+            }), status_code
         
-        status = st_api.get_device_status(device_id)
+        # ?refresh=1 bypasses the cache
+        use_cache = not parse_bool(request.args.get('refresh'), False)
+        status, cache_state = accounts.api_for(entry.account).lookup_device_status(
+            entry.device_id, use_cache=use_cache, ttl=entry.status_cache_ttl)
         
         if status:
             return jsonify({
                 'success': True,
-                'device': device_name,
+                'device': entry.name,
+                'cache': cache_state,
                 'status': status
             })
         
@@ -546,25 +1267,12 @@ def device_status():
         return jsonify({
             'success': False,
             'error': str(e)
-        }), 500
+        }), error_status(e)
 
 @app.route('/config', methods=['GET'])
 def get_config():
     """Get current configuration (for debugging)"""
-    logger.info(f"Config check - S95 TV device ID: {config.TV_DEVICE_ID_S95}")
-    logger.info(f"Config check - M7 Monitor device ID: {config.TV_DEVICE_ID_M7}")
-    logger.info(f"Config check - TV_APP_ID from config object: {config.TV_APP_ID}")
-    logger.info(f"Config check - ST_PAT from config object: {config.ST_PAT[:8] if config.ST_PAT else 'Not set'}...")
-    
-    return jsonify({
-        's95_tv_device_id': config.TV_DEVICE_ID_S95[:8] + '...' if config.TV_DEVICE_ID_S95 else 'Not set',
-        'm7_monitor_device_id': config.TV_DEVICE_ID_M7[:8] + '...' if config.TV_DEVICE_ID_M7 else 'Not set',
-        'tv_app_id': config.TV_APP_ID if config.TV_APP_ID else 'Not set',
-        'auth_method': 'OAuth' if st_api.use_oauth else 'PAT',
-        'auth_configured': bool(st_api.use_oauth and st_api.refresh_token) or bool(config.ST_PAT),
-        'oauth_token_valid': st_api.access_token and not st_api.is_token_expired() if st_api.use_oauth else None,
-        'token_expires_at': datetime.fromtimestamp(st_api.token_expires_at).isoformat() if st_api.token_expires_at else None
-    })
+    return jsonify(config_payload())
 
 if __name__ == '__main__':
     logger.info("=" * 60)
@@ -575,8 +1283,11 @@ if __name__ == '__main__':
     logger.info(f"S95 TV Device ID: {config.TV_DEVICE_ID_S95[:8] + '...' if config.TV_DEVICE_ID_S95 else 'NOT SET'}")
     logger.info(f"M7 Monitor Device ID: {config.TV_DEVICE_ID_M7[:8] + '...' if config.TV_DEVICE_ID_M7 else 'NOT SET'}")
     logger.info(f"TV App ID: {config.TV_APP_ID if config.TV_APP_ID else 'NOT SET'}")
+    logger.info(f"Device registry: {', '.join(device_registry.targets()) or 'EMPTY'} (from {device_registry.source})")
     logger.info(f"Auth Method: {'OAuth' if st_api.use_oauth else 'PAT'}")
-    logger.info(f"Auth Configured: {bool(config.ST_PAT or st_api.access_token)}")
+    logger.info(f"Auth Configured: {bool(config.ST_PAT or st_api.use_oauth)}")
+    logger.info(f"Accounts: {', '.join(accounts.names())}")
     logger.info("=" * 60)
     
+    start_services()
     app.run(host=config.HOST, port=config.PORT, debug=False)
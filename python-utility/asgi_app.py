@@ -0,0 +1,840 @@
+"""
+TV App Launcher Utility - async (ASGI) serving mode
+Serves the same routes as app.py with Starlette and an async SmartThings client,
+so a single worker can keep hundreds of upstream calls in flight.
+
+Run with:
+    gunicorn --bind 0.0.0.0:5000 --workers 1 -k uvicorn.workers.UvicornWorker asgi_app:app
+"""
+
+import asyncio
+import contextlib
+import sqlite3
+import time
+from datetime import datetime
+
+import httpcore
+import httpx
+from starlette.applications import Starlette
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Match, Route
+
+# Configuration, token management and the status cache are shared with the
+# synchronous app (app.py and its subsystem modules); only the outbound HTTP
+# path is async here.
+from settings import config, parse_bool
+from logs import log_context, start_log_context, current_request_id
+from resilience import error_status, UpstreamUnavailable, upstream_guard
+from credentials import DEFAULT_ACCOUNT
+from metrics import (
+    device_label,
+    observe_operation,
+    observe_transport,
+    metrics_payload,
+    HTTP_REQUESTS,
+    HTTP_REQUEST_LATENCY,
+    HTTP_IN_FLIGHT,
+    UPSTREAM_LATENCY,
+)
+from dns_cache import dns_cache
+from journal import replayable_error, replay_retry_after, launch_queued
+from app import (
+    logger,
+    start_services,
+    accounts,
+    resolve_target,
+    resolve_account,
+    plan_launch,
+    plan_batch,
+    batch_result,
+    summarize_batch,
+    plan_commands,
+    check_command_group,
+    command_group_result,
+    summarize_commands,
+    wants_async_launch,
+    wants_minimal_ack,
+    accept_launch_job,
+    launch_payload,
+    launch_jobs,
+    launch_dedup,
+    launch_dedup_key,
+    smart_launch_payload,
+    health_payload,
+    readiness_payload,
+    authorization_payload,
+    code_exchange_request,
+    refresh_status_payload,
+    config_payload,
+    webhook_rejection,
+    handle_lifecycle,
+    subscriptions_request,
+    discovery_payload,
+)
+
+
+class CachedDNSBackend(httpcore.AsyncNetworkBackend):
+    """httpcore network backend that connects to the DNSCache addresses of the SmartThings hosts
+    
+    The async twin of dns_cache.CachedDNSAdapter: TLS still verifies the hostname,
+    and other hosts go straight to the wrapped backend.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        if not dns_cache.caches(host):
+            return await self.backend.connect_tcp(host, port, timeout, local_address, socket_options)
+        try:
+            # A miss resolves synchronously, so keep it off the event loop
+            addresses = await asyncio.to_thread(dns_cache.addresses, host, port)
+        except OSError as e:
+            raise httpcore.ConnectError(str(e)) from e
+        error = None
+        for address in addresses:
+            try:
+                return await self.backend.connect_tcp(address, port, timeout, local_address, socket_options)
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                error = e
+        raise error
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self.backend.connect_unix_socket(path, timeout, socket_options)
+
+    async def sleep(self, seconds):
+        await self.backend.sleep(seconds)
+
+
+def cached_dns_transport(**kwargs):
+    """AsyncHTTPTransport whose connections resolve through dns_cache
+    
+    httpx has no public hook for the network backend, so this sets the
+    private one of its httpcore pool; requirements.txt pins both packages
+    for that reason. If an upgrade moves it, the transport is returned
+    unchanged and the async client resolves DNS on every new connection.
+    """
+    transport = httpx.AsyncHTTPTransport(**kwargs)
+    pool = getattr(transport, '_pool', None)
+    if not isinstance(pool, httpcore.AsyncConnectionPool) or not hasattr(pool, '_network_backend'):
+        logger.warning("httpx transport has no httpcore network backend to wrap, async DNS cache disabled")
+        return transport
+    pool._network_backend = CachedDNSBackend(pool._network_backend)
+    return transport
+
+
+class AsyncSmartThingsAPI:
+    """Async SmartThings client that reuses the token state of a SmartThingsAPI"""
+
+    def __init__(self, api):
+        self.api = api
+        self._client = None
+        self.in_flight = 0
+        self.requests_sent = 0
+        self.errors = 0
+        self.warm_rounds = 0
+
+    @property
+    def client(self):
+        """Pooled keep-alive client, created on first use inside the event loop"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=config.ASYNC_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=config.ASYNC_HTTP_MAX_KEEPALIVE
+                ),
+                timeout=httpx.Timeout(config.HTTP_READ_TIMEOUT, connect=config.HTTP_CONNECT_TIMEOUT),
+                # httpx transport retries cover connect errors only, so commands are never re-sent
+                transport=cached_dns_transport(retries=config.HTTP_RETRIES)
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def request(self, method, url, call='other', device='none', **kwargs):
+        request_id = current_request_id()
+        if request_id:
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **{'X-Request-ID': request_id})
+        # Same per-endpoint circuit breaker and rate limiter as the sync client
+        delay = upstream_guard.before(call)
+        if delay:
+            await asyncio.sleep(delay)
+        self.in_flight += 1
+        self.requests_sent += 1
+        started = time.perf_counter()
+        status = 'error'
+        response = None
+        try:
+            response = await self.client.request(method, url, **kwargs)
+            status = str(response.status_code)
+            return response
+        except httpx.HTTPError:
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            UPSTREAM_LATENCY.labels(call, device, status).observe(time.perf_counter() - started)
+            if response is not None:
+                upstream_guard.after(call, response.status_code, response.headers)
+            else:
+                upstream_guard.after(call)
+
+    async def get_headers(self):
+        """Auth headers, built off the event loop
+        
+        api.get_headers() stats and may re-read the token file, and near expiry
+        (without a running refresher) refreshes the token over blocking HTTP
+        under the cross-worker lock.
+        """
+        return await asyncio.to_thread(self.api.get_headers)
+
+    async def launch_app(self, device_id, app_id, payload=None, replay_deadline=None):
+        """Launch app on Samsung TV - sends power on + app launch commands"""
+        started = time.perf_counter()
+        if payload is None:
+            payload = self.api.build_launch_payload(app_id)
+
+        # LAN control blocks (Wake-on-LAN polling), so it runs off the event loop
+        if await asyncio.to_thread(self.api.local.device_entry, device_id) is not None:
+            local = await asyncio.to_thread(self.api.launch_locally, device_id, app_id, payload, started)
+            if local is not None:
+                return local
+
+        cloud_started = time.perf_counter()
+        success, result = await self._launch_app(device_id, app_id, payload, replay_deadline)
+        observe_transport('cloud', device_id, success, cloud_started)
+        observe_operation('launch_app', device_id, 'success' if success else 'failure', started)
+        return success, result
+
+    async def _post_commands(self, device_id, payload):
+        """POST a command batch to a device, refreshing the token once on 401; returns the response JSON"""
+        url = f"{config.ST_API_BASE_URL}/devices/{device_id}/commands"
+        device = device_label(device_id)
+        response = await self.request('POST', url, call='device_command', device=device,
+                                      json=payload, headers=await self.get_headers())
+
+        # If unauthorized and using OAuth, try refreshing token
+        if response.status_code == 401 and self.api.use_oauth:
+            logger.info("Token expired (401), attempting to refresh")
+            if await asyncio.to_thread(self.api.refresh_oauth_token, 'unauthorized'):
+                response = await self.request('POST', url, call='device_command', device=device,
+                                              json=payload, headers=await self.get_headers())
+
+        response.raise_for_status()
+        return response.json()
+
+    async def _deliver(self, device_id, payload, source, replay_deadline=None):
+        """Async counterpart of SmartThingsAPI._deliver; journal writes run off the event loop"""
+        journal = self.api.journal
+        replay_deadline = config.COMMAND_REPLAY_DEADLINE if replay_deadline is None else float(replay_deadline)
+        entry_id = None
+        if journal is not None:
+            try:
+                entry_id, queued = await asyncio.to_thread(journal.record, device_id, payload, source, replay_deadline)
+            except sqlite3.Error as e:
+                logger.error(f"Command journal unavailable, sending without it: {e}")
+                queued = False
+            if queued:
+                self.api.replayer.wake()
+                return await asyncio.to_thread(journal.queued_result, entry_id, 'Queued behind earlier commands waiting for replay')
+        if entry_id is None:
+            return await self._post_commands(device_id, payload)
+
+        try:
+            result = await self._post_commands(device_id, payload)
+        except (httpx.HTTPError, UpstreamUnavailable) as e:
+            if replay_deadline > 0 and (replayable_error(e) or isinstance(e, httpx.TransportError)):
+                if await asyncio.to_thread(journal.defer, [entry_id], str(e), replay_retry_after(e)):
+                    logger.warning(f"Command to {device_label(device_id)} failed ({e}), queued for replay")
+                    self.api.replayer.wake()
+                    return await asyncio.to_thread(journal.queued_result, entry_id, str(e))
+            else:
+                await asyncio.to_thread(journal.finish, [entry_id], 'failed', str(e))
+            raise
+        except Exception as e:
+            # No token, token lock timeout, ...: never leave the entry for the replayer
+            await asyncio.to_thread(journal.finish, [entry_id], 'failed', str(e))
+            raise
+        await asyncio.to_thread(journal.finish, [entry_id], 'sent')
+        return result
+
+    async def _launch_app(self, device_id, app_id, payload, replay_deadline=None):
+        if payload is None:
+            payload = self.api.build_launch_payload(app_id)
+
+        try:
+            result = await self._deliver(device_id, payload, 'launch', replay_deadline)
+            if result.get('queued'):
+                logger.info(f"Launch of app {app_id} on device {device_id} queued for replay")
+            else:
+                logger.info(f"Successfully launched app {app_id} on device {device_id}")
+            return True, result
+
+        except (httpx.HTTPError, UpstreamUnavailable) as e:
+            logger.error(f"Failed to launch app: {e}")
+            if isinstance(e, httpx.HTTPStatusError):
+                logger.error(f"Response: {e.response.text}")
+            return False, str(e)
+        finally:
+            await asyncio.to_thread(self.api.state_changed, device_id)
+
+    async def send_commands(self, device_id, commands, replay_deadline=None):
+        """Send one merged command batch (from /commands) to a device; returns (success, result)"""
+        started = time.perf_counter()
+        try:
+            result = await self._deliver(device_id, {'commands': commands}, 'commands', replay_deadline)
+            success = True
+        except (httpx.HTTPError, UpstreamUnavailable) as e:
+            logger.error(f"Failed to send commands: {e}")
+            if isinstance(e, httpx.HTTPStatusError):
+                logger.error(f"Response: {e.response.text}")
+            success, result = False, str(e)
+        finally:
+            await asyncio.to_thread(self.api.state_changed, device_id)
+        observe_operation('send_commands', device_id, 'success' if success else 'failure', started)
+        return success, result
+
+    async def get_device_capabilities(self, device_id):
+        """Device capabilities from the shared capability cache; returns (capabilities, cache_state)"""
+        return await self.api.capability_cache.aget(device_id, self._fetch_device_capabilities)
+
+    async def _fetch_device_capabilities(self, device_id):
+        url = f"{config.ST_API_BASE_URL}/devices/{device_id}"
+        try:
+            response = await self.request('GET', url, call='device_description', device=device_label(device_id),
+                                          headers=await self.get_headers())
+            response.raise_for_status()
+            return self.api.parse_capabilities(response.json())
+        except (httpx.HTTPError, UpstreamUnavailable) as e:
+            logger.error(f"Failed to get device capabilities: {e}")
+            return None
+
+    async def lookup_device_status(self, device_id, use_cache=True, ttl=None):
+        """Get device status along with its cache state"""
+        started = time.perf_counter()
+        if use_cache:
+            # Mirror snapshots are read from the shared files
+            status, _ = await asyncio.to_thread(self.api.mirror.snapshot, device_id)
+            if status is not None:
+                observe_operation('get_device_status', device_id, 'mirror', started)
+                return status, 'mirror'
+        if not use_cache:
+            status, cache_state = await self._fetch_device_status(device_id), 'bypass'
+        else:
+            status, cache_state = await self.api.status_cache.aget(device_id, self._fetch_device_status, ttl=ttl)
+        observe_operation('get_device_status', device_id, cache_state if status is not None else 'failure', started)
+        return status, cache_state
+
+    async def _fetch_device_status(self, device_id):
+        url = f"{config.ST_API_BASE_URL}/devices/{device_id}/status"
+        fetched_at = time.time()
+        try:
+            response = await self.request('GET', url, call='device_status', device=device_label(device_id),
+                                          headers=await self.get_headers())
+            response.raise_for_status()
+            status = response.json()
+            if config.STATE_MIRROR:
+                await asyncio.to_thread(self.api.mirror.resync, device_id, status, fetched_at)
+            return status
+        except (httpx.HTTPError, UpstreamUnavailable) as e:
+            logger.error(f"Failed to get device status: {e}")
+            return None
+
+    async def warm(self):
+        """Touch KEEP_WARM_CONNECTIONS pooled connections concurrently (see UpstreamWarmer)"""
+        count = max(1, config.KEEP_WARM_CONNECTIONS)
+        results = await asyncio.gather(
+            *(self.request('HEAD', f"{config.ST_API_BASE_URL}/", call='keep_warm') for _ in range(count)),
+            return_exceptions=True
+        )
+        errors = [result for result in results if isinstance(result, Exception)]
+        self.warm_rounds += 1
+        if errors:
+            logger.warning(f"Keep-warm ping failed: {errors[0]}")
+
+    async def keep_warm(self):
+        """Pre-connect on startup, then keep the pool warm every KEEP_WARM_INTERVAL seconds"""
+        while True:
+            try:
+                await self.warm()
+            except Exception:
+                logger.exception("Unexpected error in upstream keep-warm")
+            await asyncio.sleep(config.KEEP_WARM_INTERVAL)
+
+    def stats(self):
+        return {
+            'requests': self.requests_sent,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'keep_warm_rounds': self.warm_rounds,
+            'max_connections': config.ASYNC_HTTP_MAX_CONNECTIONS,
+            'max_keepalive_connections': config.ASYNC_HTTP_MAX_KEEPALIVE
+        }
+
+
+# One httpx pool per account, wrapping that account's SmartThingsAPI
+async_apis = {name: AsyncSmartThingsAPI(api) for name, api in accounts.apis.items()}
+async_api = async_apis[DEFAULT_ACCOUNT]
+
+
+def async_api_for(account):
+    """Async client of an account; raises KeyError for accounts that are not configured"""
+    return async_apis[accounts.api_for(account).account]
+
+
+async def launch_with_dedup(plan):
+    """Async counterpart of app.launch_with_dedup (deduplicates within this worker)"""
+    states = []
+
+    async def launch():
+        api = async_api_for(plan.get('account'))
+        if not plan.get('smart'):
+            return await api.launch_app(plan['device_id'], plan['app_id'], plan['payload'], plan.get('replay_deadline'))
+        # Reads the mirror files and the status cache
+        payload, report = await asyncio.to_thread(smart_launch_payload, plan)
+        if payload is None:
+            logger.info(f"Smart launch: {plan['device_name']} already in the requested state, nothing sent")
+            return True, dict(report, response=None)
+        success, result = await api.launch_app(plan['device_id'], plan['app_id'], payload, plan.get('replay_deadline'))
+        return success, dict(report, response=result) if success else result
+
+    async def deduplicated():
+        success, result, state = await launch_dedup.arun(launch_dedup_key(plan), config.LAUNCH_DEDUP_WINDOW, launch)
+        states.append(state)
+        return success, result
+
+    if plan.get('idempotency_key'):
+        success, result, state = await launch_dedup.arun(f"idem:{plan['idempotency_key']}", config.IDEMPOTENCY_TTL, deduplicated)
+    else:
+        success, result = await deduplicated()
+        state = None
+    return success, result, state or (states[0] if states else None)
+
+# Bounds the upstream fan-out of all batch requests in this worker
+batch_semaphore = None
+# Launches that outlived their batch deadline; kept referenced until they finish
+background_launches = set()
+
+
+async def run_batch(batch):
+    """Launch every planned item concurrently within the batch deadline"""
+    global batch_semaphore
+    if batch_semaphore is None:
+        batch_semaphore = asyncio.Semaphore(config.BATCH_MAX_WORKERS)
+
+    started = time.monotonic()
+    results = []
+    tasks = {}
+    state = {'aborted': False}
+    started_items = set()
+
+    async def launch(item):
+        async with batch_semaphore:
+            if state['aborted']:
+                return batch_result(item, 'cancelled', error='Skipped after an earlier failure')
+            started_items.add(item['index'])
+            t0 = time.monotonic()
+            success, result, dedup_state = await launch_with_dedup(item['plan'])
+            duration_ms = round((time.monotonic() - t0) * 1000, 1)
+            if success:
+                status = 'deferred' if launch_queued(result) else 'launched'
+                return batch_result(item, status, True, result=result, duration_ms=duration_ms, deduplicated=dedup_state)
+            if batch['fail_fast']:
+                state['aborted'] = True
+            return batch_result(item, 'failed', error=result, duration_ms=duration_ms)
+
+    for item in batch['items']:
+        if item['plan'] is None:
+            results.append(batch_result(item, 'invalid', error=item['error']))
+        else:
+            tasks[asyncio.create_task(launch(item))] = item
+
+    if tasks:
+        done, pending = await asyncio.wait(tasks, timeout=batch['deadline'])
+        for task in done:
+            try:
+                results.append(task.result())
+            except Exception as e:
+                logger.exception("Unexpected error in batch launch")
+                results.append(batch_result(tasks[task], 'failed', error=str(e)))
+        for task in pending:
+            item = tasks[task]
+            if item['index'] in started_items:
+                # Already sent upstream: let it finish in the background
+                background_launches.add(task)
+                task.add_done_callback(background_launches.discard)
+                results.append(batch_result(item, 'timeout', error='Batch deadline reached'))
+            else:
+                task.cancel()
+                results.append(batch_result(item, 'cancelled', error='Batch deadline reached before launch started'))
+
+    return summarize_batch(batch, results, started)
+
+
+def error_response(message, status_code):
+    return JSONResponse({'success': False, 'error': message}, status_code=status_code)
+
+
+async def read_json(request):
+    """Parse a JSON body, returning None when it is missing or invalid"""
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def metrics(request):
+    """Prometheus metrics endpoint"""
+    body, content_type = metrics_payload()
+    return Response(body, headers={'Content-Type': content_type})
+
+
+async def health_check(request):
+    """Health check endpoint"""
+    # Journal, job and mirror stats read sqlite and the shared state files
+    payload = await asyncio.to_thread(health_payload)
+    payload['serving_mode'] = 'asgi'
+    payload['http_pool'] = async_api.stats()
+    for name, api in async_apis.items():
+        payload['accounts'][name]['async_http_pool'] = api.stats()
+    return JSONResponse(payload)
+
+
+async def readiness_check(request):
+    """Readiness endpoint (liveness stays on /health)"""
+    payload, status_code = await asyncio.to_thread(readiness_payload)
+    payload['serving_mode'] = 'asgi'
+    return JSONResponse(payload, status_code=status_code)
+
+
+async def oauth_authorize(request):
+    """Get OAuth authorization URL (manual flow for local NAS deployment)"""
+    api, error, status_code = resolve_account(request.query_params.get('account'))
+    if api is None:
+        return error_response(error, status_code)
+    if not api.credentials.client_id:
+        return error_response('OAuth client ID not configured', 500)
+    logger.info(f"Authorization URL requested (account {api.account})")
+    return JSONResponse(await asyncio.to_thread(authorization_payload, api))
+
+
+async def oauth_token_exchange(request):
+    """Exchange authorization code for tokens (manual flow)"""
+    try:
+        data = await read_json(request)
+        if not data:
+            return error_response('Request body must be JSON', 400)
+
+        code = data.get('code')
+        if not code:
+            return error_response('Authorization code is required in request body: {"code": "your-code"}', 400)
+
+        api, error, status_code = resolve_account(data.get('account'))
+        if api is None:
+            return error_response(error, status_code)
+
+        logger.info(f"Exchanging authorization code for tokens (account {api.account})...")
+        response = await async_apis[api.account].request('POST', config.ST_OAUTH_TOKEN_URL, call='token_exchange',
+                                                         **code_exchange_request(code, api.credentials))
+
+        if response.status_code != 200:
+            logger.error(f"Token exchange failed: {response.status_code}")
+            logger.error(f"Response: {response.text}")
+            return error_response(f'Token exchange failed: {response.text}', 400)
+
+        # Saving takes the cross-worker file lock, so keep it off the event loop
+        expires_in = await asyncio.to_thread(api.store_exchanged_tokens, response.json())
+        logger.info("OAuth authorization successful! Tokens saved.")
+
+        return JSONResponse({
+            'success': True,
+            'message': 'OAuth authorization successful! Tokens saved.',
+            'account': api.account,
+            'expires_in': expires_in,
+            'expires_at': datetime.fromtimestamp(api.token_expires_at).isoformat()
+        })
+    except Exception as e:
+        logger.exception("Failed to exchange authorization code for tokens")
+        return error_response(str(e), error_status(e))
+
+
+async def oauth_refresh_status(request):
+    """Background token refresh schedule and recent refresh outcomes"""
+    api, error, status_code = resolve_account(request.query_params.get('account'))
+    if api is None:
+        return error_response(error, status_code)
+    return JSONResponse(await asyncio.to_thread(refresh_status_payload, api))
+
+
+async def launch_tv_app(request):
+    """Launch TV app endpoint - called by Edge Driver"""
+    try:
+        data = await read_json(request) or {}
+        # Target lookup may reload the registry file
+        plan, error, status_code = await asyncio.to_thread(plan_launch, data, request.headers)
+        if plan is None:
+            return error_response(error, status_code)
+        minimal = wants_minimal_ack(data, request.query_params, request.headers)
+
+        # Fire-and-forget: answer 202 right away and launch from the job queue
+        if wants_async_launch(data, request.query_params, request.headers):
+            # The job record is written to JOB_STATE_DIR
+            payload, status_code, location = await asyncio.to_thread(accept_launch_job, plan, minimal)
+            headers = {'Location': location} if location else None
+            return JSONResponse(payload, status_code=status_code, headers=headers)
+
+        success, result, dedup_state = await launch_with_dedup(plan)
+
+        payload, status_code = launch_payload(plan, success, result, dedup_state, minimal)
+        return JSONResponse(payload, status_code=status_code)
+    except Exception as e:
+        logger.exception("Unexpected error while launching TV app")
+        return error_response(str(e), error_status(e))
+
+
+async def launch_batch(request):
+    """Launch apps on many devices concurrently (scene requests from the hub)"""
+    try:
+        data = await read_json(request)
+        if not data:
+            return error_response('Request body must be JSON', 400)
+
+        batch, error, status_code = await asyncio.to_thread(plan_batch, data)
+        if batch is None:
+            return error_response(error, status_code)
+
+        payload, status_code = await run_batch(batch)
+        logger.info(f"Batch launch: {payload['launched']}/{payload['total']} launched in {payload['duration_ms']} ms")
+        return JSONResponse(payload, status_code=status_code)
+    except Exception as e:
+        logger.exception("Unexpected error during batch launch")
+        return error_response(str(e), error_status(e))
+
+
+async def run_command_group(group, validate, dry_run, replay_deadline=None):
+    """Validate one device's commands against its cached capabilities, then send its batches in order"""
+    api = async_api_for(group['account'])
+    capabilities = cache_state = None
+    if validate:
+        capabilities, cache_state = await api.get_device_capabilities(group['device_id'])
+    skipped = check_command_group(group, capabilities, cache_state, dry_run)
+    if skipped is not None:
+        return skipped
+
+    responses = []
+    for batch in group['batches']:
+        success, response = await api.send_commands(group['device_id'], batch, replay_deadline)
+        if not success:
+            return command_group_result(group, 'failed', False, requests=len(responses) + 1,
+                                        validated=capabilities is not None, error=response, results=responses)
+        responses.append(response)
+    status = 'deferred' if any(launch_queued(r) for r in responses) else 'sent'
+    return command_group_result(group, status, True, requests=len(responses),
+                                validated=capabilities is not None, results=responses)
+
+
+async def device_commands(request):
+    """Send ordered capability commands to one or more devices, merged per device"""
+    try:
+        data = await read_json(request)
+        if not data:
+            return error_response('Request body must be JSON', 400)
+
+        plan, error, status_code = await asyncio.to_thread(plan_commands, data)
+        if plan is None:
+            return error_response(error, status_code)
+
+        started = time.monotonic()
+        outcomes = await asyncio.gather(
+            *(run_command_group(group, plan['validate'], plan['dry_run'], plan['replay_deadline'])
+              for group in plan['groups']),
+            return_exceptions=True
+        )
+        results = []
+        for group, outcome in zip(plan['groups'], outcomes):
+            if isinstance(outcome, Exception):
+                logger.error(f"Unexpected error in command pipeline: {outcome}")
+                outcome = command_group_result(group, 'failed', False, requests=0, error=str(outcome))
+            results.append(outcome)
+        payload, status_code = summarize_commands(plan, results, started)
+        logger.info(f"Commands: {payload['steps']} steps on {payload['devices']} device(s) in {payload['upstream_requests']} request(s)")
+        return JSONResponse(payload, status_code=status_code)
+    except Exception as e:
+        logger.exception("Unexpected error while sending commands")
+        return error_response(str(e), error_status(e))
+
+
+async def smartthings_webhook(request):
+    """SmartThings webhook SmartApp lifecycle calls (subscription events feed the state mirror)"""
+    error, status_code = webhook_rejection(request.query_params.get('token'))
+    if error:
+        return error_response(error, status_code)
+    # Each account's SmartApp installation points at ?account=<name>
+    api, error, status_code = resolve_account(request.query_params.get('account'))
+    if api is None:
+        return error_response(error, status_code)
+    try:
+        data = await read_json(request)
+        if not data:
+            return error_response('Request body must be JSON', 400)
+
+        # Lifecycle handling writes the shared mirror files under a flock
+        payload, status_code = await asyncio.to_thread(handle_lifecycle, data, api)
+        return JSONResponse(payload, status_code=status_code)
+    except Exception as e:
+        logger.exception("Unexpected error in webhook lifecycle")
+        return error_response(str(e), error_status(e))
+
+
+async def register_subscriptions(request):
+    """Subscribe the installed SmartApp to every registry device of an account"""
+    try:
+        data = await read_json(request) or {}
+        payload, status_code = await asyncio.to_thread(subscriptions_request, data)
+        return JSONResponse(payload, status_code=status_code)
+    except Exception as e:
+        logger.exception("Failed to register subscriptions")
+        return error_response(str(e), error_status(e))
+
+
+async def discover_devices(request):
+    """Search the account's devices (cached listing with label/room/capability/manufacturer indexes)"""
+    try:
+        # A revalidation is blocking HTTP under a file lock, so the lookup runs off the event loop
+        payload, status_code = await asyncio.to_thread(discovery_payload, request.query_params)
+        return JSONResponse(payload, status_code=status_code)
+    except Exception as e:
+        logger.exception("Unexpected error in device discovery")
+        return error_response(str(e), error_status(e))
+
+
+async def job_status(request):
+    """Status of a fire-and-forget launch"""
+    job_id = request.path_params['job_id']
+    job = await asyncio.to_thread(launch_jobs.get, job_id)
+    if job is None:
+        return error_response(f'Unknown job {job_id}', 404)
+    return JSONResponse({'success': True, 'job': job})
+
+
+async def device_status(request):
+    """Get TV device status"""
+    try:
+        entry, error, status_code = await asyncio.to_thread(resolve_target, request.query_params.get('target'))
+        if entry is None:
+            return error_response(error, status_code)
+
+        # ?refresh=1 bypasses the cache
+        use_cache = not parse_bool(request.query_params.get('refresh'), False)
+        status, cache_state = await async_api_for(entry.account).lookup_device_status(
+            entry.device_id, use_cache=use_cache, ttl=entry.status_cache_ttl)
+
+        if status:
+            return JSONResponse({
+                'success': True,
+                'device': entry.name,
+                'cache': cache_state,
+                'status': status
+            })
+
+        return error_response('Failed to get device status', 500)
+    except Exception as e:
+        logger.exception("Unexpected error while getting device status")
+        return error_response(str(e), error_status(e))
+
+
+async def get_config(request):
+    """Get current configuration (for debugging)"""
+    return JSONResponse(await asyncio.to_thread(config_payload))
+
+
+class RequestMetricsMiddleware:
+    """Per-route request count, latency and in-flight gauge (same metrics as the Flask hooks)"""
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = routes
+
+    def route_label(self, scope):
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return 'unmatched'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        route = self.route_label(scope)
+        method = scope['method']
+        status = {'code': 500}
+        request_id, log_token = start_log_context(Headers(scope=scope), route)
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+                MutableHeaders(scope=message)['X-Request-ID'] = request_id
+            await send(message)
+
+        started = time.perf_counter()
+        HTTP_IN_FLIGHT.labels(route).inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - started
+            HTTP_IN_FLIGHT.labels(route).dec()
+            HTTP_REQUEST_LATENCY.labels(route, method).observe(duration)
+            HTTP_REQUESTS.labels(route, method, str(status['code'])).inc()
+            logger.info(f"{method} {scope['path']} {status['code']} {duration * 1000:.1f}ms",
+                        extra={'method': method, 'status': status['code'], 'duration_ms': round(duration * 1000, 1)})
+            log_context.reset(log_token)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    logger.info("TV App Launcher Utility starting in async (ASGI) mode")
+    start_services()
+    # The sync warmer (started above) covers the token sessions and DNS; these the httpx pools
+    warmers = [asyncio.create_task(api.keep_warm()) for api in async_apis.values()] if config.KEEP_WARM_INTERVAL > 0 else []
+    yield
+    for warmer in warmers:
+        warmer.cancel()
+    for api in async_apis.values():
+        await api.aclose()
+
+
+routes = [
+    Route('/metrics', metrics, methods=['GET']),
+    Route('/health', health_check, methods=['GET']),
+    Route('/ready', readiness_check, methods=['GET']),
+    Route('/oauth/authorize', oauth_authorize, methods=['GET']),
+    Route('/oauth/token', oauth_token_exchange, methods=['POST']),
+    Route('/oauth/refresh-status', oauth_refresh_status, methods=['GET']),
+    Route('/launch-tv-app', launch_tv_app, methods=['POST']),
+    Route('/launch-batch', launch_batch, methods=['POST']),
+    Route('/commands', device_commands, methods=['POST']),
+    Route('/smartthings/webhook', smartthings_webhook, methods=['POST']),
+    Route('/subscriptions', register_subscriptions, methods=['POST']),
+    Route('/jobs/{job_id}', job_status, methods=['GET']),
+    Route('/device-status', device_status, methods=['GET']),
+    Route('/devices', discover_devices, methods=['GET']),
+    Route('/config', get_config, methods=['GET']),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(RequestMetricsMiddleware, routes=routes)],
+    lifespan=lifespan
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host=config.HOST, port=config.PORT)
@@ -0,0 +1,243 @@
+"""
+Local stand-in for api.smartthings.com used by the benchmark
+Serves device commands, device status, device descriptions and listings, rooms, subscriptions and /oauth/token with configurable latency and error injection.
+
+Run standalone:
+    python benchmark/mock_smartthings.py --port 18080 --latency-ms 150 --error-rate 0.01
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COMMANDS_PATH = re.compile(r'^/v1/devices/([^/]+)/commands$')
+STATUS_PATH = re.compile(r'^/v1/devices/([^/]+)/status$')
+DEVICE_PATH = re.compile(r'^/v1/devices/([^/]+)$')
+SUBSCRIPTIONS_PATH = re.compile(r'^/v1/installedapps/([^/]+)/subscriptions$')
+ROOMS_PATH = re.compile(r'^/v1/locations/([^/]+)/rooms$')
+LIST_PAGE_SIZE = 20
+ROOMS = ('Living Room', 'Kitchen', 'Bedroom', 'Office')
+CAPABILITIES = ('switch', 'custom.launchapp', 'audioVolume', 'mediaInputSource', 'refresh')
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256  # Default backlog of 5 drops connections under load
+
+
+class MockSettings:
+    """Injected latency and failure rates shared by all handler threads"""
+
+    def __init__(self, latency_ms=100.0, jitter_ms=20.0, error_rate=0.0, rate_limit_rate=0.0,
+                 token_latency_ms=200.0, token_expires_in=86400, account_devices=40):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.token_latency_ms = token_latency_ms
+        self.token_expires_in = token_expires_in
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.devices = {}  # device_id -> {'switch': ..., 'app': ...}
+        self.account_devices = account_devices  # Size of the GET /devices listing
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def delay(self, base_ms):
+        time.sleep(max(0.0, base_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000)
+
+
+def make_handler(settings):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, code, body, headers=None):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read_body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return self.rfile.read(length) if length else b''
+
+        def _inject_failure(self, kind):
+            """Send an injected 429/500 and return True, or return False to proceed"""
+            roll = random.random()
+            if roll < settings.rate_limit_rate:
+                settings.count(f'{kind}_429')
+                self._send(429, {'error': 'rate limited'}, {'Retry-After': '1'})
+                return True
+            if roll < settings.rate_limit_rate + settings.error_rate:
+                settings.count(f'{kind}_500')
+                self._send(500, {'error': 'injected failure'})
+                return True
+            return False
+
+        def do_HEAD(self):
+            # Keep-warm pings from the utility
+            settings.count('head')
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def _list_devices(self):
+            """Paged GET /v1/devices with an ETag on the first page"""
+            etag = f'"account-{settings.account_devices}"'
+            if self.headers.get('If-None-Match') == etag:
+                settings.count('list_304')
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            page = int(self.path.partition('page=')[2] or 0)
+            start = page * LIST_PAGE_SIZE
+            items = []
+            for i in range(start, min(start + LIST_PAGE_SIZE, settings.account_devices)):
+                tv = i % 3 == 0
+                items.append({
+                    'deviceId': f'account-device-{i}',
+                    'name': f'{"Samsung TV" if tv else "Smart Plug"} {i}',
+                    'label': f'{ROOMS[i % len(ROOMS)]} {"TV" if tv else "Lamp"} {i}',
+                    'manufacturerName': 'Samsung Electronics' if tv else 'SmartThings',
+                    'locationId': 'location-1',
+                    'roomId': f'room-{i % len(ROOMS)}',
+                    'components': [{'id': 'main', 'capabilities': [
+                        {'id': c, 'version': 1} for c in (CAPABILITIES if tv else ('switch', 'refresh'))
+                    ]}]
+                })
+            body = {'items': items, '_links': {}}
+            if start + LIST_PAGE_SIZE < settings.account_devices:
+                host = self.headers.get('Host')
+                body['_links']['next'] = {'href': f'http://{host}/v1/devices?page={page + 1}'}
+            self._send(200, body, {'ETag': etag} if page == 0 else None)
+
+        def do_GET(self):
+            if self.path == '/_stats':
+                with settings.lock:
+                    self._send(200, dict(settings.counters))
+                return
+            if self.path.split('?')[0] == '/v1/devices':
+                settings.count('list')
+                settings.delay(settings.latency_ms)
+                self._list_devices()
+                return
+            if ROOMS_PATH.match(self.path):
+                settings.count('rooms')
+                self._send(200, {'items': [{'roomId': f'room-{i}', 'name': name} for i, name in enumerate(ROOMS)]})
+                return
+            match = DEVICE_PATH.match(self.path)
+            if match:
+                settings.count('device')
+                settings.delay(settings.latency_ms)
+                if self._inject_failure('device'):
+                    return
+                self._send(200, {'deviceId': match.group(1), 'components': [
+                    {'id': 'main', 'capabilities': [{'id': c, 'version': 1} for c in CAPABILITIES]}
+                ]})
+                return
+            match = STATUS_PATH.match(self.path)
+            if not match:
+                self._send(404, {'error': 'not found'})
+                return
+            settings.count('status')
+            settings.delay(settings.latency_ms)
+            if self._inject_failure('status'):
+                return
+            state = settings.devices.get(match.group(1), {'switch': 'off', 'app': None})
+            self._send(200, {'components': {'main': {
+                'switch': {'switch': {'value': state['switch']}},
+                'custom.launchapp': {'appId': {'value': state['app']}}
+            }}})
+
+        def do_POST(self):
+            body = self._read_body()
+            if self.path == '/oauth/token':
+                settings.count('token')
+                settings.delay(settings.token_latency_ms)
+                self._send(200, {
+                    'access_token': f'mock-access-{time.time_ns()}',
+                    'refresh_token': 'mock-refresh',
+                    'expires_in': settings.token_expires_in
+                })
+                return
+            if SUBSCRIPTIONS_PATH.match(self.path):
+                settings.count('subscribe')
+                settings.delay(settings.latency_ms)
+                self._send(200, {'id': f'sub-{time.time_ns()}', 'sourceType': 'DEVICE'})
+                return
+            match = COMMANDS_PATH.match(self.path)
+            if not match:
+                self._send(404, {'error': 'not found'})
+                return
+            settings.count('commands')
+            settings.delay(settings.latency_ms)
+            if self._inject_failure('commands'):
+                return
+            state = settings.devices.setdefault(match.group(1), {'switch': 'off', 'app': None})
+            try:
+                commands = json.loads(body or b'{}').get('commands', [])
+            except ValueError:
+                commands = []
+            for command in commands:
+                if command.get('capability') == 'switch':
+                    state['switch'] = command.get('command')
+                elif command.get('command') == 'launchApp':
+                    state['app'] = (command.get('arguments') or [None])[0]
+            self._send(200, {'results': [{'id': str(i), 'status': 'ACCEPTED'} for i in range(len(commands))]})
+
+        def do_DELETE(self):
+            if not SUBSCRIPTIONS_PATH.match(self.path):
+                self._send(404, {'error': 'not found'})
+                return
+            settings.count('unsubscribe')
+            settings.delay(settings.latency_ms)
+            self._send(200, {'count': 0})
+
+    return Handler
+
+
+def start_mock(port=0, settings=None):
+    """Start the mock in a background thread; returns (server, settings)"""
+    settings = settings or MockSettings()
+    server = MockServer(('127.0.0.1', port), make_handler(settings))
+    threading.Thread(target=server.serve_forever, name='mock-smartthings', daemon=True).start()
+    return server, settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local SmartThings API stand-in')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--latency-ms', type=float, default=100.0)
+    parser.add_argument('--jitter-ms', type=float, default=20.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of calls answered with 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Fraction of calls answered with 429')
+    parser.add_argument('--token-latency-ms', type=float, default=200.0)
+    args = parser.parse_args()
+
+    settings = MockSettings(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate, args.token_latency_ms)
+    server, _ = start_mock(args.port, settings)
+    print(f"Mock SmartThings API listening on http://127.0.0.1:{server.server_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
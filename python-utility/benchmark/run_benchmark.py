@@ -0,0 +1,303 @@
+"""
+Load/latency benchmark for the TV App Launcher utility
+
+Starts the mock SmartThings API (benchmark/mock_smartthings.py), boots app.py
+against it in the chosen serving mode, drives /launch-tv-app and /device-status
+(or launches over the hub channel) at a fixed concurrency and reports
+p50/p95/p99 latency and throughput.
+
+Examples:
+    python benchmark/run_benchmark.py --mode gunicorn --workers 2 --concurrency 20 --duration 20
+    python benchmark/run_benchmark.py --mode asgi --scenario status --status-cache-ttl 0
+    python benchmark/run_benchmark.py --scenario channel --concurrency 50   # persistent hub channel launches
+    python benchmark/run_benchmark.py --url http://localhost:5000 --scenario status   # existing server
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+
+from mock_smartthings import MockSettings, start_mock
+
+UTILITY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ('launch', 'status', 'mixed', 'channel')
+KINDS = ('launch', 'status', 'channel')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def server_command(args, port):
+    if args.mode == 'flask':
+        return [sys.executable, 'app.py']
+    if args.mode == 'gunicorn':
+        return [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}',
+                '--workers', str(args.workers), '--threads', str(args.threads), '--timeout', '60', 'app:app']
+    return [sys.executable, '-m', 'uvicorn', 'asgi_app:app', '--host', '127.0.0.1', '--port', str(port),
+            '--workers', str(args.workers), '--no-access-log']
+
+
+def server_env(args, port, mock_url, state_dir):
+    """Environment for app.py: every SmartThings URL points at the mock, all state lives in state_dir"""
+    devices = {
+        f'tv{i}': {'device_id': f'bench-device-{i}', 'name': f'Bench TV {i}', 'app_id': 'bench-app'}
+        for i in range(args.devices)
+    }
+    env = dict(os.environ)
+    env.update({
+        'PORT': str(port),
+        'HOST': '127.0.0.1',
+        'ST_API_BASE_URL': f'{mock_url}/v1',
+        'ST_OAUTH_TOKEN_URL': f'{mock_url}/oauth/token',
+        'DEVICE_REGISTRY': json.dumps({'default_target': 'tv0', 'devices': devices}),
+        'DEVICE_REGISTRY_FILE': os.path.join(state_dir, 'devices.json'),
+        'TOKEN_FILE': os.path.join(state_dir, 'oauth_tokens.json'),
+        'DEDUP_STATE_DIR': os.path.join(state_dir, 'dedup'),
+        'JOB_STATE_DIR': os.path.join(state_dir, 'jobs'),
+        'COMMAND_JOURNAL': os.path.join(state_dir, 'commands.db'),
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(state_dir, 'prometheus'),
+        'STATUS_CACHE_TTL': str(args.status_cache_ttl),
+        'LAUNCH_DEDUP_WINDOW': str(args.dedup_window),
+        'SMART_LAUNCH': 'true' if args.smart else 'false',
+        'HTTP_POOL_MAXSIZE': str(args.pool_maxsize),
+        'HUB_CHANNEL_PORT': str(args.channel_port),
+    })
+    if args.oauth:
+        # Short-lived tokens so the refresh path is exercised during the run
+        env.update({'ST_CLIENT_ID': 'bench-client', 'ST_CLIENT_SECRET': 'bench-secret',
+                    'ST_REFRESH_TOKEN': 'bench-refresh', 'SMARTTHINGS_PAT': ''})
+    else:
+        env.update({'SMARTTHINGS_PAT': 'bench-pat', 'ST_CLIENT_ID': ''})
+    if args.mode != 'flask':
+        os.makedirs(env['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+    else:
+        env.pop('PROMETHEUS_MULTIPROC_DIR')
+    return env
+
+
+def wait_ready(base_url, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f'Server exited with code {proc.returncode}')
+        try:
+            if requests.get(f'{base_url}/health', timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'Server at {base_url} not healthy after {timeout}s')
+
+
+class LoadDriver:
+    """Closed-loop load: each of `concurrency` clients sends its next request as soon as the last returns"""
+
+    def __init__(self, base_url, scenario, devices, launch_ratio, channel_addr=None):
+        self.base_url = base_url
+        self.scenario = scenario
+        self.devices = devices
+        self.launch_ratio = launch_ratio
+        self.channel_addr = channel_addr
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.samples = {kind: [] for kind in KINDS}
+        self.errors = {kind: {} for kind in KINDS}
+
+    def _session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def _channel_launch(self, target):
+        """One launch over this client's hub channel connection, like the Edge Driver; returns the status code"""
+        if getattr(self.local, 'channel', None) is None:
+            self.local.channel = socket.create_connection(self.channel_addr, timeout=60).makefile('rwb')
+            self.local.seq = 0
+        self.local.seq += 1
+        try:
+            self.local.channel.write(f'{self.local.seq} launch {target}\n'.encode())
+            self.local.channel.flush()
+            reply = self.local.channel.readline().split()
+            if not reply:
+                raise ConnectionError('hub channel closed')
+            return int(reply[1])
+        except OSError:
+            self.local.channel.close()
+            self.local.channel = None
+            raise
+
+    def _one(self):
+        kind = self.scenario
+        if kind == 'mixed':
+            kind = 'launch' if random.random() < self.launch_ratio else 'status'
+        target = f'tv{random.randrange(self.devices)}'
+        started = time.perf_counter()
+        try:
+            if kind == 'channel':
+                outcome = self._channel_launch(target)
+            elif kind == 'launch':
+                outcome = self._session().post(f'{self.base_url}/launch-tv-app', json={'target': target}, timeout=60).status_code
+            else:
+                outcome = self._session().get(f'{self.base_url}/device-status', params={'target': target}, timeout=60).status_code
+        except (requests.RequestException, OSError) as e:
+            outcome = type(e).__name__
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.samples[kind].append(elapsed)
+            if outcome != 200:
+                self.errors[kind][str(outcome)] = self.errors[kind].get(str(outcome), 0) + 1
+
+    def _client(self, stop_at):
+        while time.time() < stop_at:
+            self._one()
+
+    def run(self, concurrency, duration, warmup):
+        if warmup:
+            stop_at = time.time() + warmup
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                for _ in range(concurrency):
+                    pool.submit(self._client, stop_at)
+            self.samples = {kind: [] for kind in KINDS}
+            self.errors = {kind: {} for kind in KINDS}
+
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for _ in range(concurrency):
+                pool.submit(self._client, started + duration)
+        return time.time() - started
+
+    def report(self, elapsed):
+        results = {}
+        for kind, values in self.samples.items():
+            if not values:
+                continue
+            values = sorted(values)
+            results[kind] = {
+                'requests': len(values),
+                'errors': self.errors[kind],
+                'throughput_rps': round(len(values) / elapsed, 1),
+                'p50_ms': round(percentile(values, 50) * 1000, 1),
+                'p95_ms': round(percentile(values, 95) * 1000, 1),
+                'p99_ms': round(percentile(values, 99) * 1000, 1),
+                'max_ms': round(values[-1] * 1000, 1),
+            }
+        return results
+
+
+def print_report(args, results, mock_stats):
+    print()
+    print(f"mode={args.mode} workers={args.workers} concurrency={args.concurrency} duration={args.duration}s "
+          f"cache_ttl={args.status_cache_ttl} upstream={args.latency_ms}ms±{args.jitter_ms} "
+          f"error_rate={args.error_rate}")
+    print(f"{'endpoint':<10}{'requests':>10}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}  errors")
+    for kind, r in results.items():
+        errors = ', '.join(f'{code}={n}' for code, n in sorted(r['errors'].items())) or '-'
+        print(f"{kind:<10}{r['requests']:>10}{r['throughput_rps']:>10}{r['p50_ms']:>10}{r['p95_ms']:>10}"
+              f"{r['p99_ms']:>10}{r['max_ms']:>10}  {errors}")
+    if mock_stats:
+        print(f"upstream calls: {mock_stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the TV App Launcher against a local SmartThings stand-in')
+    parser.add_argument('--mode', choices=('flask', 'gunicorn', 'asgi'), default='gunicorn',
+                        help='flask dev server, gunicorn sync workers, or uvicorn ASGI workers')
+    parser.add_argument('--url', help='Benchmark an already running server instead of starting one')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4, help='Threads per gunicorn sync worker')
+    parser.add_argument('--scenario', choices=SCENARIOS, default='mixed')
+    parser.add_argument('--launch-ratio', type=float, default=0.2, help='Share of launches in the mixed scenario')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=15, help='Measured seconds')
+    parser.add_argument('--warmup', type=float, default=2, help='Unmeasured seconds before the run')
+    parser.add_argument('--devices', type=int, default=4, help='Devices in the generated registry')
+    # Upstream behaviour
+    parser.add_argument('--latency-ms', type=float, default=150.0)
+    parser.add_argument('--jitter-ms', type=float, default=30.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--oauth', action='store_true', help='Use OAuth with short-lived mock tokens instead of a PAT')
+    parser.add_argument('--token-expires-in', type=int, default=1200)
+    # Utility settings under test
+    parser.add_argument('--status-cache-ttl', type=float, default=10)
+    parser.add_argument('--dedup-window', type=float, default=0, help='LAUNCH_DEDUP_WINDOW (0 = every launch hits upstream)')
+    parser.add_argument('--smart', action='store_true', help='Enable SMART_LAUNCH')
+    parser.add_argument('--pool-maxsize', type=int, default=10)
+    parser.add_argument('--channel-port', type=int, help='HUB_CHANNEL_PORT (default: a free port, or 5001 with --url)')
+    parser.add_argument('--json', dest='json_out', help='Also write results to this file')
+    args = parser.parse_args()
+
+    mock = proc = None
+    mock_stats = None
+    with tempfile.TemporaryDirectory(prefix='tv-launcher-bench-') as state_dir:
+        try:
+            if args.url:
+                base_url = args.url.rstrip('/')
+                args.channel_port = args.channel_port or 5001
+            else:
+                args.channel_port = args.channel_port or free_port()
+                settings = MockSettings(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit_rate,
+                                        token_expires_in=args.token_expires_in)
+                mock, _ = start_mock(0, settings)
+                mock_url = f'http://127.0.0.1:{mock.server_port}'
+                port = free_port()
+                base_url = f'http://127.0.0.1:{port}'
+                log = open(os.path.join(state_dir, 'server.log'), 'w')
+                proc = subprocess.Popen(server_command(args, port), cwd=UTILITY_DIR,
+                                        env=server_env(args, port, mock_url, state_dir),
+                                        stdout=log, stderr=subprocess.STDOUT)
+            try:
+                wait_ready(base_url, proc)
+            except RuntimeError:
+                if proc is not None:
+                    log.flush()
+                    with open(log.name) as f:
+                        sys.stderr.write(f.read()[-4000:])
+                raise
+
+            channel_addr = (urlparse(base_url).hostname, args.channel_port)
+            driver = LoadDriver(base_url, args.scenario, args.devices, args.launch_ratio, channel_addr)
+            elapsed = driver.run(args.concurrency, args.duration, args.warmup)
+            results = driver.report(elapsed)
+            if mock is not None:
+                mock_stats = requests.get(f'{mock_url}/_stats', timeout=5).json()
+        finally:
+            if proc is not None:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+            if mock is not None:
+                mock.shutdown()
+
+    print_report(args, results, mock_stats)
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results, 'upstream_calls': mock_stats}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
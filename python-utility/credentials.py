@@ -0,0 +1,74 @@
+"""
+Credentials of the SmartThings accounts served by this process
+"""
+
+import re
+from pathlib import Path
+
+from settings import config
+
+DEFAULT_ACCOUNT = 'default'
+ACCOUNT_NAME_PATTERN = re.compile(r'^[a-z0-9_-]{1,32}$')
+
+class AccountCredentials:
+    """Credentials of one SmartThings account and where its state is kept
+    
+    The default account uses the ST_* settings and the configured state
+    paths unchanged; other accounts get their own token file, journal,
+    mirror directory and discovery cache next to the default ones.
+    """
+    
+    def __init__(self, name, client_id='', client_secret='', refresh_token='', pat='',
+                 token_file=None, installed_app_id=''):
+        self.name = name
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_token = refresh_token
+        self.pat = pat
+        self.token_file = token_file or self.scoped_path(config.TOKEN_FILE)
+        self.installed_app_id = installed_app_id
+    
+    @classmethod
+    def from_config(cls):
+        return cls(
+            DEFAULT_ACCOUNT,
+            client_id=config.ST_CLIENT_ID,
+            client_secret=config.ST_CLIENT_SECRET,
+            refresh_token=config.ST_REFRESH_TOKEN,
+            pat=config.ST_PAT,
+            token_file=config.TOKEN_FILE,
+            installed_app_id=config.ST_INSTALLED_APP_ID
+        )
+    
+    @classmethod
+    def from_dict(cls, name, data):
+        name = name.lower()
+        if not ACCOUNT_NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid account name '{name}' (use a-z, 0-9, '-' and '_')")
+        # Households usually authorize the same SmartApp, so the client defaults to ST_CLIENT_ID
+        return cls(
+            name,
+            client_id=data.get('client_id') or config.ST_CLIENT_ID,
+            client_secret=data.get('client_secret') or (config.ST_CLIENT_SECRET if not data.get('client_id') else ''),
+            refresh_token=data.get('refresh_token', ''),
+            pat=data.get('pat', ''),
+            token_file=data.get('token_file'),
+            installed_app_id=data.get('installed_app_id', '')
+        )
+    
+    @property
+    def use_oauth(self):
+        """OAuth when a client is configured and there is a refresh token or a token file"""
+        return bool(self.client_id and (self.refresh_token or Path(self.token_file).exists()))
+    
+    def scoped_path(self, path, directory=False):
+        """path for this account: unchanged for the default account, else suffixed with the name"""
+        if not path or self.name == DEFAULT_ACCOUNT:
+            return path
+        path = Path(path)
+        if directory:
+            return str(path / self.name)
+        return str(path.with_name(f"{path.stem}-{self.name}{path.suffix}"))
+    
+    def secrets(self):
+        return (self.pat, self.client_secret, self.refresh_token)
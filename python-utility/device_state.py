@@ -0,0 +1,496 @@
+"""
+Device status: the in-process status cache and the event-driven state mirror
+"""
+
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from pathlib import Path
+
+from settings import config
+from storage import atomic_write_json, file_lock
+
+logger = logging.getLogger(__name__)
+
+class DeviceStatusCache:
+    """In-process device status cache with stale-while-revalidate
+    
+    Entries are fresh for their TTL, then served stale for up to
+    STATUS_CACHE_STALE more seconds while one background fetch revalidates
+    them. Concurrent misses for the same device share a single upstream
+    call. invalidate() drops an entry and marks any fetch already in flight
+    as invalidated: its result is neither cached nor handed to the callers
+    waiting on it, who fetch again. A status read from before a command is
+    thus never served as if it were read after it.
+    """
+    
+    class _Flight:
+        def __init__(self):
+            self.invalidated = False
+            self.done = threading.Event()
+            self.future = None  # Set when the fetch runs on an asyncio loop
+            self.value = None
+    
+    def __init__(self, default_ttl, stale_seconds):
+        self.default_ttl = default_ttl
+        self.stale_seconds = stale_seconds
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> (value, fetched_at)
+        self._inflight = {}  # key -> _Flight
+        self._tasks = set()  # Background revalidation tasks (async mode)
+        self.counters = {
+            'hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'revalidations': 0,
+            'invalidations': 0,
+            'errors': 0
+        }
+    
+    def get(self, key, loader, ttl=None):
+        """Return (value, state) where state is hit, stale, miss, coalesced or bypass"""
+        ttl = self.default_ttl if ttl is None else ttl
+        if ttl <= 0:
+            return loader(key), 'bypass'
+        
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, fetched_at = entry
+                age = now - fetched_at
+                if age < ttl:
+                    self.counters['hits'] += 1
+                    return value, 'hit'
+                if age < ttl + self.stale_seconds:
+                    self.counters['stale_hits'] += 1
+                    if key not in self._inflight:
+                        self.counters['revalidations'] += 1
+                        flight = self._start_flight(key)
+                        threading.Thread(
+                            target=self._load, args=(key, loader, flight),
+                            name='status-revalidate', daemon=True
+                        ).start()
+                    return value, 'stale'
+            
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self.counters['coalesced'] += 1
+                leader = False
+            else:
+                self.counters['misses'] += 1
+                flight = self._start_flight(key)
+                leader = True
+        
+        if leader:
+            self._load(key, loader, flight)
+            return flight.value, 'miss'
+        flight.done.wait(config.HTTP_CONNECT_TIMEOUT + config.HTTP_READ_TIMEOUT)
+        if flight.invalidated:
+            # Read before a command that changed the device; fetch again
+            return self.get(key, loader, ttl)
+        return flight.value, 'coalesced'
+    
+    def _start_flight(self, key):
+        """Register an in-flight fetch; caller must hold the lock"""
+        flight = self._Flight()
+        self._inflight[key] = flight
+        return flight
+    
+    def _load(self, key, loader, flight):
+        value = None
+        try:
+            value = loader(key)
+        except Exception:
+            logger.exception(f"Device status fetch failed for {key}")
+        finally:
+            self._finish(key, flight, value)
+    
+    def _finish(self, key, flight, value):
+        """Store a fetched value (unless invalidated meanwhile) and release waiters"""
+        with self._lock:
+            if value is None:
+                self.counters['errors'] += 1
+            elif not flight.invalidated:
+                self._entries[key] = (value, time.monotonic())
+            if self._inflight.get(key) is flight:
+                del self._inflight[key]
+        flight.value = value
+        flight.done.set()
+        if flight.future is not None and not flight.future.done():
+            flight.future.set_result(value)
+    
+    async def aget(self, key, loader, ttl=None):
+        """Async variant of get() for a coroutine loader; same states and counters"""
+        ttl = self.default_ttl if ttl is None else ttl
+        if ttl <= 0:
+            return await loader(key), 'bypass'
+        
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, fetched_at = entry
+                age = now - fetched_at
+                if age < ttl:
+                    self.counters['hits'] += 1
+                    return value, 'hit'
+                if age < ttl + self.stale_seconds:
+                    self.counters['stale_hits'] += 1
+                    if key not in self._inflight:
+                        self.counters['revalidations'] += 1
+                        flight = self._start_flight(key)
+                        flight.future = loop.create_future()
+                        task = loop.create_task(self._aload(key, loader, flight))
+                        self._tasks.add(task)
+                        task.add_done_callback(self._tasks.discard)
+                    return value, 'stale'
+            
+            flight = self._inflight.get(key)
+            if flight is not None:
+                self.counters['coalesced'] += 1
+                leader = False
+            else:
+                self.counters['misses'] += 1
+                flight = self._start_flight(key)
+                flight.future = loop.create_future()
+                leader = True
+        
+        if leader:
+            await self._aload(key, loader, flight)
+            return flight.value, 'miss'
+        wait_seconds = config.HTTP_CONNECT_TIMEOUT + config.HTTP_READ_TIMEOUT
+        if flight.future is not None and flight.future.get_loop() is loop:
+            try:
+                await asyncio.wait_for(asyncio.shield(flight.future), wait_seconds)
+            except asyncio.TimeoutError:
+                pass
+        else:
+            # Leader is a synchronous fetch on another thread
+            await asyncio.to_thread(flight.done.wait, wait_seconds)
+        if flight.invalidated:
+            return await self.aget(key, loader, ttl)
+        return flight.value, 'coalesced'
+    
+    async def _aload(self, key, loader, flight):
+        value = None
+        try:
+            value = await loader(key)
+        except Exception:
+            logger.exception(f"Device status fetch failed for {key}")
+        finally:
+            self._finish(key, flight, value)
+    
+    def prime(self, key, value):
+        """Store a value fetched elsewhere (e.g. by a device listing) as a fresh entry"""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+    
+    def peek(self, key, max_age):
+        """Cached value no older than max_age seconds, without fetching; returns (value, age)"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None, None
+        value, fetched_at = entry
+        age = time.monotonic() - fetched_at
+        if age > max_age:
+            return None, None
+        return value, age
+    
+    def invalidate(self, key):
+        """Drop the cached status for key and invalidate the fetch in flight, if any"""
+        with self._lock:
+            self._entries.pop(key, None)
+            flight = self._inflight.pop(key, None)
+            if flight is not None:
+                flight.invalidated = True
+            self.counters['invalidations'] += 1
+    
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+            entries = len(self._entries)
+        lookups = counters['hits'] + counters['stale_hits'] + counters['misses'] + counters['coalesced']
+        served = counters['hits'] + counters['stale_hits'] + counters['coalesced']
+        counters.update({
+            'entries': entries,
+            'hit_ratio': round(served / lookups, 3) if lookups else None,
+            'default_ttl': self.default_ttl,
+            'stale_seconds': self.stale_seconds
+        })
+        return counters
+
+def event_timestamp(value):
+    """Epoch seconds of a SmartThings ISO 8601 timestamp, or None"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+class DeviceStateMirror:
+    """Device attributes kept current by SmartThings subscription events
+    
+    Each device is seeded from a full /status document (a resync) and then
+    patched one attribute at a time by DEVICE_EVENTs from the webhook. The
+    mirror has the same component/capability/attribute shape as /status, so
+    a snapshot can be served in its place. A device is only served while it
+    is in sync; the next status fetch resyncs it after any of these gaps:
+    
+    - the worker has not seen a resync since it started (events may have been
+      missed while it was down),
+    - MIRROR_RESYNC_INTERVAL has passed since the last resync,
+    - a command was sent and no event arrived within MIRROR_EVENT_GRACE,
+    - subscriptions were (re)registered or the SmartApp was uninstalled.
+    
+    With a state directory every change is written to a per-device file
+    under a flock, so the gunicorn workers that did not receive a webhook
+    see it too; reads only re-read a file when it changed.
+    """
+    
+    def __init__(self, state_dir=None):
+        self.state_dir = Path(state_dir) if state_dir else None
+        self.started_at = time.time()
+        self._lock = threading.RLock()
+        self._records = {}  # device_id -> (record, file signature)
+        self._verified = set()  # Devices resynced by this process
+        self.last_event_at = None
+        self.counters = {
+            'served': 0,
+            'resyncs': 0,
+            'events': 0,
+            'out_of_order': 0,
+            'untracked': 0
+        }
+        self.gaps = {}  # reason -> count
+    
+    def _path(self, device_id):
+        return self.state_dir / f"{hashlib.sha1(device_id.encode()).hexdigest()}.json"
+    
+    def _load(self, device_id):
+        """Latest record for device_id; caller must hold the lock"""
+        cached = self._records.get(device_id)
+        if self.state_dir is None:
+            return cached[0] if cached else None
+        path = self._path(device_id)
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            self._records.pop(device_id, None)
+            return None
+        signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if cached is not None and cached[1] == signature:
+            return cached[0]
+        try:
+            with open(path, 'r') as f:
+                record = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to read mirrored state for {device_id}: {e}")
+            return None
+        self._records[device_id] = (record, signature)
+        return record
+    
+    def _update(self, device_id, change):
+        """Apply change(record) -> new record (or None to leave it) under the cross-worker lock"""
+        with self._lock:
+            lock = (file_lock(self._path(device_id).with_suffix('.lock'), config.TOKEN_LOCK_TIMEOUT)
+                    if self.state_dir else nullcontext())
+            with lock:
+                record = self._load(device_id)
+                # Readers may be serialising the current record, so changes go to a copy
+                record = change(copy.deepcopy(record) if record is not None else None)
+                if record is None:
+                    return None
+                if self.state_dir is None:
+                    self._records[device_id] = (record, None)
+                else:
+                    path = self._path(device_id)
+                    atomic_write_json(path, record, fsync=False)
+                    st = path.stat()
+                    self._records[device_id] = (record, (st.st_ino, st.st_mtime_ns, st.st_size))
+                return record
+    
+    def _gap(self, device_id, record, now):
+        """Why record cannot be served (None when it is in sync)"""
+        if record.get('gap'):
+            return record['gap']
+        if device_id not in self._verified and record['synced_at'] < self.started_at:
+            return 'restart'
+        if now - record['synced_at'] > config.MIRROR_RESYNC_INTERVAL:
+            return 'resync_due'
+        awaiting = record.get('awaiting_event_since')
+        if awaiting is not None and now - awaiting > config.MIRROR_EVENT_GRACE:
+            return 'no_event_after_command'
+        return None
+    
+    def snapshot(self, device_id):
+        """Mirrored status document and its age, or (None, None) when the device needs a resync"""
+        if not config.STATE_MIRROR:
+            return None, None
+        with self._lock:
+            record = self._load(device_id)
+        if record is None:
+            return None, None
+        now = time.time()
+        if self._gap(device_id, record, now) is not None:
+            return None, None
+        self.counters['served'] += 1
+        return {'components': record['components']}, now - record['updated_at']
+    
+    def resync(self, device_id, status, fetched_at):
+        """Replace a device's state with a /status document fetched at fetched_at (epoch seconds)"""
+        if not config.STATE_MIRROR or not isinstance(status, dict):
+            return
+        
+        def change(record):
+            previous = record or {}
+            reason = self._gap(device_id, previous, time.time()) if record else 'initial'
+            components = copy.deepcopy(status.get('components') or {})
+            # Keep attributes an event updated after this document was read
+            for component_id, capabilities in (previous.get('components') or {}).items():
+                for capability_id, attributes in capabilities.items():
+                    for attribute_id, current in attributes.items():
+                        fetched = components.get(component_id, {}).get(capability_id, {}).get(attribute_id)
+                        current_time = event_timestamp(current.get('timestamp'))
+                        if current_time is not None and current_time > fetched_at and (
+                                fetched is None or (event_timestamp(fetched.get('timestamp')) or 0) < current_time):
+                            components.setdefault(component_id, {}).setdefault(capability_id, {})[attribute_id] = current
+            awaiting = previous.get('awaiting_event_since')
+            gap_at = previous.get('gap_at')
+            in_sync = gap_at is None or gap_at <= fetched_at
+            if reason:
+                self.gaps[reason] = self.gaps.get(reason, 0) + 1
+            return {
+                'device_id': device_id,
+                'components': components,
+                'synced_at': fetched_at,
+                'updated_at': time.time(),
+                'events': previous.get('events', 0),
+                'awaiting_event_since': awaiting if awaiting is not None and awaiting > fetched_at else None,
+                'gap': None if in_sync else previous.get('gap'),
+                'gap_at': None if in_sync else gap_at
+            }
+        
+        try:
+            self._update(device_id, change)
+        except Exception as e:
+            logger.error(f"Failed to resync mirrored state for {device_id}: {e}")
+            return
+        self._verified.add(device_id)
+        self.counters['resyncs'] += 1
+    
+    def apply_events(self, events):
+        """Apply DEVICE_EVENTs from a webhook EVENT lifecycle; returns the number applied"""
+        if not config.STATE_MIRROR:
+            return 0
+        by_device = {}
+        for event in events or []:
+            device_event = event.get('deviceEvent') if event.get('eventType') == 'DEVICE_EVENT' else None
+            if device_event and device_event.get('deviceId') and device_event.get('attribute'):
+                by_device.setdefault(device_event['deviceId'], []).append((event.get('eventTime'), device_event))
+        
+        applied = 0
+        for device_id, device_events in by_device.items():
+            def change(record):
+                nonlocal applied
+                if record is None:
+                    # Never synced: the first status read fetches the full document
+                    self.counters['untracked'] += len(device_events)
+                    return None
+                for event_time, event in device_events:
+                    attributes = record['components'].setdefault(event.get('componentId') or 'main', {}) \
+                        .setdefault(event.get('capability') or '', {})
+                    current = attributes.get(event['attribute'])
+                    new_time = event_timestamp(event_time) or time.time()
+                    if current is not None and (event_timestamp(current.get('timestamp')) or 0) > new_time:
+                        self.counters['out_of_order'] += 1
+                        continue
+                    value = {'value': event.get('value'), 'timestamp': event_time or time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+                    if event.get('unit'):
+                        value['unit'] = event['unit']
+                    if event.get('data'):
+                        value['data'] = event['data']
+                    attributes[event['attribute']] = value
+                    applied += 1
+                record['events'] = record.get('events', 0) + len(device_events)
+                record['updated_at'] = time.time()
+                record['awaiting_event_since'] = None
+                return record
+            
+            try:
+                self._update(device_id, change)
+            except Exception as e:
+                logger.error(f"Failed to apply events for {device_id}: {e}")
+                self.mark_gap(device_id, 'event_apply_failed')
+        self.counters['events'] += applied
+        self.last_event_at = time.time()
+        return applied
+    
+    def expect_event(self, device_id):
+        """A command was sent: the device needs a resync if no event confirms it within MIRROR_EVENT_GRACE"""
+        if not config.STATE_MIRROR:
+            return
+        
+        def change(record):
+            if record is None or record.get('awaiting_event_since') is not None:
+                return None
+            record['awaiting_event_since'] = time.time()
+            return record
+        
+        try:
+            self._update(device_id, change)
+        except Exception as e:
+            logger.error(f"Failed to update mirrored state for {device_id}: {e}")
+    
+    def mark_gap(self, device_id, reason):
+        """Stop serving device_id (every mirrored device when None) until it is resynced"""
+        if device_id is None:
+            with self._lock:
+                if self.state_dir is None:
+                    device_ids = list(self._records)
+                else:
+                    device_ids = []
+                    for path in self.state_dir.glob('*.json'):
+                        try:
+                            with open(path, 'r') as f:
+                                device_ids.append(json.load(f)['device_id'])
+                        except (OSError, ValueError, KeyError):
+                            continue
+            for mirrored_id in device_ids:
+                self.mark_gap(mirrored_id, reason)
+            return
+        
+        def change(record):
+            if record is None:
+                return None
+            record['gap'] = reason
+            record['gap_at'] = time.time()
+            return record
+        
+        try:
+            self._update(device_id, change)
+        except Exception as e:
+            logger.error(f"Failed to mark mirrored state for {device_id}: {e}")
+    
+    def stats(self):
+        with self._lock:
+            devices = len(self._records)
+        return dict(
+            self.counters,
+            enabled=config.STATE_MIRROR,
+            devices=devices,
+            gaps=dict(self.gaps),
+            last_event_at=datetime.fromtimestamp(self.last_event_at).isoformat() if self.last_event_at else None,
+            resync_interval=config.MIRROR_RESYNC_INTERVAL,
+            event_grace=config.MIRROR_EVENT_GRACE
+        )
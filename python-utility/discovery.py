@@ -0,0 +1,243 @@
+"""
+Cached, indexed listing of every device on an account (GET /devices)
+"""
+
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from pathlib import Path
+
+import requests
+
+from settings import config
+from storage import atomic_write_json, file_lock
+
+logger = logging.getLogger(__name__)
+
+def index_tokens(text):
+    """Lowercased words of a label for the discovery label index"""
+    return set(re.findall(r'[a-z0-9]+', (text or '').lower()))
+
+class DeviceCatalog:
+    """Cached, indexed listing of every device on the account (GET /devices)
+    
+    The listing pages through /devices and names rooms via
+    /locations/{id}/rooms. It is kept in DISCOVERY_CACHE_FILE, which all
+    workers share and which survives restarts. After DISCOVERY_TTL seconds
+    the first page is requested again with If-None-Match; a 304 only renews
+    the TTL, so a large account is listed in full only when it changed. A
+    listing cut off at DISCOVERY_MAX_PAGES is marked truncated. One
+    worker revalidates at a time and the others pick up its file.
+    Queries are answered from in-memory indexes by label word, room,
+    capability and manufacturer. Listed capabilities also prime the
+    capability cache that /commands validates against.
+    """
+    
+    INDEXES = ('label', 'room', 'capability', 'manufacturer')
+    
+    def __init__(self, api, path=None):
+        self.api = api
+        self.path = Path(path) if path else None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._signature = None
+        self.document = None  # {'devices', 'rooms', 'etag', 'truncated', 'fetched_at', 'validated_at'}
+        self.devices = {}
+        self.indexes = {name: {} for name in self.INDEXES}
+        self.counters = {'queries': 0, 'listings': 0, 'pages': 0, 'not_modified': 0, 'errors': 0}
+    
+    def _file_signature(self):
+        try:
+            st = self.path.stat()
+        except (AttributeError, FileNotFoundError):
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+    
+    def _load_shared(self):
+        """Pick up a listing another worker (or an earlier run) saved"""
+        signature = self._file_signature()
+        if signature is None or signature == self._signature:
+            return
+        try:
+            with open(self.path, 'r') as f:
+                document = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to read discovery cache: {e}")
+            return
+        self._signature = signature
+        self._install(document)
+    
+    def _install(self, document):
+        """Swap in a listing and rebuild the indexes"""
+        devices = {device['device_id']: device for device in document.get('devices', [])}
+        indexes = {name: {} for name in self.INDEXES}
+        for device_id, device in devices.items():
+            keys = {
+                'label': index_tokens(device.get('label')) | index_tokens(device.get('name')),
+                'room': {(device.get('room') or '').lower()} - {''},
+                'capability': {c.lower() for c in device.get('capabilities', [])},
+                'manufacturer': {(device.get('manufacturer') or '').lower()} - {''}
+            }
+            for name, values in keys.items():
+                for value in values:
+                    indexes[name].setdefault(value, set()).add(device_id)
+            self.api.capability_cache.prime(device_id, device.get('components', {}))
+        with self._lock:
+            self.document = document
+            self.devices = devices
+            self.indexes = indexes
+    
+    def _save(self, document):
+        self._install(document)
+        if self.path is None:
+            return
+        try:
+            atomic_write_json(self.path, document, fsync=False)
+            self._signature = self._file_signature()
+        except OSError as e:
+            logger.error(f"Failed to save discovery cache: {e}")
+    
+    def _fresh(self):
+        document = self.document
+        return document is not None and time.time() - document['validated_at'] < config.DISCOVERY_TTL
+    
+    def ensure_fresh(self, force=False):
+        """Make sure the listing is within DISCOVERY_TTL; returns hit, revalidated, listed or stale"""
+        self._load_shared()
+        if not force and self._fresh():
+            return 'hit'
+        with self._refresh_lock:
+            lock = (file_lock(self.path.with_name(self.path.name + '.lock'), config.TOKEN_LOCK_TIMEOUT)
+                    if self.path else nullcontext())
+            with lock:
+                # Another thread or worker may have revalidated while we waited
+                self._load_shared()
+                if self._fresh() and (not force or self.document['validated_at'] > time.time() - 1):
+                    return 'hit'
+                try:
+                    return self._revalidate()
+                except requests.exceptions.RequestException as e:
+                    self.counters['errors'] += 1
+                    logger.error(f"Device discovery failed: {e}")
+                    if self.document is None:
+                        raise
+                    return 'stale'
+    
+    def _revalidate(self):
+        url = f"{config.ST_API_BASE_URL}/devices"
+        headers = self.api.get_headers()
+        etag = self.document.get('etag') if self.document else None
+        if etag:
+            headers = dict(headers, **{'If-None-Match': etag})
+        
+        response = self.api.http.get(url, call='device_list', headers=headers)
+        if response.status_code == 304 and self.document is not None:
+            self.counters['not_modified'] += 1
+            self._save(dict(self.document, validated_at=time.time()))
+            return 'revalidated'
+        response.raise_for_status()
+        first_etag = response.headers.get('ETag')
+        
+        items = []
+        pages = 0
+        truncated = False
+        while True:
+            pages += 1
+            data = response.json()
+            items.extend(data.get('items', []))
+            next_url = ((data.get('_links') or {}).get('next') or {}).get('href')
+            if not next_url:
+                break
+            if pages >= config.DISCOVERY_MAX_PAGES:
+                truncated = True
+                logger.warning(f"Device discovery stopped after DISCOVERY_MAX_PAGES ({pages}) pages, the listing is incomplete")
+                break
+            response = self.api.http.get(next_url, call='device_list', headers=self.api.get_headers())
+            response.raise_for_status()
+        self.counters['listings'] += 1
+        self.counters['pages'] += pages
+        
+        rooms = self._fetch_rooms({item.get('locationId') for item in items} - {None})
+        now = time.time()
+        self._save({
+            'devices': [self._summarize(item, rooms) for item in items],
+            'rooms': rooms,
+            'etag': first_etag,
+            'truncated': truncated,
+            'fetched_at': now,
+            'validated_at': now
+        })
+        logger.info(f"Device discovery: {len(items)} device(s) in {pages} page(s)")
+        return 'listed'
+    
+    def _fetch_rooms(self, location_ids):
+        """roomId -> name for each location; rooms stay unnamed if a lookup fails"""
+        rooms = {}
+        for location_id in sorted(location_ids):
+            try:
+                response = self.api.http.get(f"{config.ST_API_BASE_URL}/locations/{location_id}/rooms",
+                                             call='rooms', headers=self.api.get_headers())
+                response.raise_for_status()
+                for room in response.json().get('items', []):
+                    rooms[room.get('roomId')] = room.get('name')
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Failed to list rooms of location {location_id}: {e}")
+        return rooms
+    
+    def _summarize(self, item, rooms):
+        components = self.api.parse_capabilities(item)
+        return {
+            'device_id': item.get('deviceId'),
+            'label': item.get('label') or item.get('name'),
+            'name': item.get('name'),
+            'manufacturer': item.get('manufacturerName'),
+            'type': item.get('type'),
+            'location_id': item.get('locationId'),
+            'room_id': item.get('roomId'),
+            'room': rooms.get(item.get('roomId')),
+            'capabilities': sorted({c for capabilities in components.values() for c in capabilities}),
+            'components': components
+        }
+    
+    def query(self, label=None, room=None, capabilities=None, manufacturer=None, text=None):
+        """Device summaries matching every given filter (label words, room, capabilities, manufacturer, free text)"""
+        self.counters['queries'] += 1
+        with self._lock:
+            devices, indexes = self.devices, self.indexes
+        candidates = None
+        
+        def narrow(matches):
+            nonlocal candidates
+            candidates = set(matches) if candidates is None else candidates & matches
+        
+        for word in index_tokens(label):
+            narrow(indexes['label'].get(word, set()))
+        if room:
+            narrow(indexes['room'].get(room.lower(), set()))
+        for capability in capabilities or []:
+            narrow(indexes['capability'].get(capability.lower(), set()))
+        if manufacturer:
+            narrow(indexes['manufacturer'].get(manufacturer.lower(), set()))
+        
+        matches = devices.values() if candidates is None else (devices[d] for d in candidates)
+        if text:
+            needle = text.lower()
+            matches = (d for d in matches if any(
+                needle in (d.get(field) or '').lower() for field in ('label', 'name', 'room', 'manufacturer', 'device_id')
+            ))
+        return sorted(matches, key=lambda d: ((d.get('label') or '').lower(), d['device_id']))
+    
+    def stats(self):
+        document = self.document
+        return dict(
+            self.counters,
+            devices=len(self.devices),
+            truncated=bool(document and document.get('truncated')),
+            fetched_at=datetime.fromtimestamp(document['fetched_at']).isoformat() if document else None,
+            validated_at=datetime.fromtimestamp(document['validated_at']).isoformat() if document else None,
+            ttl=config.DISCOVERY_TTL
+        )
@@ -0,0 +1,145 @@
+"""
+TTL cache of SmartThings host lookups and the requests adapter that uses it
+"""
+
+import logging
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from settings import config
+
+logger = logging.getLogger(__name__)
+
+class DNSCache:
+    """TTL cache of getaddrinfo results for the SmartThings hosts
+    
+    Python does not cache lookups, so every new connection resolves
+    api.smartthings.com again. Only the connections opened by the pooled
+    clients consult it (CachedDNSAdapter for requests, CachedDNSBackend in
+    asgi_app.py for httpx); socket.getaddrinfo itself is left alone. If a
+    refresh fails, the last known addresses keep being served.
+    """
+    
+    def __init__(self, ttl, urls):
+        self.ttl = ttl
+        self.hosts = {urlparse(url).hostname for url in urls if urlparse(url).hostname}
+        self._lock = threading.Lock()
+        self._entries = {}  # getaddrinfo args -> (expires_at, result)
+        self._resolve = socket.getaddrinfo
+        self.hits = 0
+        self.misses = 0
+        self.stale_served = 0
+    
+    @property
+    def enabled(self):
+        return self.ttl > 0
+    
+    def caches(self, host):
+        return self.enabled and host in self.hosts
+    
+    def addresses(self, host, port):
+        """Distinct IP addresses for a TCP connection to host, in resolver order"""
+        addresses = []
+        for _, _, _, _, sockaddr in self.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+            if sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+        return addresses
+    
+    def _lookup(self, key):
+        try:
+            result = self._resolve(*key)
+        except socket.gaierror:
+            entry = self._entries.get(key)
+            if entry is None:
+                raise
+            self.stale_served += 1
+            logger.warning(f"DNS lookup for {key[0]} failed, serving cached addresses")
+            return entry[1]
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+        return result
+    
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        if not self.caches(host):
+            return self._resolve(*key)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return self._lookup(key)
+    
+    def refresh(self, within):
+        """Re-resolve entries expiring in the next `within` seconds, off the request path"""
+        horizon = time.monotonic() + within
+        with self._lock:
+            due = [key for key, (expires_at, _) in self._entries.items() if expires_at <= horizon]
+        for key in due:
+            try:
+                self._lookup(key)
+            except socket.gaierror as e:
+                logger.warning(f"DNS refresh for {key[0]} failed: {e}")
+    
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'ttl': self.ttl,
+            'hosts': sorted(self.hosts),
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_served': self.stale_served
+        }
+
+def cached_dns_connection(base):
+    """urllib3 connection class that connects to the DNSCache addresses of the SmartThings hosts
+    
+    Only the TCP connect target changes: TLS SNI and certificate checks still
+    use the hostname. Every cached address is tried in turn, as
+    create_connection does for a fresh lookup.
+    """
+    class CachedDNSConnection(base):
+        def _new_conn(self):
+            host = self._dns_host
+            if not dns_cache.caches(host):
+                return super()._new_conn()
+            try:
+                addresses = dns_cache.addresses(host, self.port)
+            except socket.gaierror:
+                # Nothing cached and the lookup failed: let urllib3 report it
+                return super()._new_conn()
+            error = None
+            try:
+                for address in addresses:
+                    self._dns_host = address
+                    try:
+                        return super()._new_conn()
+                    except (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError) as e:
+                        error = e
+            finally:
+                self._dns_host = host
+            raise error
+    CachedDNSConnection.__name__ = f'CachedDNS{base.__name__}'
+    return CachedDNSConnection
+
+class CachedDNSAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools resolve the SmartThings hosts through dns_cache"""
+    
+    POOL_CLASSES = {
+        'http': type('CachedDNSHTTPConnectionPool', (urllib3.HTTPConnectionPool,),
+                     {'ConnectionCls': cached_dns_connection(urllib3.connection.HTTPConnection)}),
+        'https': type('CachedDNSHTTPSConnectionPool', (urllib3.HTTPSConnectionPool,),
+                      {'ConnectionCls': cached_dns_connection(urllib3.connection.HTTPSConnection)})
+    }
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = self.POOL_CLASSES
+
+dns_cache = DNSCache(config.DNS_CACHE_TTL, [config.ST_API_BASE_URL, config.ST_OAUTH_TOKEN_URL])
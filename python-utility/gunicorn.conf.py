@@ -0,0 +1,31 @@
+"""
+Gunicorn settings loaded automatically from the working directory.
+Keeps Prometheus multiprocess metrics (PROMETHEUS_MULTIPROC_DIR) consistent across worker restarts
+and starts each worker's listeners once the app is loaded.
+"""
+
+import os
+import shutil
+
+
+def on_starting(server):
+    """Start every deployment with an empty metrics directory"""
+    multiproc_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if multiproc_dir:
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+        os.makedirs(multiproc_dir, exist_ok=True)
+
+
+def post_worker_init(worker):
+    """Start the worker's listeners (app.py does not start them at import)"""
+    import sys
+    launcher = sys.modules.get('app')
+    if launcher is not None:
+        launcher.start_services()
+
+
+def child_exit(server, worker):
+    """Drop the live gauges of a worker that exited"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,225 @@
+"""
+Pooled keep-alive HTTP client for SmartThings and the thread that keeps it warm
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from urllib3.util.retry import Retry
+
+from settings import config
+from logs import current_request_id
+from resilience import upstream_guard
+from metrics import UPSTREAM_LATENCY
+from dns_cache import CachedDNSAdapter
+
+logger = logging.getLogger(__name__)
+
+class PooledHTTPClient:
+    """Keep-alive HTTP session with a bounded connection pool and retry policy
+    
+    One session is kept per worker process, so gunicorn workers never share
+    sockets after fork. Connection reuse is tracked from the urllib3 pool
+    counters to confirm that TCP/TLS handshakes are being avoided.
+    """
+    
+    # Transient upstream statuses worth retrying at the transport level
+    RETRY_STATUSES = (502, 503, 504)
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        self.timeout = (config.HTTP_CONNECT_TIMEOUT, config.HTTP_READ_TIMEOUT)
+        self.requests_sent = 0
+        self.errors = 0
+    
+    def _build_session(self):
+        """Create a requests session with a pooled, retrying adapter"""
+        # Connect errors are retried for every method (the request never left);
+        # read/status retries only apply to idempotent methods, so a launch
+        # command is never sent twice by the transport.
+        retry = Retry(
+            total=config.HTTP_RETRIES,
+            connect=config.HTTP_RETRIES,
+            read=config.HTTP_RETRIES,
+            status=config.HTTP_RETRIES,
+            backoff_factor=config.HTTP_RETRY_BACKOFF,
+            status_forcelist=self.RETRY_STATUSES,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = CachedDNSAdapter(
+            pool_connections=config.HTTP_POOL_CONNECTIONS,
+            pool_maxsize=config.HTTP_POOL_MAXSIZE,
+            max_retries=retry,
+            pool_block=False
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        logger.info(f"HTTP connection pool created (pid={os.getpid()}, maxsize={config.HTTP_POOL_MAXSIZE})")
+        return session
+    
+    @property
+    def session(self):
+        """Return the session for the current process, rebuilding it after fork"""
+        pid = os.getpid()
+        if self._session is None or self._pid != pid:
+            with self._lock:
+                if self._session is None or self._pid != pid:
+                    self._session = self._build_session()
+                    self._pid = pid
+                    self.requests_sent = 0
+                    self.errors = 0
+        return self._session
+    
+    def request(self, method, url, call='other', device='none', **kwargs):
+        """Send a request over the pooled session using the configured timeouts
+        
+        call and device only label the upstream latency metric.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        request_id = current_request_id()
+        if request_id:
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **{'X-Request-ID': request_id})
+        session = self.session
+        # Fails fast with UpstreamUnavailable while the circuit is open or the bucket is empty
+        delay = upstream_guard.before(call)
+        if delay:
+            time.sleep(delay)
+        self.requests_sent += 1
+        started = time.perf_counter()
+        status = 'error'
+        response = None
+        try:
+            response = session.request(method, url, **kwargs)
+            status = str(response.status_code)
+            return response
+        except requests.exceptions.RequestException:
+            self.errors += 1
+            raise
+        finally:
+            UPSTREAM_LATENCY.labels(call, device, status).observe(time.perf_counter() - started)
+            if response is not None:
+                upstream_guard.after(call, response.status_code, response.headers)
+            else:
+                upstream_guard.after(call)
+    
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+    
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+    
+    def stats(self):
+        """Connection reuse metrics for the current worker"""
+        connections_opened = 0
+        upstream_requests = 0
+        hosts = []
+        if self._session is not None and self._pid == os.getpid():
+            for adapter in set(self._session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in list(pools.keys()):
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+                    connections_opened += pool.num_connections
+                    upstream_requests += pool.num_requests
+                    hosts.append(pool.host)
+        reused = max(upstream_requests - connections_opened, 0)
+        return {
+            'pid': os.getpid(),
+            'requests': self.requests_sent,
+            'errors': self.errors,
+            'upstream_requests': upstream_requests,
+            'connections_opened': connections_opened,
+            'connections_reused': reused,
+            'reuse_ratio': round(reused / upstream_requests, 3) if upstream_requests else None,
+            'pooled_hosts': sorted(set(hosts)),
+            'pool_maxsize': config.HTTP_POOL_MAXSIZE,
+            'timeout': {'connect': self.timeout[0], 'read': self.timeout[1]}
+        }
+
+class UpstreamWarmer:
+    """Background thread that keeps connections to SmartThings warm
+    
+    Launches are rare and bursty, so idle pooled connections are usually
+    closed by the server before the next one. Every KEEP_WARM_INTERVAL
+    seconds this sends KEEP_WARM_CONNECTIONS concurrent unauthenticated HEAD
+    requests over each account's pooled session, which keeps that many
+    connections (and their TLS sessions) open, and refreshes the DNS cache
+    ahead of expiry.
+    The first round runs as soon as the thread starts, pre-connecting the
+    worker without blocking startup.
+    """
+    
+    def __init__(self, clients, dns_cache):
+        self.clients = clients  # PooledHTTPClient per account
+        self.dns_cache = dns_cache
+        self._thread = None
+        self.rounds = 0
+        self.pings = 0
+        self.failures = 0
+        self.last_round_at = None
+        self.last_error = None
+    
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+    
+    def start(self):
+        if config.KEEP_WARM_INTERVAL <= 0 or self.running:
+            return
+        self._thread = threading.Thread(target=self._run, name='upstream-warmer', daemon=True)
+        self._thread.start()
+        logger.info(f"Upstream keep-warm started (every {config.KEEP_WARM_INTERVAL:g}s, {config.KEEP_WARM_CONNECTIONS} connections)")
+    
+    def _run(self):
+        while True:
+            try:
+                self.warm()
+            except Exception:
+                logger.exception("Unexpected error in upstream keep-warm")
+            time.sleep(config.KEEP_WARM_INTERVAL)
+    
+    def _ping(self, http):
+        try:
+            http.request('HEAD', f"{config.ST_API_BASE_URL}/", call='keep_warm', timeout=http.timeout)
+            return None
+        except requests.exceptions.RequestException as e:
+            return str(e)
+    
+    def warm(self):
+        """Refresh DNS and touch KEEP_WARM_CONNECTIONS pooled connections concurrently"""
+        self.dns_cache.refresh(within=config.KEEP_WARM_INTERVAL * 1.5)
+        count = max(1, config.KEEP_WARM_CONNECTIONS)
+        targets = [http for http in self.clients for _ in range(count)]
+        with ThreadPoolExecutor(max_workers=len(targets), thread_name_prefix='keep-warm') as pool:
+            errors = [error for error in pool.map(self._ping, targets) if error]
+        self.rounds += 1
+        self.pings += len(targets)
+        self.failures += len(errors)
+        self.last_round_at = datetime.now().isoformat()
+        if errors:
+            self.last_error = errors[0]
+            logger.warning(f"Keep-warm ping failed: {errors[0]}")
+    
+    def stats(self):
+        return {
+            'running': self.running,
+            'interval': config.KEEP_WARM_INTERVAL,
+            'connections': config.KEEP_WARM_CONNECTIONS,
+            'sessions': len(self.clients),
+            'rounds': self.rounds,
+            'pings': self.pings,
+            'failures': self.failures,
+            'last_round_at': self.last_round_at,
+            'last_error': self.last_error,
+            'dns_cache': self.dns_cache.stats()
+        }
@@ -0,0 +1,234 @@
+"""
+Keep-alive TCP channel for the Edge Driver (HUB_CHANNEL_PORT)
+"""
+
+import asyncio
+import hmac
+import json
+import logging
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote
+
+from settings import config
+from resilience import error_status
+
+logger = logging.getLogger(__name__)
+
+class HubChannel:
+    """Keep-alive TCP channel for the Edge Driver on HUB_CHANNEL_PORT
+    
+    A hub keeps one connection open and sends one line per button press::
+    
+        <seq> launch <target> [action=launch] [app=<app id>] [async=1] [smart=1]
+                              [deadline=<seconds>] [ack=full] [rid=<request id>] [idem=<key>]
+        <seq> ping
+    
+    With HUB_CHANNEL_TOKEN set, the first line must be ``<seq> auth
+    token=<HUB_CHANNEL_TOKEN>``; anything else gets 401 and the connection is
+    closed. Without it the channel trusts every host that can reach the port.
+    The hub then gets ``<seq> <status> key=value ...`` back: the minimal launch ack
+    (``status=launched``, ``job_id``, ``deduplicated``, ``error``), or with
+    ack=full ``<seq> <status> {json}``, the /launch-tv-app document. Values
+    are percent-encoded. Requests on one connection may overlap (up to
+    HUB_CHANNEL_MAX_INFLIGHT); the sequence number pairs replies with them.
+    
+    Connections live on an asyncio loop in a background thread, so an idle
+    hub costs one socket; launches run on a small thread pool. Every worker
+    listens with SO_REUSEPORT and the kernel spreads hubs across them.
+    """
+    
+    MAX_LINE = 4096
+    
+    def __init__(self, port, launch):
+        self.port = port
+        self.launch = launch  # fields -> (payload, status_code, minimal)
+        self._thread = None
+        self._executor = None
+        self.listening = False
+        self.connections = 0
+        self.peak_connections = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.requests = 0
+        self.errors = 0
+        self.last_error = None
+    
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+    
+    def start(self):
+        if self.port <= 0 or self.running:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=max(1, config.HUB_CHANNEL_WORKERS), thread_name_prefix='hub-launch')
+        self._thread = threading.Thread(target=self._run, name='hub-channel', daemon=True)
+        self._thread.start()
+    
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(asyncio.start_server(
+                self._serve, config.HUB_CHANNEL_HOST, self.port, reuse_port=hasattr(socket, 'SO_REUSEPORT'),
+                limit=self.MAX_LINE
+            ))
+        except OSError as e:
+            # Another process holding the port without SO_REUSEPORT; HTTP keeps working
+            self.last_error = str(e)
+            logger.warning(f"Hub channel not listening on port {self.port}: {e}")
+            loop.close()
+            return
+        self.listening = True
+        logger.info(f"Hub channel listening on {config.HUB_CHANNEL_HOST}:{self.port} (pid={os.getpid()})")
+        loop.run_forever()
+    
+    @staticmethod
+    def parse(line):
+        """'7 launch s95 app=x' -> ('7', 'launch', {'target': 's95', 'app': 'x'})"""
+        parts = line.split()
+        if len(parts) < 2 or not parts[0].isdigit():
+            raise ValueError('expected "<seq> <op> [target] [key=value ...]"')
+        fields = {}
+        for part in parts[2:]:
+            key, sep, value = part.partition('=')
+            if sep:
+                fields[key] = unquote(value)
+            elif 'target' not in fields:
+                fields['target'] = unquote(part)
+            else:
+                raise ValueError(f'unexpected token {part!r}')
+        return parts[0], parts[1].lower(), fields
+    
+    @staticmethod
+    def format_reply(seq, status_code, payload=None, minimal=True):
+        """One reply line: key=value pairs of a minimal payload, else the JSON document"""
+        if payload and not minimal:
+            return f"{seq} {status_code} {json.dumps(payload, separators=(',', ':'), default=str)}\n".encode()
+        items = []
+        for key, value in (payload or {}).items():
+            if key == 'success' or value is None:
+                continue
+            if isinstance(value, bool):
+                value = int(value)
+            items.append(f"{key}={quote(str(value), safe='')}")
+        return ' '.join([seq, str(status_code), *items]).encode() + b'\n'
+    
+    async def _serve(self, reader, writer):
+        if self.connections >= config.HUB_CHANNEL_MAX_CONNECTIONS:
+            self.rejected += 1
+            writer.write(self.format_reply('0', 503, {'error': 'Too many hub connections'}))
+            writer.close()
+            return
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.connections += 1
+        self.accepted += 1
+        self.peak_connections = max(self.peak_connections, self.connections)
+        slots = asyncio.Semaphore(max(1, config.HUB_CHANNEL_MAX_INFLIGHT))
+        write_lock = asyncio.Lock()
+        pending = set()
+        authenticated = not config.HUB_CHANNEL_TOKEN
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), timeout=config.HUB_CHANNEL_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                except ValueError:
+                    # Line longer than MAX_LINE; the stream cannot be resynchronised
+                    await self._reply(writer, write_lock, self.format_reply('0', 400, {'error': 'Line too long'}))
+                    break
+                if not line:
+                    break
+                line = line.decode('utf-8', 'replace').strip()
+                if not line:
+                    continue
+                if not authenticated:
+                    # Handled inline: nothing else on the connection runs before it
+                    authenticated = await self._authenticate(line, writer, write_lock)
+                    if not authenticated:
+                        break
+                    continue
+                await slots.acquire()
+                task = asyncio.create_task(self._answer(line, writer, write_lock))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                task.add_done_callback(lambda _: slots.release())
+            if pending:
+                # Let launches already sent upstream report back before closing
+                await asyncio.gather(*pending, return_exceptions=True)
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+    
+    async def _authenticate(self, line, writer, write_lock):
+        """Check the connection's first line against HUB_CHANNEL_TOKEN; replies and returns whether it matched"""
+        try:
+            seq, op, fields = self.parse(line)
+        except ValueError:
+            seq, op, fields = '0', None, {}
+        token = fields.get('token', '')
+        if op == 'auth' and token and hmac.compare_digest(token.encode(), config.HUB_CHANNEL_TOKEN.encode()):
+            await self._reply(writer, write_lock, self.format_reply(seq, 200))
+            return True
+        self.rejected += 1
+        logger.warning("Hub channel connection rejected: missing or wrong token")
+        await self._reply(writer, write_lock, self.format_reply(seq, 401, {'error': 'Authenticate first with "<seq> auth token=..."'}))
+        return False
+    
+    async def _answer(self, line, writer, write_lock):
+        self.requests += 1
+        try:
+            seq, op, fields = self.parse(line)
+        except ValueError as e:
+            self.errors += 1
+            await self._reply(writer, write_lock, self.format_reply('0', 400, {'error': str(e)}))
+            return
+        if op in ('ping', 'auth'):
+            reply = self.format_reply(seq, 200)
+        elif op == 'launch':
+            try:
+                payload, status_code, minimal = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self.launch, fields)
+            except Exception as e:
+                logger.exception("Unexpected error in hub channel launch")
+                payload, status_code, minimal = {'success': False, 'error': str(e)}, error_status(e), True
+            if status_code >= 400:
+                self.errors += 1
+            reply = self.format_reply(seq, status_code, payload, minimal)
+        else:
+            self.errors += 1
+            reply = self.format_reply(seq, 400, {'error': f'Unknown operation {op!r}'})
+        await self._reply(writer, write_lock, reply)
+    
+    @staticmethod
+    async def _reply(writer, write_lock, data):
+        async with write_lock:
+            if writer.is_closing():
+                return
+            writer.write(data)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+    
+    def stats(self):
+        return {
+            'port': self.port,
+            'listening': self.listening,
+            'authenticated': bool(config.HUB_CHANNEL_TOKEN),
+            'connections': self.connections,
+            'peak_connections': self.peak_connections,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'requests': self.requests,
+            'errors': self.errors,
+            'last_error': self.last_error
+        }
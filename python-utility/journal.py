@@ -0,0 +1,358 @@
+"""
+Command journal: failed commands kept on disk and replayed in the background
+"""
+
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import requests
+
+from settings import config
+from logs import current_request_id
+from resilience import UpstreamUnavailable, retry_after_seconds
+from metrics import device_label
+
+logger = logging.getLogger(__name__)
+
+def replayable_error(error):
+    """Whether a failed command is worth replaying: network errors, 5xx, 429 and local circuit/rate rejections"""
+    if isinstance(error, UpstreamUnavailable):
+        return True
+    response = getattr(error, 'response', None)
+    if response is not None:
+        return response.status_code >= 500 or response.status_code == 429
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+def replay_retry_after(error):
+    """Seconds SmartThings (or the local circuit breaker) asked us to wait, if any"""
+    if isinstance(error, UpstreamUnavailable):
+        return error.retry_after
+    response = getattr(error, 'response', None)
+    return retry_after_seconds(response.headers) if response is not None else None
+
+def launch_queued(result):
+    """True when a launch or command result was left to the command journal's replayer"""
+    return isinstance(result, dict) and bool(result.get('queued') or (result.get('response') or {}).get('queued'))
+
+class CommandJournal:
+    """Crash-safe journal of outbound device commands, shared by all worker processes
+    
+    Every command payload is recorded in sqlite (WAL mode) before it is sent,
+    with the deadline after which it must no longer be delivered. Entry
+    states:
+    
+    - sending: being sent by a request worker
+    - pending: failed on a network error, 5xx or 429, waiting for the replayer
+    - replaying: claimed by a worker's CommandReplayer
+    - sent, failed, expired: finished, kept for JOURNAL_RETENTION seconds
+    
+    A command for a device that still has pending entries is queued behind
+    them instead of being sent, so a replay never overtakes a newer command.
+    Entries left in sending/replaying by a worker that died are handed back
+    to the replayer, which makes delivery at-least-once.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS commands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id TEXT NOT NULL,
+            source TEXT NOT NULL,
+            request_id TEXT,
+            payload TEXT NOT NULL,
+            state TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            deadline REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            claimed_at REAL,
+            finished_at REAL,
+            last_error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS commands_state ON commands (state, device_id, id);
+    """
+    ACTIVE_STATES = ('sending', 'pending', 'replaying')
+    
+    def __init__(self, path):
+        self.path = Path(path)
+        self._local = threading.local()
+        self._last_cleanup = 0.0
+        self.counters = {'recorded': 0, 'queued': 0, 'deferred': 0, 'replayed': 0, 'expired': 0, 'failed': 0}
+    
+    @property
+    def stale_after(self):
+        """Seconds after which an unfinished claim is assumed to belong to a dead worker"""
+        return (config.HTTP_CONNECT_TIMEOUT + config.HTTP_READ_TIMEOUT) * (config.HTTP_RETRIES + 2) + config.UPSTREAM_RATE_MAX_WAIT
+    
+    def _connection(self):
+        """One connection per thread and process (sqlite connections must not cross a fork)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=config.TOKEN_LOCK_TIMEOUT, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Commits survive a process crash; only a power loss can drop the last few
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(self.SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+    
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    
+    def record(self, device_id, payload, source, replay_deadline):
+        """Journal a command before it is sent; returns (entry_id, queued)
+        
+        queued is True when earlier commands for the device are waiting to be
+        replayed: the caller must not send, the replayer delivers it in order.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            waiting = conn.execute(
+                "SELECT 1 FROM commands WHERE device_id = ? AND state IN ('pending', 'replaying') LIMIT 1",
+                (device_id,)
+            ).fetchone()
+            state = 'pending' if waiting and replay_deadline > 0 else 'sending'
+            cursor = conn.execute(
+                "INSERT INTO commands (device_id, source, request_id, payload, state, created_at, deadline, "
+                "next_attempt_at, claimed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (device_id, source, current_request_id(), json.dumps(payload), state, now,
+                 now + max(0.0, replay_deadline), now, now)
+            )
+        self.counters['recorded'] += 1
+        if state == 'pending':
+            self.counters['queued'] += 1
+        return cursor.lastrowid, state == 'pending'
+    
+    def finish(self, entry_ids, state, error=None):
+        """Mark entries sent or failed"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE commands SET state = ?, finished_at = ?, last_error = ? WHERE id = ?",
+                [(state, now, error, entry_id) for entry_id in entry_ids]
+            )
+        if state == 'failed':
+            self.counters['failed'] += len(entry_ids)
+    
+    def defer(self, entry_ids, error, retry_after=None):
+        """Hand failed entries to the replayer with backoff; returns False if they expired instead"""
+        now = time.time()
+        deferred = False
+        with self._transaction() as conn:
+            for entry_id in entry_ids:
+                row = conn.execute("SELECT attempts, deadline FROM commands WHERE id = ?", (entry_id,)).fetchone()
+                if row is None:
+                    continue
+                attempts = row['attempts'] + 1
+                delay = min(config.JOURNAL_RETRY_BACKOFF * (2 ** (attempts - 1)), config.JOURNAL_RETRY_MAX)
+                delay = max(delay * random.uniform(0.5, 1.0), retry_after or 0)
+                if now + delay >= row['deadline']:
+                    conn.execute(
+                        "UPDATE commands SET state = 'expired', attempts = ?, finished_at = ?, last_error = ? WHERE id = ?",
+                        (attempts, now, error, entry_id)
+                    )
+                    self.counters['expired'] += 1
+                else:
+                    conn.execute(
+                        "UPDATE commands SET state = 'pending', attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                        (attempts, now + delay, error, entry_id)
+                    )
+                    self.counters['deferred'] += 1
+                    deferred = True
+        return deferred
+    
+    def claim(self, max_commands):
+        """Claim due pending entries for replay, merged per device; returns [{device_id, entry_ids, commands}]
+        
+        Only a device's oldest pending entries are claimed, and only when the
+        first one is due and no other worker is replaying that device.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            expired = conn.execute(
+                "UPDATE commands SET state = 'expired', finished_at = ? WHERE state = 'pending' AND deadline <= ?",
+                (now, now)
+            ).rowcount
+            self.counters['expired'] += expired
+            conn.execute(
+                "UPDATE commands SET state = 'pending', last_error = 'worker stopped before finishing' "
+                "WHERE state IN ('sending', 'replaying') AND claimed_at < ?",
+                (now - self.stale_after,)
+            )
+            rows = conn.execute(
+                "SELECT id, device_id, payload, next_attempt_at FROM commands WHERE state = 'pending' "
+                "AND device_id NOT IN (SELECT device_id FROM commands WHERE state = 'replaying') ORDER BY id"
+            ).fetchall()
+            
+            batches = {}
+            blocked = set()
+            for row in rows:
+                device_id = row['device_id']
+                if device_id in blocked:
+                    continue
+                batch = batches.get(device_id)
+                if batch is None and row['next_attempt_at'] > now:
+                    blocked.add(device_id)
+                    continue
+                commands = json.loads(row['payload']).get('commands', [])
+                if batch is None:
+                    batch = batches[device_id] = {'device_id': device_id, 'entry_ids': [], 'commands': []}
+                elif len(batch['commands']) + len(commands) > max_commands:
+                    blocked.add(device_id)
+                    continue
+                batch['entry_ids'].append(row['id'])
+                batch['commands'].extend(commands)
+            
+            conn.executemany(
+                "UPDATE commands SET state = 'replaying', claimed_at = ? WHERE id = ?",
+                [(now, entry_id) for batch in batches.values() for entry_id in batch['entry_ids']]
+            )
+        return list(batches.values())
+    
+    def next_due_in(self):
+        """Seconds until the next pending entry is due (None when nothing is pending)"""
+        row = self._connection().execute(
+            "SELECT MIN(next_attempt_at) FROM commands WHERE state = 'pending'"
+        ).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+    
+    def cleanup(self):
+        """Delete finished entries older than JOURNAL_RETENTION (at most once a minute)"""
+        now = time.time()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        with self._transaction() as conn:
+            conn.execute(
+                "DELETE FROM commands WHERE state IN ('sent', 'failed', 'expired') AND finished_at < ?",
+                (now - config.JOURNAL_RETENTION,)
+            )
+    
+    def queued_result(self, entry_id, error):
+        """Result reported to the caller for a command left to the replayer"""
+        row = self._connection().execute("SELECT deadline FROM commands WHERE id = ?", (entry_id,)).fetchone()
+        return {
+            'queued': True,
+            'journal_id': entry_id,
+            'replay_until': datetime.fromtimestamp(row['deadline']).isoformat() if row else None,
+            'error': error
+        }
+    
+    def stats(self):
+        try:
+            rows = self._connection().execute("SELECT state, COUNT(*) FROM commands GROUP BY state").fetchall()
+        except sqlite3.Error as e:
+            return dict(self.counters, error=str(e))
+        return dict(self.counters, path=str(self.path), entries={state: count for state, count in rows})
+
+class CommandReplayer:
+    """Background thread that drains pending journal entries once SmartThings is reachable again
+    
+    Woken when a request defers a command, and otherwise every
+    JOURNAL_POLL_INTERVAL seconds to pick up entries deferred by other
+    workers. Each round merges a device's consecutive pending commands into
+    one request of at most COMMAND_BATCH_MAX commands.
+    """
+    
+    def __init__(self, api, journal):
+        self.api = api
+        self.journal = journal
+        self._wake = threading.Event()
+        self._thread = None
+        self.rounds = 0
+        self.last_round_at = None
+        self.last_error = None
+    
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+    
+    def start(self):
+        if self.running:
+            return
+        self._thread = threading.Thread(target=self._run, name='command-replayer', daemon=True)
+        self._thread.start()
+        logger.info("Command journal replayer started")
+    
+    def wake(self):
+        self._wake.set()
+    
+    def _run(self):
+        while True:
+            try:
+                self.drain()
+                due_in = self.journal.next_due_in()
+                self.journal.cleanup()
+            except Exception as e:
+                logger.exception("Unexpected error in command replayer")
+                self.last_error = str(e)
+                due_in = None
+            timeout = config.JOURNAL_POLL_INTERVAL if due_in is None else min(due_in, config.JOURNAL_POLL_INTERVAL)
+            self._wake.wait(max(0.05, timeout))
+            self._wake.clear()
+    
+    def drain(self):
+        """Replay every due entry; deferred entries come back once their backoff has passed"""
+        while True:
+            batches = self.journal.claim(max(1, config.COMMAND_BATCH_MAX))
+            if not batches:
+                return
+            self.rounds += 1
+            self.last_round_at = datetime.now().isoformat()
+            for batch in batches:
+                self._replay(batch)
+    
+    def _replay(self, batch):
+        device_id, entry_ids = batch['device_id'], batch['entry_ids']
+        try:
+            self.api._post_commands(device_id, {'commands': batch['commands']})
+        except requests.exceptions.RequestException as e:
+            self.last_error = str(e)
+            if replayable_error(e):
+                if not self.journal.defer(entry_ids, str(e), replay_retry_after(e)):
+                    logger.warning(f"Dropped {len(entry_ids)} journaled command(s) for {device_label(device_id)}: past their deadline")
+            else:
+                logger.error(f"Replay of {len(entry_ids)} journaled command(s) rejected: {e}")
+                self.journal.finish(entry_ids, 'failed', str(e))
+            return
+        except Exception as e:
+            # Local failures (no token yet, token lock busy) back off like a
+            # network error instead of leaving the entries in 'replaying'
+            self.last_error = str(e)
+            logger.warning(f"Replay to {device_label(device_id)} could not be sent ({e}), retrying later")
+            if not self.journal.defer(entry_ids, str(e)):
+                logger.warning(f"Dropped {len(entry_ids)} journaled command(s) for {device_label(device_id)}: past their deadline")
+            return
+        finally:
+            self.api.state_changed(device_id)
+        self.journal.finish(entry_ids, 'sent')
+        self.journal.counters['replayed'] += len(entry_ids)
+        logger.info(f"Replayed {len(entry_ids)} journaled command(s) to {device_label(device_id)}")
+    
+    def stats(self):
+        return {
+            'running': self.running,
+            'rounds': self.rounds,
+            'last_round_at': self.last_round_at,
+            'last_error': self.last_error
+        }
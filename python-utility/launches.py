@@ -0,0 +1,344 @@
+"""
+Launch deduplication and the background launch job queue
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+from settings import config
+from logs import current_request_id, log_context
+from storage import atomic_write_json, file_lock
+from journal import launch_queued
+
+logger = logging.getLogger(__name__)
+
+class LaunchDeduplicator:
+    """Coalesces identical launches onto one upstream call
+    
+    A launch whose key matches one that is in flight waits for it and
+    shares its outcome ("coalesced"); one that matches a launch that
+    succeeded less than window seconds ago gets that result back
+    ("replayed"). Failures are shared with waiters but never replayed, so
+    a retry after a failure goes upstream. With a state directory the
+    leader also holds a per-key flock and publishes its result there, which
+    extends both behaviours to the other gunicorn workers. A launch that
+    gives up waiting for the one in flight (here or in another worker)
+    fails with state "in_progress" instead of going upstream a second time.
+    """
+    
+    class _Flight:
+        def __init__(self):
+            self.done = threading.Event()
+            self.future = None
+            self.outcome = None
+    
+    def __init__(self, state_dir=None):
+        self.state_dir = Path(state_dir) if state_dir else None
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._recent = {}  # key -> (outcome, replay_until)
+        self._last_cleanup = 0.0
+        self.counters = {'coalesced': 0, 'replayed': 0}
+    
+    def _check(self, key, now):
+        """Return (outcome, state, flight, leader); caller must hold the lock"""
+        for k, (_, until) in list(self._recent.items()):
+            if until <= now:
+                del self._recent[k]
+        recent = self._recent.get(key)
+        if recent is not None:
+            self.counters['replayed'] += 1
+            return recent[0], 'replayed', None, False
+        flight = self._inflight.get(key)
+        if flight is not None:
+            self.counters['coalesced'] += 1
+            return None, None, flight, False
+        flight = self._Flight()
+        self._inflight[key] = flight
+        return None, None, flight, True
+    
+    def _finish(self, key, window, flight, outcome):
+        with self._lock:
+            if self._inflight.get(key) is flight:
+                del self._inflight[key]
+            if outcome[0]:
+                self._recent[key] = (outcome, time.monotonic() + window)
+        flight.outcome = outcome
+        flight.done.set()
+        if flight.future is not None and not flight.future.done():
+            flight.future.set_result(outcome)
+    
+    def run(self, key, window, launch):
+        """Run launch() -> (success, result) unless deduplicated
+        
+        Returns (success, result, state) where state is None for a fresh
+        launch, "coalesced" or "replayed".
+        """
+        if window <= 0:
+            return (*launch(), None)
+        with self._lock:
+            outcome, state, flight, leader = self._check(key, time.monotonic())
+        if state == 'replayed':
+            return (*outcome, state)
+        if not leader:
+            flight.done.wait(config.HTTP_CONNECT_TIMEOUT + 2 * config.HTTP_READ_TIMEOUT)
+            if flight.outcome is None:
+                return False, 'Identical launch still in progress', 'in_progress'
+            return (*flight.outcome, 'coalesced')
+        
+        outcome, state = (False, 'Launch did not complete'), None
+        try:
+            outcome, state = self._run_shared(key, window, launch)
+        finally:
+            self._finish(key, window, flight, outcome)
+        return (*outcome, state)
+    
+    def _run_shared(self, key, window, launch):
+        """Run launch() under the cross-worker lock for key, reusing a fresh shared result"""
+        if self.state_dir is None:
+            return launch(), None
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        result_path = self.state_dir / f'{digest}.json'
+        locked = False
+        try:
+            with file_lock(self.state_dir / f'{digest}.lock', config.HTTP_CONNECT_TIMEOUT + 2 * config.HTTP_READ_TIMEOUT):
+                locked = True
+                try:
+                    with open(result_path, 'r') as f:
+                        shared = json.load(f)
+                    if time.time() - shared['finished_at'] < window:
+                        self.counters['replayed'] += 1
+                        return (True, shared['result']), 'replayed'
+                except (FileNotFoundError, ValueError, KeyError):
+                    pass
+                outcome = launch()
+                if outcome[0]:
+                    try:
+                        atomic_write_json(result_path, {'key': key, 'result': outcome[1], 'finished_at': time.time()}, fsync=False)
+                    except Exception as e:
+                        logger.error(f"Failed to share launch result: {e}")
+        except TimeoutError:
+            if locked:
+                raise  # From launch() itself, e.g. the token lock
+            # Another worker is still running this launch; don't send it twice
+            logger.warning("Identical launch still in progress in another worker, not sending it again")
+            return (False, 'Identical launch still in progress'), 'in_progress'
+        self._cleanup()
+        return outcome, None
+    
+    def _cleanup(self):
+        """Remove shared results older than IDEMPOTENCY_TTL (at most once a minute)"""
+        now = time.time()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        cutoff = now - max(config.IDEMPOTENCY_TTL, config.LAUNCH_DEDUP_WINDOW)
+        try:
+            for path in self.state_dir.iterdir():
+                if path.stat().st_mtime < cutoff:
+                    path.unlink(missing_ok=True)
+        except OSError as e:
+            logger.error(f"Failed to clean up launch dedup state: {e}")
+    
+    async def arun(self, key, window, launch):
+        """Async variant of run() for a coroutine launch (per-process only)"""
+        if window <= 0:
+            return (*(await launch()), None)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            outcome, state, flight, leader = self._check(key, time.monotonic())
+            if leader:
+                flight.future = loop.create_future()
+        if state == 'replayed':
+            return (*outcome, state)
+        if not leader:
+            wait_seconds = config.HTTP_CONNECT_TIMEOUT + 2 * config.HTTP_READ_TIMEOUT
+            if flight.future is not None and flight.future.get_loop() is loop:
+                try:
+                    await asyncio.wait_for(asyncio.shield(flight.future), wait_seconds)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.to_thread(flight.done.wait, wait_seconds)
+            if flight.outcome is None:
+                return False, 'Identical launch still in progress', 'in_progress'
+            return (*flight.outcome, 'coalesced')
+        
+        outcome = (False, 'Launch did not complete')
+        try:
+            outcome = await launch()
+        finally:
+            self._finish(key, window, flight, outcome)
+        return (*outcome, None)
+    
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, in_flight=len(self._inflight), window=config.LAUNCH_DEDUP_WINDOW)
+
+class LaunchJobQueue:
+    """In-process queue that runs launches in the background for 202-style requests
+    
+    Worker threads pull planned launches off a bounded queue and retry
+    failures with exponential backoff. Each job record is written to
+    JOB_STATE_DIR on every state change, so a status poll answered by a
+    different gunicorn worker still finds it.
+    """
+    
+    def __init__(self, launcher, state_dir, workers=2, maxsize=100):
+        self.launcher = launcher  # plan -> (success, result, dedup_state)
+        self.state_dir = Path(state_dir)
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self._last_cleanup = 0.0
+    
+    def _ensure_workers(self):
+        """Start worker threads lazily (and again after a fork)"""
+        pid = os.getpid()
+        if self._pid == pid and all(t.is_alive() for t in self._threads):
+            return
+        with self._lock:
+            if self._pid == pid and all(t.is_alive() for t in self._threads):
+                return
+            self._threads = [t for t in self._threads if t.is_alive()] if self._pid == pid else []
+            for i in range(len(self._threads), self.workers):
+                thread = threading.Thread(target=self._worker, name=f'launch-job-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = pid
+    
+    def submit(self, plan):
+        """Queue a planned launch; returns the job record, or None if the queue is full"""
+        self._ensure_workers()
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'request_id': current_request_id(),
+            'status': 'queued',
+            'target': plan['target'],
+            'device': plan['device_name'],
+            'app_id': plan['app_id'],
+            'action': plan['action'],
+            'attempts': 0,
+            'max_attempts': config.JOB_MAX_ATTEMPTS,
+            'created_at': datetime.now().isoformat(),
+            'started_at': None,
+            'finished_at': None,
+            'duration_ms': None,
+            'error': None,
+            'result': None
+        }
+        with self._lock:
+            self._jobs[job['job_id']] = job
+        self._persist(job)
+        try:
+            self._queue.put_nowait((job, plan, time.monotonic()))
+        except queue.Full:
+            job.update(status='rejected', error='Launch queue is full', finished_at=datetime.now().isoformat())
+            self._persist(job)
+            return None
+        return dict(job)
+    
+    def get(self, job_id):
+        """Job record from this worker, or from the shared state directory"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+        if not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        try:
+            with open(self.state_dir / f'{job_id}.json', 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+    
+    def _persist(self, job):
+        try:
+            atomic_write_json(self.state_dir / f"{job['job_id']}.json", job, fsync=False)
+        except Exception as e:
+            logger.error(f"Failed to persist job {job['job_id']}: {e}")
+    
+    def _worker(self):
+        while True:
+            job, plan, enqueued = self._queue.get()
+            # Log under the ID of the request that queued the job
+            token = log_context.set({'request_id': job.get('request_id') or job['job_id'][:16], 'route': 'job', 'sampled': True})
+            try:
+                self._run(job, plan, enqueued)
+            except Exception as e:
+                logger.exception(f"Unexpected error in launch job {job['job_id']}")
+                job.update(status='failed', error=str(e), finished_at=datetime.now().isoformat())
+                self._persist(job)
+            finally:
+                log_context.reset(token)
+                self._queue.task_done()
+                self._cleanup()
+    
+    def _run(self, job, plan, enqueued):
+        started = time.monotonic()
+        job.update(status='running', started_at=datetime.now().isoformat(),
+                   queue_wait_ms=round((started - enqueued) * 1000, 1))
+        self._persist(job)
+        
+        while True:
+            job['attempts'] += 1
+            success, result, dedup_state = self.launcher(plan)
+            if success:
+                job.update(status='deferred' if launch_queued(result) else 'succeeded',
+                           result=result, error=None, deduplicated=dedup_state)
+                break
+            job['error'] = result
+            if job['attempts'] >= config.JOB_MAX_ATTEMPTS:
+                job['status'] = 'failed'
+                break
+            backoff = config.JOB_RETRY_BACKOFF * (2 ** (job['attempts'] - 1))
+            logger.warning(f"Launch job {job['job_id']} attempt {job['attempts']} failed, retrying in {backoff:.1f}s")
+            job['status'] = 'retrying'
+            self._persist(job)
+            time.sleep(backoff)
+        
+        job.update(finished_at=datetime.now().isoformat(),
+                   duration_ms=round((time.monotonic() - started) * 1000, 1))
+        self._persist(job)
+        logger.info(f"Launch job {job['job_id']} {job['status']} after {job['attempts']} attempt(s)")
+    
+    def _cleanup(self):
+        """Forget finished jobs older than JOB_RETENTION (at most once a minute)"""
+        now = time.time()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        cutoff = now - config.JOB_RETENTION
+        with self._lock:
+            for job_id, job in list(self._jobs.items()):
+                if job['finished_at'] and datetime.fromisoformat(job['finished_at']).timestamp() < cutoff:
+                    del self._jobs[job_id]
+        try:
+            for path in self.state_dir.glob('*.json'):
+                if path.stat().st_mtime < cutoff:
+                    path.unlink(missing_ok=True)
+        except OSError as e:
+            logger.error(f"Failed to clean up job state: {e}")
+    
+    def stats(self):
+        with self._lock:
+            statuses = {}
+            for job in self._jobs.values():
+                statuses[job['status']] = statuses.get(job['status'], 0) + 1
+        return {
+            'queued': self._queue.qsize(),
+            'workers': self.workers,
+            'jobs': statuses
+        }
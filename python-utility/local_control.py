@@ -0,0 +1,183 @@
+"""
+Direct LAN control of Samsung TVs, bypassing the SmartThings cloud
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+
+import requests
+
+from settings import config
+from resilience import CircuitBreaker
+from registry import device_registry
+
+logger = logging.getLogger(__name__)
+
+class LocalControlError(Exception):
+    """A launch over the LAN failed; the caller falls back to the cloud"""
+
+class LocalTVTransport:
+    """Direct LAN control of Samsung TVs, bypassing the SmartThings cloud
+    
+    Talks to the TV's REST API (http://<host>:8001/api/v2/) to read the power
+    state and launch apps, and powers it on with Wake-on-LAN. Only registry
+    devices with a "local" block are handled, and only command batches made
+    of switch on / launchApp. launch_app returns None when a launch is not
+    attempted locally and (False, error) when it fails, so SmartThingsAPI
+    can fall back to the cloud in both cases. A device that keeps failing
+    is skipped for BREAKER_OPEN_SECONDS by its own circuit breaker.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        self._breakers = {}
+        self.attempts = 0
+        self.successes = 0
+        self.failures = 0
+        self.last_error = None
+    
+    @property
+    def session(self):
+        pid = os.getpid()
+        if self._session is None or self._pid != pid:
+            with self._lock:
+                if self._session is None or self._pid != pid:
+                    self._session = requests.Session()
+                    self._pid = pid
+        return self._session
+    
+    def _breaker(self, key):
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = CircuitBreaker(f'local:{key}')
+            return breaker
+    
+    @staticmethod
+    def device_entry(device_id):
+        """Registry entry for device_id if it can be controlled locally"""
+        if not config.LOCAL_CONTROL:
+            return None
+        entry = device_registry.get(device_id)
+        if entry is None or entry.device_id != device_id or not entry.local:
+            return None
+        return entry
+    
+    @staticmethod
+    def plan_commands(payload):
+        """(power_on, app_id) for a command batch, or None if it has commands the LAN API can't send"""
+        power_on = False
+        app_id = None
+        for command in payload.get('commands', []):
+            name = (command.get('capability'), command.get('command'))
+            if name == ('switch', 'on'):
+                power_on = True
+            elif name == ('custom.launchapp', 'launchApp') and command.get('arguments'):
+                app_id = command['arguments'][0]
+            else:
+                return None
+        return power_on, app_id
+    
+    @staticmethod
+    def wake(mac, broadcast):
+        """Send a Wake-on-LAN magic packet"""
+        mac_bytes = bytes.fromhex(mac.replace(':', '').replace('-', ''))
+        if len(mac_bytes) != 6:
+            raise LocalControlError(f"Invalid MAC address: {mac}")
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.sendto(b'\xff' * 6 + mac_bytes * 16, (broadcast, 9))
+    
+    def _power_state(self, base_url, timeout=None):
+        """'on', 'standby' or None when the TV does not answer"""
+        try:
+            response = self.session.get(f"{base_url}/", timeout=timeout or config.LOCAL_TV_TIMEOUT)
+            response.raise_for_status()
+            # Older models have no PowerState and only answer while on
+            return response.json().get('device', {}).get('PowerState', 'on')
+        except (requests.exceptions.RequestException, ValueError):
+            return None
+    
+    def _launch(self, entry, power_on, app_id, deadline=None):
+        local = entry.local
+        base_url = f"http://{local['host']}:{local.get('port', config.LOCAL_TV_PORT)}/api/v2"
+        state = self._power_state(base_url)
+        woke = False
+        if state != 'on':
+            if not power_on:
+                raise LocalControlError(f"{entry.name} is {state or 'unreachable'}")
+            if not local.get('mac'):
+                raise LocalControlError(f"{entry.name} is {state or 'unreachable'} and has no MAC for Wake-on-LAN")
+            try:
+                self.wake(local['mac'], local.get('broadcast', config.LOCAL_TV_BROADCAST))
+            except OSError as e:
+                raise LocalControlError(f"Wake-on-LAN failed: {e}")
+            woke = True
+            wake_started = time.monotonic()
+            wait_until = wake_started + config.LOCAL_TV_WAKE_TIMEOUT
+            if deadline is not None:
+                # Leave time for the app launch request
+                wait_until = min(wait_until, deadline - config.LOCAL_TV_TIMEOUT)
+            while state != 'on':
+                remaining = wait_until - time.monotonic()
+                if remaining <= 0:
+                    raise LocalControlError(f"{entry.name} did not wake within {time.monotonic() - wake_started:.1f}s")
+                time.sleep(min(0.5, remaining))
+                state = self._power_state(base_url, max(0.1, min(config.LOCAL_TV_TIMEOUT, wait_until - time.monotonic())))
+        
+        if app_id:
+            try:
+                response = self.session.post(f"{base_url}/applications/{app_id}", timeout=config.LOCAL_TV_TIMEOUT)
+            except requests.exceptions.RequestException as e:
+                raise LocalControlError(f"App launch request failed: {e}")
+            if response.status_code >= 300:
+                raise LocalControlError(f"TV rejected app launch: HTTP {response.status_code}")
+        
+        return {'transport': 'local', 'host': local['host'], 'woke': woke, 'app_id': app_id}
+    
+    def launch_app(self, device_id, app_id, payload, deadline=None):
+        """Launch over the LAN; returns (success, result), or None if not attempted
+        
+        deadline (time.monotonic()) cuts the Wake-on-LAN wait short so the
+        caller still has time for the cloud fallback.
+        """
+        entry = self.device_entry(device_id)
+        if entry is None:
+            return None
+        commands = self.plan_commands(payload)
+        if commands is None:
+            return None
+        breaker = self._breaker(entry.key)
+        allowed, _ = breaker.allow()
+        if not allowed:
+            return None
+        
+        self.attempts += 1
+        try:
+            result = self._launch(entry, *commands, deadline)
+        except LocalControlError as e:
+            breaker.record(True)
+            self.failures += 1
+            self.last_error = f"{entry.key}: {e}"
+            return False, str(e)
+        breaker.record(False)
+        self.successes += 1
+        logger.info(f"Launched {commands[1] or 'power on'} on {entry.name} over the LAN")
+        return True, result
+    
+    def stats(self):
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {
+            'enabled': config.LOCAL_CONTROL,
+            'attempts': self.attempts,
+            'successes': self.successes,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'devices': {key: breaker.state for key, breaker in sorted(breakers.items())}
+        }
@@ -0,0 +1,153 @@
+"""
+Logging with request context, sampling and redaction
+Records are stamped with the request ID and route of the request being
+served (see start_log_context). INFO/DEBUG records of requests that were not
+sampled are dropped; warnings and errors are always kept. Secrets and full
+device IDs are redacted when a record is written.
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import uuid
+from datetime import datetime
+
+from settings import config
+
+logger = logging.getLogger(__name__)
+
+log_context = contextvars.ContextVar('log_context', default=None)
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+TEXT_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(request_id)s - %(message)s'
+
+def parse_sample_rates(spec):
+    """'/health=0,/device-status=0.1' -> {'/health': 0.0, '/device-status': 0.1}"""
+    rates = {}
+    for item in spec.split(','):
+        route, _, rate = item.strip().partition('=')
+        if route and rate:
+            try:
+                rates[route.strip()] = float(rate)
+            except ValueError:
+                logger.warning(f"Ignoring invalid LOG_SAMPLE_RATES entry: {item}")
+    return rates
+
+log_sample_rates = parse_sample_rates(config.LOG_SAMPLE_RATES)
+
+def start_log_context(headers, route):
+    """Begin logging for a request; returns (request_id, token for log_context.reset)
+    
+    The caller's X-Request-ID (the Edge Driver sends one) is kept so its logs
+    and ours line up; otherwise a new ID is generated.
+    """
+    request_id = headers.get('X-Request-ID') or ''
+    if not REQUEST_ID_PATTERN.match(request_id):
+        request_id = uuid.uuid4().hex[:16]
+    sampled = random.random() < log_sample_rates.get(route, config.LOG_SAMPLE_RATE)
+    token = log_context.set({'request_id': request_id, 'route': route, 'sampled': sampled})
+    return request_id, token
+
+def current_request_id():
+    context = log_context.get()
+    return context['request_id'] if context else None
+
+class RequestContextFilter(logging.Filter):
+    """Add request_id/route to records and drop INFO/DEBUG records of unsampled requests"""
+    
+    def filter(self, record):
+        context = log_context.get()
+        record.request_id = context['request_id'] if context else '-'
+        record.route = context['route'] if context else None
+        if context and not context['sampled'] and record.levelno < logging.WARNING:
+            return False
+        return True
+
+class LogRedactor:
+    """Removes credentials from log output and shortens device IDs"""
+    
+    PATTERNS = (
+        (re.compile(r'(Bearer\s+)[^\s"\',]+', re.IGNORECASE), r'\1[REDACTED]'),
+        (re.compile(r'\b((?:access_token|refresh_token|client_secret|password)["\']?\s*[:=]\s*["\']?)[^"\'&\s,}]+'), r'\1[REDACTED]'),
+        (re.compile(r'(["\']code["\']\s*:\s*["\']|[?&]code=)[^"\'&\s,}]+'), r'\1[REDACTED]'),
+    )
+    # SmartThings device IDs (and PATs) are UUIDs; keep the first 8 characters like /config does
+    UUID_PATTERN = re.compile(r'\b([0-9a-fA-F]{8})-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b')
+    
+    def __init__(self):
+        # Returns the live secrets (tokens change on refresh); set once the API client exists
+        self.secrets_source = lambda: ()
+    
+    def redact(self, text):
+        for secret in (config.ST_PAT, config.ST_CLIENT_SECRET, config.ST_REFRESH_TOKEN, config.ST_WEBHOOK_TOKEN, *self.secrets_source()):
+            if secret and len(secret) >= 8 and secret in text:
+                text = text.replace(secret, '[REDACTED]')
+        for pattern, replacement in self.PATTERNS:
+            text = pattern.sub(replacement, text)
+        return self.UUID_PATTERN.sub(r'\1...', text)
+
+log_redactor = LogRedactor()
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record):
+        return log_redactor.redact(super().format(record))
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line; `extra` fields passed to the logger become keys"""
+    
+    STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id', 'route'}
+    
+    def format(self, record):
+        document = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        if getattr(record, 'request_id', '-') != '-':
+            document['request_id'] = record.request_id
+        if getattr(record, 'route', None):
+            document['route'] = record.route
+        for key, value in record.__dict__.items():
+            if key not in self.STANDARD_ATTRIBUTES:
+                document[key] = value
+        if record.exc_info:
+            document['exc'] = self.formatException(record.exc_info)
+        # Redact before encoding: the patterns expect unescaped quotes
+        for key, value in document.items():
+            if isinstance(value, str):
+                document[key] = log_redactor.redact(value)
+        return json.dumps(document, default=str)
+
+def configure_logging():
+    """Install the root handler: filter in the caller's thread, format and write in a listener thread
+    
+    With LOG_ASYNC a request only pays for putting the record on a queue;
+    formatting, redaction and the write to a slow disk happen in the
+    QueueListener thread.
+    """
+    output = logging.StreamHandler()
+    if config.LOG_FORMAT == 'json':
+        output.setFormatter(JsonLogFormatter())
+    else:
+        output.setFormatter(TextLogFormatter(TEXT_LOG_FORMAT))
+    
+    if config.LOG_ASYNC:
+        log_queue = queue.SimpleQueue()
+        handler = logging.handlers.QueueHandler(log_queue)
+        listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        handler = output
+    handler.addFilter(RequestContextFilter())
+    
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(config.LOG_LEVEL)
+
+configure_logging()
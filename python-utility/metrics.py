@@ -0,0 +1,79 @@
+"""
+Prometheus metrics
+Under gunicorn, set PROMETHEUS_MULTIPROC_DIR so /metrics aggregates all workers
+(the Docker image does this, see gunicorn.conf.py).
+"""
+
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest,
+    multiprocess
+)
+
+from registry import device_registry
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+HTTP_REQUESTS = Counter(
+    'launcher_http_requests_total', 'Requests served by the utility',
+    ['route', 'method', 'status']
+)
+HTTP_REQUEST_LATENCY = Histogram(
+    'launcher_http_request_duration_seconds', 'Request latency per route',
+    ['route', 'method'], buckets=LATENCY_BUCKETS
+)
+HTTP_IN_FLIGHT = Gauge(
+    'launcher_http_requests_in_flight', 'Requests currently being served',
+    ['route'], multiprocess_mode='livesum'
+)
+UPSTREAM_LATENCY = Histogram(
+    'launcher_upstream_request_duration_seconds', 'SmartThings HTTP call latency per call type',
+    ['call', 'device', 'status'], buckets=LATENCY_BUCKETS
+)
+OPERATION_LATENCY = Histogram(
+    'launcher_operation_duration_seconds', 'Latency of launch_app / get_device_status including retries and cache',
+    ['operation', 'device', 'outcome'], buckets=LATENCY_BUCKETS
+)
+UPSTREAM_REJECTIONS = Counter(
+    'launcher_upstream_rejected_total', 'SmartThings calls refused locally by the circuit breaker or rate limiter',
+    ['call', 'reason']
+)
+LAUNCH_TRANSPORT_LATENCY = Histogram(
+    'launcher_launch_transport_duration_seconds', 'Launch latency per transport (local LAN or SmartThings cloud)',
+    ['transport', 'device', 'outcome'], buckets=LATENCY_BUCKETS
+)
+TOKEN_REFRESHES = Counter(
+    'launcher_token_refresh_total', 'OAuth token refresh attempts',
+    ['trigger', 'outcome']
+)
+TOKEN_REFRESH_LATENCY = Histogram(
+    'launcher_token_refresh_duration_seconds', 'OAuth token refresh duration (including lock wait)',
+    ['outcome'], buckets=LATENCY_BUCKETS
+)
+
+def device_label(device_id):
+    """Registry name for a device ID, used as the metrics label"""
+    if not device_id:
+        return 'none'
+    entry = device_registry.get(device_id)
+    return entry.key if entry is not None else 'unknown'
+
+def observe_operation(operation, device_id, outcome, started):
+    """Record one launch_app / get_device_status call started at time.perf_counter() value started"""
+    OPERATION_LATENCY.labels(operation, device_label(device_id), outcome).observe(time.perf_counter() - started)
+
+def observe_transport(transport, device_id, success, started):
+    LAUNCH_TRANSPORT_LATENCY.labels(transport, device_label(device_id), 'success' if success else 'failure').observe(
+        time.perf_counter() - started
+    )
+
+def metrics_payload():
+    """Prometheus text exposition of all metrics (all workers in multiprocess mode)"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,237 @@
+"""
+Launch targets: device entries and the device registry
+"""
+
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from settings import config
+from credentials import DEFAULT_ACCOUNT
+
+logger = logging.getLogger(__name__)
+
+def build_launch_payload(app_id):
+    """Command batch that powers the TV on and launches app_id"""
+    # Send both power on and app launch commands
+    # Based on your existing tv-app-launch.py implementation
+    return {
+        "commands": [
+            {
+                "component": "main",
+                "capability": "switch",
+                "command": "on"
+            },
+            {
+                "component": "main",
+                "capability": "custom.launchapp",
+                "command": "launchApp",
+                "arguments": [app_id]
+            }
+        ]
+    }
+
+class DeviceEntry:
+    """One launch target: SmartThings device ID, default app and command templates"""
+    
+    def __init__(self, key, device_id, name=None, app_id=None, aliases=None,
+                 commands=None, status_cache_ttl=None, local=None, account=None):
+        self.key = key
+        self.device_id = device_id
+        self.name = name or key
+        self.app_id = app_id or config.TV_APP_ID
+        self.aliases = [a.lower() for a in (aliases or [])]
+        # action -> list of SmartThings commands; "{app_id}" in arguments is substituted
+        self.commands = commands or {}
+        self.status_cache_ttl = config.STATUS_CACHE_TTL if status_cache_ttl is None else float(status_cache_ttl)
+        # LAN control settings: {"host": ..., "mac": ..., "port": 8001, "broadcast": ...}
+        self.local = local or None
+        # SmartThings account that owns the device (see AccountManager)
+        self.account = (account or DEFAULT_ACCOUNT).lower()
+    
+    @classmethod
+    def from_dict(cls, key, data):
+        if not data.get('device_id'):
+            raise ValueError(f"Device '{key}' has no device_id")
+        if data.get('local') and not data['local'].get('host'):
+            raise ValueError(f"Device '{key}' has a local block without a host")
+        return cls(
+            key,
+            data['device_id'],
+            name=data.get('name'),
+            app_id=data.get('app_id'),
+            aliases=data.get('aliases'),
+            commands=data.get('commands'),
+            status_cache_ttl=data.get('status_cache_ttl'),
+            local=data.get('local'),
+            account=data.get('account')
+        )
+    
+    def build_payload(self, action='launch', app_id=None):
+        """Render the command template for action, or None if the device has no such action"""
+        app_id = app_id or self.app_id
+        template = self.commands.get(action)
+        if template is None:
+            if action != 'launch':
+                return None
+            return build_launch_payload(app_id)
+        commands = []
+        for command in template:
+            rendered = dict(command)
+            rendered.setdefault('component', 'main')
+            if 'arguments' in rendered:
+                rendered['arguments'] = [
+                    app_id if arg == '{app_id}' else arg for arg in rendered['arguments']
+                ]
+            commands.append(rendered)
+        return {'commands': commands}
+    
+    def summary(self):
+        return {
+            'name': self.name,
+            'device_id': self.device_id[:8] + '...',
+            'app_id': self.app_id or 'Not set',
+            'aliases': self.aliases,
+            'actions': sorted(set(self.commands) | {'launch'}),
+            'status_cache_ttl': self.status_cache_ttl,
+            'local_control': bool(self.local),
+            'account': self.account
+        }
+
+class DeviceRegistry:
+    """Launch targets indexed by name, alias and device ID
+    
+    Loaded from DEVICE_REGISTRY_FILE (hot-reloaded when the file changes) or
+    the DEVICE_REGISTRY variable, falling back to the legacy S95/M7 settings.
+    File format::
+    
+        {
+          "default_target": "s95",
+          "devices": {
+            "s95": {"device_id": "...", "name": "S95 TV", "app_id": "...",
+                    "aliases": ["living-room"], "status_cache_ttl": 10, "account": "default",
+                    "local": {"host": "192.168.1.50", "mac": "aa:bb:cc:dd:ee:ff"},
+                    "commands": {"launch": [{"capability": "switch", "command": "on"}, ...]}}
+          }
+        }
+    """
+    
+    def __init__(self, path=None, inline_json=''):
+        self.path = Path(path) if path else None
+        self.inline_json = inline_json
+        self._lock = threading.Lock()
+        self._signature = None
+        self._next_check = 0.0
+        self._devices = {}
+        self._index = {}
+        self.default_target = 's95'
+        self.source = None
+        self.loaded_at = None
+        self.reload(force=True)
+    
+    def _file_signature(self):
+        try:
+            st = self.path.stat()
+        except (FileNotFoundError, AttributeError, TypeError):
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+    
+    def _legacy_document(self):
+        """Registry equivalent of the TV_DEVICE_ID_S95 / TV_DEVICE_ID_M7 settings"""
+        devices = {}
+        if config.TV_DEVICE_ID_S95:
+            devices['s95'] = {'device_id': config.TV_DEVICE_ID_S95, 'name': 'S95 TV',
+                              'status_cache_ttl': config.STATUS_CACHE_TTL_S95}
+        if config.TV_DEVICE_ID_M7:
+            devices['m7'] = {'device_id': config.TV_DEVICE_ID_M7, 'name': 'M7 Monitor',
+                             'status_cache_ttl': config.STATUS_CACHE_TTL_M7}
+        return {'default_target': 's95', 'devices': devices}
+    
+    def reload(self, force=False):
+        """Re-read the registry if its file changed; returns True if reloaded"""
+        signature = self._file_signature()
+        if not force and signature == self._signature:
+            return False
+        try:
+            if signature is not None:
+                with open(self.path, 'r') as f:
+                    document = json.load(f)
+                source = str(self.path)
+            elif self.inline_json:
+                document = json.loads(self.inline_json)
+                source = 'DEVICE_REGISTRY'
+            else:
+                document = self._legacy_document()
+                source = 'environment'
+            devices, index = self._build(document)
+        except Exception as e:
+            # Keep serving the previous registry rather than dropping every device
+            logger.error(f"Failed to load device registry: {e}")
+            self._signature = signature
+            return False
+        
+        with self._lock:
+            self._devices = devices
+            self._index = index
+            self.default_target = (document.get('default_target') or 's95').lower()
+            self._signature = signature
+            self.source = source
+            self.loaded_at = datetime.now().isoformat()
+        logger.info(f"Device registry loaded from {source} ({len(devices)} devices)")
+        return True
+    
+    @staticmethod
+    def _build(document):
+        devices = {}
+        index = {}
+        for key, data in (document.get('devices') or {}).items():
+            entry = DeviceEntry.from_dict(key.lower(), data)
+            devices[entry.key] = entry
+        # Names win over aliases, aliases over raw device IDs
+        for entry in devices.values():
+            index.setdefault(entry.device_id.lower(), entry)
+        for entry in devices.values():
+            for alias in entry.aliases:
+                index[alias] = entry
+        for entry in devices.values():
+            index[entry.key] = entry
+        return devices, index
+    
+    def _maybe_reload(self):
+        if self.path is None:
+            return
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + config.DEVICE_REGISTRY_RELOAD_INTERVAL
+        self.reload()
+    
+    def get(self, target=None):
+        """Look up a target by name, alias or device ID (default target if empty)"""
+        self._maybe_reload()
+        key = (target or self.default_target).lower()
+        return self._index.get(key)
+    
+    def targets(self):
+        self._maybe_reload()
+        return sorted(self._devices)
+    
+    def device_ids(self, account=None):
+        """SmartThings device IDs of every registry entry (of one account if given)"""
+        self._maybe_reload()
+        return sorted({entry.device_id for entry in self._devices.values()
+                       if account is None or entry.account == account})
+    
+    def summary(self):
+        self._maybe_reload()
+        return {
+            'source': self.source,
+            'loaded_at': self.loaded_at,
+            'default_target': self.default_target,
+            'devices': {key: entry.summary() for key, entry in sorted(self._devices.items())}
+        }
+
+device_registry = DeviceRegistry(config.DEVICE_REGISTRY_FILE, config.DEVICE_REGISTRY_JSON)
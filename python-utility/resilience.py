@@ -0,0 +1,289 @@
+"""
+Circuit breakers and rate limits that guard SmartThings calls
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from settings import config
+from metrics import UPSTREAM_REJECTIONS
+
+logger = logging.getLogger(__name__)
+
+class UpstreamUnavailable(requests.exceptions.RequestException):
+    """A SmartThings call refused locally because its circuit is open or its rate limit is exhausted"""
+    
+    def __init__(self, message, call, reason, retry_after):
+        super().__init__(message)
+        self.call = call
+        self.reason = reason
+        self.retry_after = retry_after
+
+class TokenUnavailable(Exception):
+    """No usable OAuth token within TOKEN_REQUEST_WAIT because another refresh holds the lock; answered with 503"""
+
+def error_status(error):
+    """Status code for an unexpected error in a route: 503 if the token was busy being refreshed, else 500"""
+    return 503 if isinstance(error, TokenUnavailable) else 500
+
+def retry_after_seconds(headers):
+    """Seconds the upstream asked us to back off, from Retry-After or SmartThings rate-limit headers"""
+    value = headers.get('Retry-After')
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    # SmartThings reports the time until the window resets in milliseconds
+    if headers.get('X-RateLimit-Remaining') == '0' and headers.get('X-RateLimit-Reset'):
+        try:
+            return max(0.0, float(headers['X-RateLimit-Reset']) / 1000)
+        except ValueError:
+            pass
+    return None
+
+class CircuitBreaker:
+    """Error-rate circuit breaker for one SmartThings endpoint
+    
+    Closed: calls go through and outcomes are kept for BREAKER_WINDOW seconds.
+    Once BREAKER_MIN_CALLS calls are in the window and the failure share
+    reaches BREAKER_ERROR_RATE, the breaker opens and calls fail immediately.
+    After BREAKER_OPEN_SECONDS it goes half-open and lets
+    BREAKER_HALF_OPEN_PROBES calls through: a success closes it again, a
+    failure re-opens it. Failures are transport errors and 5xx responses;
+    4xx (including 429, which the rate limiter handles) count as healthy.
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, name):
+        self.name = name
+        self.state = self.CLOSED
+        self._lock = threading.Lock()
+        self._outcomes = deque()  # (monotonic time, failed)
+        self._failures = 0
+        self._opened_at = None
+        self._probes = 0
+        self.times_opened = 0
+        self.rejected = 0
+    
+    def _prune(self, now):
+        while self._outcomes and now - self._outcomes[0][0] > config.BREAKER_WINDOW:
+            _, failed = self._outcomes.popleft()
+            self._failures -= failed
+    
+    def _transition(self, state, now):
+        if state == self.state:
+            return
+        logger.warning(f"Circuit breaker '{self.name}': {self.state} -> {state}")
+        self.state = state
+        self._probes = 0
+        if state == self.OPEN:
+            self._opened_at = now
+            self.times_opened += 1
+        elif state == self.CLOSED:
+            self._outcomes.clear()
+            self._failures = 0
+    
+    def allow(self):
+        """Return (allowed, retry_in_seconds) for the next call"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                remaining = self._opened_at + config.BREAKER_OPEN_SECONDS - now
+                if remaining > 0:
+                    self.rejected += 1
+                    return False, remaining
+                self._transition(self.HALF_OPEN, now)
+            if self.state == self.HALF_OPEN:
+                if self._probes >= config.BREAKER_HALF_OPEN_PROBES:
+                    self.rejected += 1
+                    return False, 1.0
+                self._probes += 1
+            return True, 0.0
+    
+    def record(self, failed):
+        """Record a call outcome; failed=None releases a call that gave no verdict (e.g. 429)"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+                if failed is not None:
+                    self._transition(self.OPEN if failed else self.CLOSED, now)
+                return
+            if failed is None or self.state == self.OPEN:
+                return
+            self._outcomes.append((now, failed))
+            self._failures += failed
+            self._prune(now)
+            calls = len(self._outcomes)
+            if calls >= config.BREAKER_MIN_CALLS and self._failures / calls >= config.BREAKER_ERROR_RATE:
+                self._transition(self.OPEN, now)
+    
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            stats = {
+                'state': self.state,
+                'window_calls': len(self._outcomes),
+                'window_failures': self._failures,
+                'times_opened': self.times_opened,
+                'rejected': self.rejected
+            }
+            if self.state == self.OPEN:
+                stats['retry_in'] = round(max(0.0, self._opened_at + config.BREAKER_OPEN_SECONDS - now), 1)
+            return stats
+
+class TokenBucket:
+    """Token-bucket rate limiter that can be paused by Retry-After
+    
+    Callers reserve a token and sleep for the returned delay (time.sleep or
+    asyncio.sleep), so the same bucket serves both serving modes. A caller
+    that would have to wait longer than UPSTREAM_RATE_MAX_WAIT is refused
+    instead of queueing behind a throttled upstream.
+    """
+    
+    # Pause applied on a 429 that carries no Retry-After / rate-limit headers
+    DEFAULT_PAUSE = 1.0
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self.throttled = 0
+        self.rejected = 0
+    
+    def _refill(self, now):
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def reserve(self, max_wait):
+        """Take a token; return the seconds to wait before sending, or None if that exceeds max_wait"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, self._paused_until - now)
+            if self.rate > 0 and self._tokens < 1:
+                wait = max(wait, (1 - self._tokens) / self.rate)
+            if wait > max_wait:
+                self.rejected += 1
+                return None
+            if self.rate > 0:
+                self._tokens -= 1  # May go negative: later callers queue behind this reservation
+            if wait > 0:
+                self.throttled += 1
+            return wait
+    
+    def pause(self, seconds):
+        """Hold all calls for seconds (upstream sent Retry-After or ran out of quota)"""
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = min(self._tokens, 0.0)
+    
+    def retry_in(self):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0.0, self._paused_until - now)
+            if self.rate > 0 and self._tokens < 1:
+                wait = max(wait, (1 - self._tokens) / self.rate)
+            return wait
+    
+    def stats(self):
+        retry_in = self.retry_in()
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'tokens': round(max(0.0, self._tokens), 1),
+                'paused_for': round(max(0.0, self._paused_until - time.monotonic()), 1),
+                'retry_in': round(retry_in, 2),
+                'throttled': self.throttled,
+                'rejected': self.rejected
+            }
+
+class UpstreamGuard:
+    """Circuit breaker and token bucket per SmartThings endpoint
+    
+    Endpoints are keyed by the same call names used for the upstream latency
+    metric (device_command, device_status, token_refresh, ...). State is per
+    worker process; the sync and async clients of a process share it.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+    
+    def _endpoint(self, call):
+        endpoint = self._endpoints.get(call)
+        if endpoint is None:
+            with self._lock:
+                endpoint = self._endpoints.get(call)
+                if endpoint is None:
+                    endpoint = (CircuitBreaker(call), TokenBucket(config.UPSTREAM_RATE_LIMIT, config.UPSTREAM_RATE_BURST))
+                    self._endpoints[call] = endpoint
+        return endpoint
+    
+    def before(self, call):
+        """Admit a call: return the seconds to wait before sending, or raise UpstreamUnavailable"""
+        breaker, bucket = self._endpoint(call)
+        allowed, retry_in = breaker.allow()
+        if not allowed:
+            UPSTREAM_REJECTIONS.labels(call, 'circuit_open').inc()
+            raise UpstreamUnavailable(
+                f"SmartThings {call} circuit is open, retry in {retry_in:.0f}s", call, 'circuit_open', retry_in
+            )
+        delay = bucket.reserve(config.UPSTREAM_RATE_MAX_WAIT)
+        if delay is None:
+            breaker.record(None)
+            retry_in = bucket.retry_in()
+            UPSTREAM_REJECTIONS.labels(call, 'rate_limited').inc()
+            raise UpstreamUnavailable(
+                f"SmartThings {call} rate limit reached, retry in {retry_in:.1f}s", call, 'rate_limited', retry_in
+            )
+        return delay
+    
+    def after(self, call, status_code=None, headers=None):
+        """Feed a call outcome back; status_code=None means the request itself failed"""
+        breaker, bucket = self._endpoint(call)
+        if status_code is not None:
+            pause = retry_after_seconds(headers or {})
+            if pause is None and status_code == 429:
+                pause = TokenBucket.DEFAULT_PAUSE
+            if pause:
+                logger.warning(f"SmartThings asked {call} to back off for {pause:.1f}s (HTTP {status_code})")
+                bucket.pause(pause)
+        if status_code == 429:
+            breaker.record(None)
+        else:
+            breaker.record(status_code is None or status_code >= 500)
+    
+    def stats(self):
+        with self._lock:
+            endpoints = dict(self._endpoints)
+        return {
+            call: {'circuit': breaker.stats(), 'rate_limit': bucket.stats()}
+            for call, (breaker, bucket) in sorted(endpoints.items())
+        }
+    
+    def open_circuits(self):
+        with self._lock:
+            endpoints = dict(self._endpoints)
+        return sorted(call for call, (breaker, _) in endpoints.items() if breaker.state == CircuitBreaker.OPEN)
+
+upstream_guard = UpstreamGuard()
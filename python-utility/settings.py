@@ -0,0 +1,198 @@
+"""
+Configuration read from the environment (and the .env file)
+"""
+
+import os
+
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+def parse_bool(value, default=None):
+    """True/False from an env var, query string, hub channel field or JSON value; default if it is neither"""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value in ('1', 'true', 'yes'):
+            return True
+        if value in ('0', 'false', 'no'):
+            return False
+    return default
+
+# Configuration
+class Config:
+    # SmartThings API configuration
+    ST_API_BASE_URL = os.environ.get('ST_API_BASE_URL', 'https://api.smartthings.com/v1')
+    ST_OAUTH_TOKEN_URL = os.environ.get('ST_OAUTH_TOKEN_URL', 'https://api.smartthings.com/oauth/token')
+    ST_OAUTH_AUTHORIZE_URL = "https://api.smartthings.com/oauth/authorize"
+    ST_PAT = os.environ.get('SMARTTHINGS_PAT', '')  # Personal Access Token (fallback only)
+    
+    # OAuth configuration
+    ST_CLIENT_ID = os.environ.get('ST_CLIENT_ID', '')
+    ST_CLIENT_SECRET = os.environ.get('ST_CLIENT_SECRET', '')
+    ST_REFRESH_TOKEN = os.environ.get('ST_REFRESH_TOKEN', '')
+    
+    # OAuth token storage
+    TOKEN_FILE = os.environ.get('TOKEN_FILE', '/app/data/oauth_tokens.json')
+    # Max seconds a worker waits for another worker's token refresh to finish
+    TOKEN_LOCK_TIMEOUT = float(os.environ.get('TOKEN_LOCK_TIMEOUT', 30))
+    # A request that has to refresh waits at most this long for a slot and the lock, then gets a 503
+    TOKEN_REQUEST_WAIT = float(os.environ.get('TOKEN_REQUEST_WAIT', 5))
+    
+    # Background token refresh
+    TOKEN_REFRESH_LEAD = float(os.environ.get('TOKEN_REFRESH_LEAD', 900))  # Refresh this many seconds before expiry
+    TOKEN_REFRESH_JITTER = float(os.environ.get('TOKEN_REFRESH_JITTER', 120))  # Random extra lead to spread workers
+    TOKEN_REFRESH_RETRY_BASE = float(os.environ.get('TOKEN_REFRESH_RETRY_BASE', 5))
+    TOKEN_REFRESH_RETRY_MAX = float(os.environ.get('TOKEN_REFRESH_RETRY_MAX', 300))
+    TOKEN_REFRESH_HISTORY = int(os.environ.get('TOKEN_REFRESH_HISTORY', 50))
+    # Spread the refreshes of several accounts: each account refreshes this many seconds
+    # earlier than the previous one, and at most TOKEN_REFRESH_CONCURRENCY run at once per worker
+    TOKEN_REFRESH_STAGGER = float(os.environ.get('TOKEN_REFRESH_STAGGER', 60))
+    TOKEN_REFRESH_CONCURRENCY = int(os.environ.get('TOKEN_REFRESH_CONCURRENCY', 2))
+    
+    # Additional SmartThings accounts (households) served by this process (JSON file or inline JSON).
+    # The ST_* / SMARTTHINGS_PAT / TOKEN_FILE settings above are the "default" account.
+    ACCOUNTS_FILE = os.environ.get('ACCOUNTS_FILE', '/app/data/accounts.json')
+    ACCOUNTS_JSON = os.environ.get('ACCOUNTS', '')
+    
+    # OAuth callback configuration
+    # Use external callback page (GitHub Pages) since this service runs on local NAS
+    OAUTH_REDIRECT_URI = os.environ.get('OAUTH_REDIRECT_URI', 'https://tatuvlak.github.io/tv-weather-oauth/callback.html')
+    # Note: Authorization code from external callback must be manually entered via /oauth/token endpoint
+    
+    # TV/Monitor configuration
+    # S95 TV (default)
+    TV_DEVICE_ID_S95 = os.environ.get('TV_DEVICE_ID_S95', os.environ.get('TV_DEVICE_ID', ''))
+    # M7 Monitor
+    TV_DEVICE_ID_M7 = os.environ.get('TV_DEVICE_ID_M7', '')
+    
+    TV_APP_ID = os.environ.get('TV_APP_ID', '')  # Your weather app ID
+    
+    # Device registry for more than the two built-in targets (JSON file or inline JSON).
+    # When neither is set, the registry is built from the TV_DEVICE_ID_* variables above.
+    DEVICE_REGISTRY_FILE = os.environ.get('DEVICE_REGISTRY_FILE', '/app/data/devices.json')
+    DEVICE_REGISTRY_JSON = os.environ.get('DEVICE_REGISTRY', '')
+    DEVICE_REGISTRY_RELOAD_INTERVAL = float(os.environ.get('DEVICE_REGISTRY_RELOAD_INTERVAL', 2))
+    
+    # Device discovery (GET /devices): cached account-wide listing, revalidated with ETags
+    DISCOVERY_CACHE_FILE = os.environ.get('DISCOVERY_CACHE_FILE', '/app/data/discovery.json')  # Shared by the workers
+    DISCOVERY_TTL = float(os.environ.get('DISCOVERY_TTL', 900))  # Seconds before the listing is revalidated
+    DISCOVERY_MAX_PAGES = int(os.environ.get('DISCOVERY_MAX_PAGES', 50))
+    
+    # Outbound HTTP connection pool (per worker process)
+    HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 4))  # Distinct hosts kept pooled
+    HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 10))  # Keep-alive connections per host
+    HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 3.05))
+    HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 10))
+    HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+    HTTP_RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', 0.3))
+    # Async (ASGI) serving mode client limits, see asgi_app.py
+    ASYNC_HTTP_MAX_CONNECTIONS = int(os.environ.get('ASYNC_HTTP_MAX_CONNECTIONS', 200))
+    ASYNC_HTTP_MAX_KEEPALIVE = int(os.environ.get('ASYNC_HTTP_MAX_KEEPALIVE', 20))
+    
+    # Circuit breaker per SmartThings endpoint (per worker process)
+    BREAKER_WINDOW = float(os.environ.get('BREAKER_WINDOW', 30))  # Rolling window for the error rate (seconds)
+    BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', 5))  # Calls in the window before it can trip
+    BREAKER_ERROR_RATE = float(os.environ.get('BREAKER_ERROR_RATE', 0.5))
+    BREAKER_OPEN_SECONDS = float(os.environ.get('BREAKER_OPEN_SECONDS', 30))  # Fail fast this long before probing
+    BREAKER_HALF_OPEN_PROBES = int(os.environ.get('BREAKER_HALF_OPEN_PROBES', 1))
+    # Token bucket per SmartThings endpoint; a rate of 0 disables limiting (Retry-After is still honoured)
+    UPSTREAM_RATE_LIMIT = float(os.environ.get('UPSTREAM_RATE_LIMIT', 10))  # Requests per second
+    UPSTREAM_RATE_BURST = float(os.environ.get('UPSTREAM_RATE_BURST', 20))
+    UPSTREAM_RATE_MAX_WAIT = float(os.environ.get('UPSTREAM_RATE_MAX_WAIT', 2))  # Longer waits fail fast instead
+    
+    # Keep-warm: pooled connections to SmartThings are pinged so bursty launches find them open
+    KEEP_WARM_INTERVAL = float(os.environ.get('KEEP_WARM_INTERVAL', 45))  # Seconds between pings, 0 disables
+    KEEP_WARM_CONNECTIONS = int(os.environ.get('KEEP_WARM_CONNECTIONS', 2))  # Connections kept open per worker
+    DNS_CACHE_TTL = float(os.environ.get('DNS_CACHE_TTL', 300))  # SmartThings host lookups, 0 disables
+    
+    # Local LAN control for registry devices with a "local" block (falls back to the cloud)
+    LOCAL_CONTROL = parse_bool(os.environ.get('LOCAL_CONTROL', 'true'), False)
+    LOCAL_TV_PORT = int(os.environ.get('LOCAL_TV_PORT', 8001))  # Samsung TV REST API
+    LOCAL_TV_TIMEOUT = float(os.environ.get('LOCAL_TV_TIMEOUT', 2))
+    LOCAL_TV_WAKE_TIMEOUT = float(os.environ.get('LOCAL_TV_WAKE_TIMEOUT', 10))  # Wait for Wake-on-LAN to bring the TV up
+    # Whole launch, LAN attempt and cloud fallback included; keep it below gunicorn's --timeout (30). 0 disables
+    LAUNCH_TIME_BUDGET = float(os.environ.get('LAUNCH_TIME_BUDGET', 28))
+    LOCAL_TV_BROADCAST = os.environ.get('LOCAL_TV_BROADCAST', '255.255.255.255')
+    
+    # /device-status cache (seconds); a TTL of 0 disables caching
+    STATUS_CACHE_TTL = float(os.environ.get('STATUS_CACHE_TTL', 10))
+    STATUS_CACHE_TTL_S95 = float(os.environ.get('STATUS_CACHE_TTL_S95', STATUS_CACHE_TTL))
+    STATUS_CACHE_TTL_M7 = float(os.environ.get('STATUS_CACHE_TTL_M7', STATUS_CACHE_TTL))
+    STATUS_CACHE_STALE = float(os.environ.get('STATUS_CACHE_STALE', 30))  # Serve stale while revalidating
+    
+    # Launch deduplication: identical launches (device, app, action) within this many
+    # seconds share one upstream call; 0 disables
+    LAUNCH_DEDUP_WINDOW = float(os.environ.get('LAUNCH_DEDUP_WINDOW', 3))
+    IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 300))  # Seconds an idempotency key replays its result
+    # Shared with the other gunicorn workers; empty keeps deduplication per worker
+    DEDUP_STATE_DIR = os.environ.get('DEDUP_STATE_DIR', '/app/data/dedup')
+    
+    # Smart launch: skip commands the cached device state shows are unnecessary
+    SMART_LAUNCH = parse_bool(os.environ.get('SMART_LAUNCH', 'false'), False)  # Default for requests
+    SMART_LAUNCH_MAX_AGE = float(os.environ.get('SMART_LAUNCH_MAX_AGE', 30))  # Oldest cached state trusted (seconds)
+    # capability.attribute on the main component that holds the running app ID
+    SMART_LAUNCH_APP_ATTRIBUTE = os.environ.get('SMART_LAUNCH_APP_ATTRIBUTE', 'custom.launchapp.appId')
+    
+    # Device-state mirror fed by SmartThings subscription events (webhook SmartApp)
+    STATE_MIRROR = parse_bool(os.environ.get('STATE_MIRROR', 'false'), False)
+    MIRROR_STATE_DIR = os.environ.get('MIRROR_STATE_DIR', '/app/data/mirror')  # Shared by the gunicorn workers
+    MIRROR_RESYNC_INTERVAL = float(os.environ.get('MIRROR_RESYNC_INTERVAL', 900))  # Full /status refresh at least this often
+    MIRROR_EVENT_GRACE = float(os.environ.get('MIRROR_EVENT_GRACE', 15))  # Seconds to wait for the event after a command
+    ST_INSTALLED_APP_ID = os.environ.get('ST_INSTALLED_APP_ID', '')  # For POST /subscriptions
+    ST_WEBHOOK_TOKEN = os.environ.get('ST_WEBHOOK_TOKEN', '')  # Required as ?token= on the webhook; unset disables it
+    
+    # Batch launch (/launch-batch)
+    BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS', 10))  # Concurrent launches per worker process
+    BATCH_MAX_TARGETS = int(os.environ.get('BATCH_MAX_TARGETS', 50))
+    BATCH_DEFAULT_DEADLINE = float(os.environ.get('BATCH_DEFAULT_DEADLINE', 15))  # Seconds for the whole batch
+    
+    # /commands pipeline
+    COMMAND_MAX_STEPS = int(os.environ.get('COMMAND_MAX_STEPS', 100))
+    COMMAND_BATCH_MAX = int(os.environ.get('COMMAND_BATCH_MAX', 10))  # Commands per upstream request
+    CAPABILITY_CACHE_TTL = float(os.environ.get('CAPABILITY_CACHE_TTL', 3600))  # Device capabilities rarely change
+    
+    # Command journal: every outbound device command is recorded in sqlite (WAL) before it is sent;
+    # commands that fail on a network error, 5xx or 429 are replayed until their deadline. Empty disables
+    COMMAND_JOURNAL = os.environ.get('COMMAND_JOURNAL', '/app/data/commands.db')
+    COMMAND_REPLAY_DEADLINE = float(os.environ.get('COMMAND_REPLAY_DEADLINE', 120))  # Seconds; 0 never replays
+    JOURNAL_RETRY_BACKOFF = float(os.environ.get('JOURNAL_RETRY_BACKOFF', 2))  # Seconds, doubled per attempt
+    JOURNAL_RETRY_MAX = float(os.environ.get('JOURNAL_RETRY_MAX', 30))
+    JOURNAL_POLL_INTERVAL = float(os.environ.get('JOURNAL_POLL_INTERVAL', 5))  # Replayer check for other workers' entries
+    JOURNAL_RETENTION = float(os.environ.get('JOURNAL_RETENTION', 86400))  # Seconds finished entries are kept
+    
+    # Hub channel: keep-alive line-protocol TCP listener for the Edge Driver (every worker listens); 0 disables
+    HUB_CHANNEL_PORT = int(os.environ.get('HUB_CHANNEL_PORT', 0))
+    HUB_CHANNEL_TOKEN = os.environ.get('HUB_CHANNEL_TOKEN', '')  # Shared secret sent with "auth"; unset trusts the LAN
+    HUB_CHANNEL_HOST = os.environ.get('HUB_CHANNEL_HOST', os.environ.get('HOST', '0.0.0.0'))
+    HUB_CHANNEL_MAX_CONNECTIONS = int(os.environ.get('HUB_CHANNEL_MAX_CONNECTIONS', 256))  # Per worker process
+    HUB_CHANNEL_MAX_INFLIGHT = int(os.environ.get('HUB_CHANNEL_MAX_INFLIGHT', 8))  # Overlapping requests per connection
+    HUB_CHANNEL_IDLE_TIMEOUT = float(os.environ.get('HUB_CHANNEL_IDLE_TIMEOUT', 900))  # Seconds before an idle hub is dropped
+    HUB_CHANNEL_WORKERS = int(os.environ.get('HUB_CHANNEL_WORKERS', 8))  # Launch threads per worker process
+    
+    # Fire-and-forget launches (job queue)
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))  # Launch threads per worker process
+    JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 100))
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+    JOB_RETRY_BACKOFF = float(os.environ.get('JOB_RETRY_BACKOFF', 1))  # Seconds, doubled per attempt
+    JOB_RETENTION = float(os.environ.get('JOB_RETENTION', 3600))  # Seconds finished jobs stay queryable
+    # Job records are shared through this directory so any gunicorn worker can answer /jobs/<id>
+    JOB_STATE_DIR = os.environ.get('JOB_STATE_DIR', '/app/data/jobs')
+    
+    # Logging
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()  # text or json
+    LOG_ASYNC = parse_bool(os.environ.get('LOG_ASYNC', 'true'), False)  # Write logs from a background thread
+    LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 1))  # Share of requests whose INFO/DEBUG lines are kept
+    LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', '/health=0,/ready=0,/metrics=0')  # Per-route overrides
+    
+    # Server configuration
+    PORT = int(os.environ.get('PORT', 5000))
+    HOST = os.environ.get('HOST', '0.0.0.0')
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
+
+config = Config()
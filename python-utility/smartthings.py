@@ -0,0 +1,593 @@
+"""
+SmartThings API client
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import requests
+
+from settings import config
+from resilience import TokenUnavailable
+from credentials import AccountCredentials
+from registry import build_launch_payload
+from metrics import TOKEN_REFRESHES, TOKEN_REFRESH_LATENCY, device_label, observe_operation, observe_transport
+from http_client import PooledHTTPClient
+from tokens import TokenRefreshScheduler, TokenStore, token_refresh_slots
+from device_state import DeviceStateMirror, DeviceStatusCache
+from journal import CommandJournal, CommandReplayer, replay_retry_after, replayable_error
+from local_control import LocalTVTransport
+
+logger = logging.getLogger(__name__)
+
+class SmartThingsAPI:
+    """SmartThings API client with OAuth support
+    
+    One instance per account (see AccountManager); each has its own tokens,
+    refresh scheduler, pooled session, caches and command journal.
+    """
+    
+    def __init__(self, use_oauth=True, credentials=None, stagger=0.0):
+        self.credentials = credentials or AccountCredentials.from_config()
+        self.account = self.credentials.name
+        self.use_oauth = use_oauth
+        self.access_token = None
+        self.refresh_token = None
+        self.token_expires_at = None
+        self.http = PooledHTTPClient()
+        self.local = LocalTVTransport()
+        self.token_store = TokenStore(self.credentials.token_file)
+        self.refresh_history = deque(maxlen=config.TOKEN_REFRESH_HISTORY)
+        self.refresher = TokenRefreshScheduler(self, stagger)
+        self.status_cache = DeviceStatusCache(config.STATUS_CACHE_TTL, config.STATUS_CACHE_STALE)
+        self.mirror = DeviceStateMirror(self.credentials.scoped_path(config.MIRROR_STATE_DIR, directory=True)
+                                        if config.STATE_MIRROR else None)
+        # device_id -> {component: [capability IDs]}, used to validate /commands
+        self.capability_cache = DeviceStatusCache(config.CAPABILITY_CACHE_TTL, config.CAPABILITY_CACHE_TTL)
+        journal_path = self.credentials.scoped_path(config.COMMAND_JOURNAL)
+        self.journal = CommandJournal(journal_path) if journal_path else None
+        self.replayer = CommandReplayer(self, self.journal) if self.journal else None
+        # Tokens are read on first use and a stale token is refreshed by the
+        # background scheduler, so building the client (at import, in every
+        # gunicorn worker) does no network I/O.
+        self._tokens_loaded = not use_oauth
+        self._load_lock = threading.Lock()
+    
+    def ensure_tokens_loaded(self):
+        """Load tokens from the token file (or ST_REFRESH_TOKEN) the first time they are needed"""
+        if self._tokens_loaded:
+            return
+        with self._load_lock:
+            if not self._tokens_loaded:
+                self._load_tokens()
+                self._tokens_loaded = True
+    
+    def _load_tokens(self):
+        """Load OAuth tokens from file"""
+        try:
+            data = self.token_store.load()
+            if data is not None:
+                self._apply_token_data(data)
+                logger.info("OAuth tokens loaded from file")
+                logger.debug(f"Loaded: has_access_token={bool(self.access_token)}, has_refresh_token={bool(self.refresh_token)}")
+            else:
+                # Try to use refresh token from environment if file doesn't exist
+                if self.credentials.refresh_token:
+                    self.refresh_token = self.credentials.refresh_token
+                    logger.info(f"Using refresh token from configuration (account {self.account})")
+        except Exception as e:
+            logger.error(f"Failed to load tokens from file: {e}")
+    
+    def _apply_token_data(self, data):
+        """Copy a persisted token document into memory"""
+        self.access_token = data.get('access_token')
+        self.refresh_token = data.get('refresh_token')
+        self.token_expires_at = data.get('expires_at')
+        self._token_created_at = data.get('created_at', datetime.now().timestamp())
+    
+    def _reload_if_changed(self):
+        """Pick up tokens another worker has written since our last read"""
+        if not self.token_store.changed():
+            return False
+        try:
+            data = self.token_store.load()
+        except Exception as e:
+            logger.error(f"Failed to reload tokens from file: {e}")
+            return False
+        if data is None:
+            return False
+        self._apply_token_data(data)
+        logger.info("OAuth tokens reloaded (updated by another worker)")
+        return True
+    
+    def _save_tokens(self):
+        """Save OAuth tokens to file"""
+        try:
+            # Store token creation timestamp for age tracking
+            self._token_created_at = datetime.now().timestamp()
+            
+            data = {
+                'access_token': self.access_token,
+                'refresh_token': self.refresh_token,
+                'expires_at': self.token_expires_at,
+                'created_at': self._token_created_at,
+                'updated_at': datetime.now().isoformat()
+            }
+            
+            self.token_store.save(data)
+            logger.info("OAuth tokens saved to file")
+            logger.debug(f"Saved: has_access_token={bool(self.access_token)}, has_refresh_token={bool(self.refresh_token)}")
+        except Exception as e:
+            logger.error(f"Failed to save tokens to file: {e}")
+    
+    def get_headers(self):
+        """Get API request headers"""
+        if self.use_oauth:
+            self.ensure_tokens_loaded()
+            self._reload_if_changed()
+            if not self.access_token or self.is_token_expired():
+                if self.refresher.running and self.access_token and not self.is_token_expired(buffer_seconds=0):
+                    # Still valid: renew it off the request path
+                    self.refresher.wake()
+                else:
+                    logger.info("Token missing or expired, refreshing...")
+                    try:
+                        self.refresh_oauth_token(trigger='request', wait=config.TOKEN_REQUEST_WAIT)
+                    except TokenUnavailable:
+                        # Within the expiry buffer the old token still works
+                        if not self.access_token or self.is_token_expired(buffer_seconds=0):
+                            raise
+            token = self.access_token
+        else:
+            token = self.credentials.pat
+            
+        if not token:
+            raise ValueError("No authentication token available")
+            
+        return {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json'
+        }
+    
+    def is_token_expired(self, buffer_seconds=300):
+        """Check if current OAuth token is expired (with a 5-minute buffer by default)"""
+        if not self.token_expires_at:
+            return True
+        return datetime.now().timestamp() >= (self.token_expires_at - buffer_seconds)
+    
+    def refresh_oauth_token(self, trigger='request', wait=None):
+        """Refresh OAuth access token using refresh token
+        
+        Single-flight across workers: the refresh runs under the shared token
+        lock, and a worker that was waiting adopts the token written by the
+        worker that held the lock instead of refreshing again. Refreshes of
+        different accounts also wait for one of TOKEN_REFRESH_CONCURRENCY slots.
+        
+        wait bounds the slot and lock waits together. Without it they get
+        TOKEN_LOCK_TIMEOUT and a timeout returns False; request handlers pass
+        TOKEN_REQUEST_WAIT and get TokenUnavailable instead.
+        """
+        self.ensure_tokens_loaded()
+        stale_access_token = self.access_token
+        started = time.monotonic()
+        wait_until = started + (config.TOKEN_LOCK_TIMEOUT if wait is None else wait)
+        outcome = 'failed'
+        try:
+            if not token_refresh_slots.acquire(timeout=max(0.0, wait_until - time.monotonic())):
+                raise TimeoutError("Timed out waiting for a token refresh slot")
+            try:
+                with self.token_store.lock(max(0.0, wait_until - time.monotonic())):
+                    self._reload_if_changed()
+                    if self.access_token and self.access_token != stale_access_token and not self.is_token_expired():
+                        logger.info("Token already refreshed by another worker, reusing it")
+                        outcome = 'adopted'
+                        return True
+                    if self._refresh_oauth_token_locked():
+                        outcome = 'refreshed'
+                        return True
+                    return False
+            finally:
+                token_refresh_slots.release()
+        except TimeoutError as e:
+            logger.error(f"Failed to refresh OAuth token: {e}")
+            outcome = 'lock_timeout'
+            if wait is not None:
+                raise TokenUnavailable(f"OAuth token is being refreshed, try again shortly ({e})") from e
+            return False
+        finally:
+            duration = time.monotonic() - started
+            TOKEN_REFRESHES.labels(trigger, outcome).inc()
+            TOKEN_REFRESH_LATENCY.labels(outcome).observe(duration)
+            self.refresh_history.append({
+                'timestamp': datetime.now().isoformat(),
+                'trigger': trigger,
+                'outcome': outcome,
+                'success': outcome in ('refreshed', 'adopted'),
+                'duration_ms': round(duration * 1000, 1)
+            })
+    
+    def _refresh_oauth_token_locked(self):
+        """Perform the refresh grant; caller must hold the token lock"""
+        if not self.refresh_token:
+            logger.error("No refresh token available")
+            return False
+            
+        if not self.credentials.client_id:
+            logger.error("OAuth client ID not configured")
+            return False
+        
+        # Calculate token age for logging
+        if hasattr(self, '_token_created_at'):
+            token_age_hours = (datetime.now().timestamp() - self._token_created_at) / 3600
+            logger.info(f"Attempting token refresh (token age: {token_age_hours:.2f} hours)")
+        else:
+            logger.info("Attempting token refresh")
+        
+        logger.debug(f"Token status: has_refresh_token={bool(self.refresh_token)}")
+            
+        # SmartThings uses /oauth/token endpoint
+        token_url = config.ST_OAUTH_TOKEN_URL
+        
+        # Prepare form data
+        data = {
+            'grant_type': 'refresh_token',
+            'refresh_token': self.refresh_token
+        }
+        
+        # Use Basic Auth if client_secret is available
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded'
+        }
+        
+        auth = None
+        if self.credentials.client_secret:
+            # Use HTTP Basic Authentication with client credentials
+            auth = (self.credentials.client_id, self.credentials.client_secret)
+            logger.debug("Using Basic Auth for token refresh")
+        else:
+            # Include client_id in body if no client_secret
+            data['client_id'] = self.credentials.client_id
+            logger.debug("Using client_id in body for token refresh")
+        
+        try:
+            logger.debug("Refreshing OAuth token...")
+            response = self.http.post(
+                token_url,
+                call='token_refresh',
+                data=data,
+                headers=headers,
+                auth=auth
+            )
+            
+            if response.status_code != 200:
+                logger.error(f"Token refresh failed: {response.status_code}")
+                logger.error(f"Response: {response.text}")
+                return False
+            
+            token_data = response.json()
+            self.access_token = token_data.get('access_token')
+            
+            # Calculate expiration time
+            expires_in = token_data.get('expires_in', 86400)  # Default 24 hours
+            self.token_expires_at = datetime.now().timestamp() + expires_in
+            
+            # Preserve existing refresh_token if new one not provided
+            # SmartThings typically doesn't return refresh_token on refresh flow
+            new_refresh_token = token_data.get('refresh_token')
+            if new_refresh_token:
+                self.refresh_token = new_refresh_token
+                logger.debug("Refresh token updated with new value")
+            else:
+                logger.debug("Preserving existing refresh_token (not returned in response)")
+            
+            # Validate we have a refresh token
+            if not self.refresh_token:
+                logger.warning("No refresh_token available - tokens may not be refreshable")
+            
+            # Save tokens to file
+            self._save_tokens()
+            
+            logger.info(f"OAuth token refreshed successfully for account {self.account} (expires in {expires_in}s)")
+            logger.debug(f"Token status: has_access_token={bool(self.access_token)}, has_refresh_token={bool(self.refresh_token)}")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Failed to refresh OAuth token: {e}")
+            return False
+    
+    build_launch_payload = staticmethod(build_launch_payload)
+    
+    def store_exchanged_tokens(self, token_response):
+        """Adopt tokens from an authorization code exchange and publish them to the other workers"""
+        expires_in = token_response.get('expires_in', 86400)
+        self.ensure_tokens_loaded()
+        with self.token_store.lock():
+            self.access_token = token_response.get('access_token')
+            self.refresh_token = token_response.get('refresh_token')
+            self.token_expires_at = datetime.now().timestamp() + expires_in
+            
+            # Enable OAuth mode now that we have tokens
+            self.use_oauth = True
+            
+            # Save tokens
+            self._save_tokens()
+        self.refresher.start()
+        return expires_in
+    
+    def launch_app(self, device_id, app_id, payload=None, replay_deadline=None):
+        """Launch app on Samsung TV - sends power on + app launch commands
+        
+        payload overrides the default command batch (e.g. a device's command template).
+        Devices with LAN control are tried locally first, then through the cloud.
+        replay_deadline overrides COMMAND_REPLAY_DEADLINE for the journal.
+        """
+        started = time.perf_counter()
+        if payload is None:
+            payload = self.build_launch_payload(app_id)
+        
+        local = self.launch_locally(device_id, app_id, payload, started)
+        if local is not None:
+            return local
+        
+        cloud_started = time.perf_counter()
+        success, result = self._launch_app(device_id, app_id, payload, replay_deadline)
+        observe_transport('cloud', device_id, success, cloud_started)
+        observe_operation('launch_app', device_id, 'success' if success else 'failure', started)
+        return success, result
+    
+    def launch_locally(self, device_id, app_id, payload, started):
+        """LAN attempt of a launch; returns (success, result) to answer with, or None to go to the cloud
+        
+        The Wake-on-LAN wait ends early enough to leave one cloud request
+        (HTTP_CONNECT_TIMEOUT + HTTP_READ_TIMEOUT) within LAUNCH_TIME_BUDGET.
+        If a failed attempt still used up too much of it, the cloud fallback
+        is skipped rather than running into the worker timeout.
+        """
+        budget_ends = None
+        cloud_reserve = config.HTTP_CONNECT_TIMEOUT + config.HTTP_READ_TIMEOUT
+        local_deadline = None
+        if config.LAUNCH_TIME_BUDGET > 0:
+            budget_ends = time.monotonic() + config.LAUNCH_TIME_BUDGET
+            # Half a second of slack for the last power state poll
+            local_deadline = budget_ends - cloud_reserve - 0.5
+        
+        local = self.local.launch_app(device_id, app_id, payload, local_deadline)
+        if local is None:
+            return None
+        success, result = local
+        observe_transport('local', device_id, success, started)
+        if success:
+            self.state_changed(device_id)
+            observe_operation('launch_app', device_id, 'success', started)
+            return success, result
+        if budget_ends is not None and budget_ends - time.monotonic() < cloud_reserve:
+            logger.warning(f"Local launch failed ({result}), not enough of LAUNCH_TIME_BUDGET left for the cloud fallback")
+            observe_operation('launch_app', device_id, 'failure', started)
+            return False, f"Local launch failed ({result}); cloud fallback skipped, LAUNCH_TIME_BUDGET used up"
+        logger.warning(f"Local launch failed ({result}), falling back to SmartThings cloud")
+        return None
+    
+    def _post_commands(self, device_id, payload):
+        """POST a command batch to a device, refreshing the token once on 401; returns the response JSON"""
+        url = f"{config.ST_API_BASE_URL}/devices/{device_id}/commands"
+        device = device_label(device_id)
+        
+        # Try with current token
+        response = self.http.post(
+            url,
+            call='device_command',
+            device=device,
+            json=payload,
+            headers=self.get_headers()
+        )
+        
+        # If unauthorized and using OAuth, try refreshing token
+        if response.status_code == 401 and self.use_oauth:
+            logger.info("Token expired (401), attempting to refresh")
+            if self.refresh_oauth_token(trigger='unauthorized', wait=config.TOKEN_REQUEST_WAIT):
+                response = self.http.post(
+                    url,
+                    call='device_command',
+                    device=device,
+                    json=payload,
+                    headers=self.get_headers()
+                )
+        
+        response.raise_for_status()
+        return response.json()
+    
+    def _deliver(self, device_id, payload, source, replay_deadline=None):
+        """Send a command payload through the command journal; returns the response JSON or a queued result
+        
+        Failures worth replaying are left to the replayer and reported as
+        {'queued': True, ...}; any other failure raises RequestException.
+        """
+        replay_deadline = config.COMMAND_REPLAY_DEADLINE if replay_deadline is None else float(replay_deadline)
+        entry_id = None
+        if self.journal is not None:
+            try:
+                entry_id, queued = self.journal.record(device_id, payload, source, replay_deadline)
+            except sqlite3.Error as e:
+                # The journal is a safety net; a broken one must not block commands
+                logger.error(f"Command journal unavailable, sending without it: {e}")
+                queued = False
+            if queued:
+                self.replayer.wake()
+                return self.journal.queued_result(entry_id, 'Queued behind earlier commands waiting for replay')
+        if entry_id is None:
+            return self._post_commands(device_id, payload)
+        
+        try:
+            result = self._post_commands(device_id, payload)
+        except requests.exceptions.RequestException as e:
+            if replay_deadline > 0 and replayable_error(e):
+                if self.journal.defer([entry_id], str(e), replay_retry_after(e)):
+                    logger.warning(f"Command to {device_label(device_id)} failed ({e}), queued for replay")
+                    self.replayer.wake()
+                    return self.journal.queued_result(entry_id, str(e))
+            else:
+                self.journal.finish([entry_id], 'failed', str(e))
+            raise
+        except Exception as e:
+            # No token, token lock timeout, ...: the caller gets an error, so the
+            # entry must not be left in 'sending' for the replayer to pick up later
+            self.journal.finish([entry_id], 'failed', str(e))
+            raise
+        self.journal.finish([entry_id], 'sent')
+        return result
+    
+    def _launch_app(self, device_id, app_id, payload, replay_deadline=None):
+        if payload is None:
+            payload = self.build_launch_payload(app_id)
+        
+        try:
+            result = self._deliver(device_id, payload, 'launch', replay_deadline)
+            if result.get('queued'):
+                logger.info(f"Launch of app {app_id} on device {device_id} queued for replay")
+            else:
+                logger.info(f"Successfully launched app {app_id} on device {device_id}")
+            return True, result
+            
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to launch app: {e}")
+            if hasattr(e, 'response') and e.response is not None:
+                logger.error(f"Response: {e.response.text}")
+            return False, str(e)
+        finally:
+            # The command may have changed power/app state either way
+            self.state_changed(device_id)
+    
+    def send_commands(self, device_id, commands, replay_deadline=None):
+        """Send one merged command batch (from /commands) to a device; returns (success, result)"""
+        started = time.perf_counter()
+        try:
+            result = self._deliver(device_id, {'commands': commands}, 'commands', replay_deadline)
+            success = True
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to send commands: {e}")
+            if hasattr(e, 'response') and e.response is not None:
+                logger.error(f"Response: {e.response.text}")
+            success, result = False, str(e)
+        finally:
+            self.state_changed(device_id)
+        observe_operation('send_commands', device_id, 'success' if success else 'failure', started)
+        return success, result
+    
+    @staticmethod
+    def parse_capabilities(description):
+        """{component: [capability IDs]} from a GET /devices/{id} document"""
+        return {
+            component['id']: sorted(capability['id'] for capability in component.get('capabilities', []))
+            for component in description.get('components', [])
+        }
+    
+    def get_device_capabilities(self, device_id):
+        """Device capabilities from the capability cache; returns (capabilities, cache_state)"""
+        return self.capability_cache.get(device_id, self._fetch_device_capabilities)
+    
+    def _fetch_device_capabilities(self, device_id):
+        """Fetch the device description from SmartThings"""
+        url = f"{config.ST_API_BASE_URL}/devices/{device_id}"
+        
+        try:
+            response = self.http.get(
+                url,
+                call='device_description',
+                device=device_label(device_id),
+                headers=self.get_headers()
+            )
+            response.raise_for_status()
+            return self.parse_capabilities(response.json())
+            
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to get device capabilities: {e}")
+            return None
+    
+    def state_changed(self, device_id):
+        """A command was sent to device_id: drop its cached status and expect an event in the mirror"""
+        self.status_cache.invalidate(device_id)
+        self.mirror.expect_event(device_id)
+    
+    def get_device_status(self, device_id, use_cache=True, ttl=None):
+        """Get device status (served from the status cache when possible)"""
+        status, _ = self.lookup_device_status(device_id, use_cache=use_cache, ttl=ttl)
+        return status
+    
+    def lookup_device_status(self, device_id, use_cache=True, ttl=None):
+        """Get device status along with its cache state (mirror, hit, stale, miss, coalesced, bypass)"""
+        started = time.perf_counter()
+        if use_cache:
+            status, _ = self.mirror.snapshot(device_id)
+            if status is not None:
+                observe_operation('get_device_status', device_id, 'mirror', started)
+                return status, 'mirror'
+        if not use_cache:
+            status, cache_state = self._fetch_device_status(device_id), 'bypass'
+        else:
+            status, cache_state = self.status_cache.get(device_id, self._fetch_device_status, ttl=ttl)
+        observe_operation('get_device_status', device_id, cache_state if status is not None else 'failure', started)
+        return status, cache_state
+    
+    def _fetch_device_status(self, device_id):
+        """Fetch device status from SmartThings (every successful fetch also resyncs the mirror)"""
+        url = f"{config.ST_API_BASE_URL}/devices/{device_id}/status"
+        fetched_at = time.time()
+        
+        try:
+            response = self.http.get(
+                url,
+                call='device_status',
+                device=device_label(device_id),
+                headers=self.get_headers()
+            )
+            response.raise_for_status()
+            status = response.json()
+            self.mirror.resync(device_id, status, fetched_at)
+            return status
+            
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to get device status: {e}")
+            return None
+
+    def register_subscriptions(self, installed_app_id, device_ids, auth_token=None):
+        """Replace the installed app's subscriptions with one all-attribute subscription per device
+        
+        auth_token is the token from an INSTALL/UPDATE lifecycle; without it
+        the utility's own token is used. Returns a list of per-device results.
+        """
+        base_url = f"{config.ST_API_BASE_URL}/installedapps/{installed_app_id}/subscriptions"
+        headers = {'Authorization': f'Bearer {auth_token}', 'Content-Type': 'application/json'} if auth_token else self.get_headers()
+        
+        response = self.http.request('DELETE', base_url, call='subscriptions', headers=headers)
+        response.raise_for_status()
+        # Events between the old and new subscriptions are lost
+        self.mirror.mark_gap(None, 'resubscribed')
+        
+        results = []
+        for index, device_id in enumerate(device_ids):
+            body = {
+                'sourceType': 'DEVICE',
+                'device': {
+                    'deviceId': device_id,
+                    'componentId': '*',
+                    'capability': '*',
+                    'attribute': '*',
+                    'value': '*',
+                    'stateChangeOnly': True,
+                    'subscriptionName': f'mirror_{index}'
+                }
+            }
+            try:
+                response = self.http.post(base_url, call='subscriptions', device=device_label(device_id),
+                                          json=body, headers=headers)
+                response.raise_for_status()
+                results.append({'device_id': device_id, 'success': True, 'subscription': response.json().get('id')})
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Failed to subscribe to {device_id}: {e}")
+                results.append({'device_id': device_id, 'success': False, 'error': str(e)})
+        logger.info(f"Registered subscriptions for {sum(r['success'] for r in results)}/{len(results)} device(s)")
+        return results
@@ -0,0 +1,40 @@
+"""
+Shared setup for the unit tests
+
+settings.py reads the configuration at import, so the environment is pointed
+at a throwaway state directory before the first test module imports app.py. No test
+talks to SmartThings: upstream calls are replaced per test.
+"""
+
+import json
+import os
+import sys
+import tempfile
+
+STATE_DIR = tempfile.mkdtemp(prefix='tv-launcher-tests-')
+
+os.environ.update({
+    'SMARTTHINGS_PAT': 'test-pat',
+    'ST_CLIENT_ID': '',
+    'ST_API_BASE_URL': 'http://127.0.0.1:9/v1',
+    'ST_OAUTH_TOKEN_URL': 'http://127.0.0.1:9/oauth/token',
+    'TV_APP_ID': 'test-app',
+    'DEVICE_REGISTRY': json.dumps({'default_target': 'tv', 'devices': {
+        'tv': {'device_id': 'device-tv', 'name': 'Test TV'},
+        'monitor': {'device_id': 'device-monitor', 'name': 'Test Monitor', 'aliases': ['m']}
+    }}),
+    'DEVICE_REGISTRY_FILE': os.path.join(STATE_DIR, 'devices.json'),
+    'ACCOUNTS_FILE': os.path.join(STATE_DIR, 'accounts.json'),
+    'TOKEN_FILE': os.path.join(STATE_DIR, 'oauth_tokens.json'),
+    'DEDUP_STATE_DIR': os.path.join(STATE_DIR, 'dedup'),
+    'JOB_STATE_DIR': os.path.join(STATE_DIR, 'jobs'),
+    'COMMAND_JOURNAL': os.path.join(STATE_DIR, 'commands.db'),
+    'MIRROR_STATE_DIR': os.path.join(STATE_DIR, 'mirror'),
+    'DISCOVERY_CACHE_FILE': os.path.join(STATE_DIR, 'discovery.json'),
+    'KEEP_WARM_INTERVAL': '0',
+    'HUB_CHANNEL_PORT': '0',
+    'LOG_LEVEL': 'WARNING',
+})
+os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
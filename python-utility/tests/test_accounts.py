@@ -0,0 +1,119 @@
+"""AccountManager: per-account clients, credentials, state paths and isolation between accounts"""
+
+import json
+from pathlib import Path
+
+import pytest
+
+import app as app_module
+from accounts import AccountManager
+from credentials import DEFAULT_ACCOUNT
+from registry import DeviceEntry
+
+ACCOUNTS = {'accounts': {
+    'Smith': {'pat': 'smith-pat', 'installed_app_id': 'smith-app'},
+    'jones': {'client_id': 'jones-client', 'client_secret': 'jones-secret', 'refresh_token': 'jones-refresh'}
+}}
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return AccountManager(tmp_path / 'missing.json', json.dumps(ACCOUNTS))
+
+
+def test_default_plus_configured_accounts(manager):
+    assert manager.names() == ['default', 'jones', 'smith']
+    assert manager.source == 'ACCOUNTS'
+    assert manager.get() is manager.default
+    assert manager.get('SMITH').account == 'smith'
+    assert manager.get('nobody') is None
+    with pytest.raises(KeyError):
+        manager.api_for('nobody')
+
+
+def test_each_account_has_its_own_clients_and_state(manager):
+    smith, jones = manager.get('smith'), manager.get('jones')
+    assert smith.http is not jones.http
+    assert smith.status_cache is not jones.status_cache
+    assert smith.token_store.path != jones.token_store.path
+    assert Path(jones.credentials.token_file).name == 'oauth_tokens-jones.json'
+    assert manager.default.credentials.token_file == app_module.config.TOKEN_FILE
+    assert smith.credentials.scoped_path('/data/mirror', directory=True) == '/data/mirror/smith'
+
+
+def test_credentials_and_auth_method(manager):
+    smith, jones = manager.get('smith'), manager.get('jones')
+    assert smith.use_oauth is False
+    assert smith.get_headers()['Authorization'] == 'Bearer smith-pat'
+    assert manager.default.get_headers()['Authorization'] == 'Bearer test-pat'
+    assert jones.use_oauth is True
+    assert jones.credentials.client_secret == 'jones-secret'
+    stats = manager.stats()
+    assert stats['smith']['auth_method'] == 'PAT'
+    assert stats['jones']['auth_method'] == 'OAuth'
+
+
+def test_refreshes_are_staggered_per_account(manager):
+    staggers = [manager.get(name).refresher.stagger for name in ('default', 'smith', 'jones')]
+    assert len(set(staggers)) == 3
+
+
+def test_accounts_without_client_default_to_st_client(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module.config, 'ST_CLIENT_ID', 'shared-client')
+    monkeypatch.setattr(app_module.config, 'ST_CLIENT_SECRET', 'shared-secret')
+    manager = AccountManager(None, json.dumps({'accounts': {'smith': {'refresh_token': 'r'}}}))
+    credentials = manager.get('smith').credentials
+    assert (credentials.client_id, credentials.client_secret) == ('shared-client', 'shared-secret')
+    assert manager.get('smith').use_oauth is True
+
+
+@pytest.mark.parametrize('document', [
+    {'accounts': {'default': {'pat': 'x'}}},
+    {'accounts': {'bad name!': {'pat': 'x'}}},
+])
+def test_invalid_accounts_fall_back_to_default_only(document):
+    manager = AccountManager(None, json.dumps(document))
+    assert manager.names() == [DEFAULT_ACCOUNT]
+    assert manager.source is None
+
+
+def test_accounts_file_wins_over_inline(tmp_path):
+    path = tmp_path / 'accounts.json'
+    path.write_text(json.dumps({'accounts': {'file-account': {'pat': 'x'}}}))
+    manager = AccountManager(path, json.dumps(ACCOUNTS))
+    assert manager.names() == ['default', 'file-account']
+    assert manager.source == str(path)
+
+
+def test_active_skips_bare_default_account(monkeypatch, manager):
+    monkeypatch.setattr(manager.default.credentials, 'pat', '')
+    assert list(manager.active()) == ['jones', 'smith']
+    alone = AccountManager(None, '')
+    monkeypatch.setattr(alone.default.credentials, 'pat', '')
+    assert list(alone.active()) == ['default']
+
+
+def test_secrets_cover_every_account(manager):
+    manager.get('jones').access_token = 'jones-access'
+    secrets = manager.secrets()
+    for secret in ('test-pat', 'smith-pat', 'jones-secret', 'jones-refresh', 'jones-access'):
+        assert secret in secrets
+
+
+def test_start_only_starts_oauth_refreshers(manager, monkeypatch):
+    started = []
+    for name, api in manager.apis.items():
+        monkeypatch.setattr(api.refresher, 'start', lambda name=name: started.append(name))
+        if api.replayer is not None:
+            monkeypatch.setattr(api.replayer, 'start', lambda: None)
+    manager.start()
+    assert started == ['jones']
+
+
+def test_targets_of_unconfigured_accounts_are_rejected(monkeypatch):
+    entry = DeviceEntry('attic', 'device-attic', account='nobody')
+    monkeypatch.setattr(app_module.device_registry, 'get', lambda target=None: entry)
+    resolved, error, status_code = app_module.resolve_target('attic')
+    assert resolved is None
+    assert status_code == 500
+    assert "unconfigured account 'nobody'" in error
@@ -0,0 +1,68 @@
+"""Async serving mode: blocking token, registry and state-file work stays off the event loop"""
+
+import asyncio
+import threading
+
+import httpx
+import pytest
+
+import app
+import asgi_app
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def call(method, path, **kwargs):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi_app.app), base_url='http://test') as client:
+        return await client.request(method, path, **kwargs)
+
+
+def test_get_headers_runs_off_the_event_loop(monkeypatch):
+    threads = []
+
+    def get_headers():
+        threads.append(threading.get_ident())
+        return {'Authorization': 'Bearer x'}
+    monkeypatch.setattr(asgi_app.async_api.api, 'get_headers', get_headers)
+
+    async def main():
+        headers = await asgi_app.async_api.get_headers()
+        return headers, threading.get_ident()
+    headers, loop_thread = run(main())
+    assert headers == {'Authorization': 'Bearer x'}
+    assert threads and threads[0] != loop_thread
+
+
+@pytest.mark.parametrize('method, path, name, result', [
+    ('POST', '/launch-tv-app', 'plan_launch', (None, 'nope', 404)),
+    ('POST', '/launch-batch', 'plan_batch', (None, 'nope', 400)),
+    ('POST', '/commands', 'plan_commands', (None, 'nope', 400)),
+    ('GET', '/device-status', 'resolve_target', (None, 'nope', 404)),
+])
+def test_request_planning_runs_off_the_event_loop(monkeypatch, method, path, name, result):
+    threads = []
+
+    def planner(*args):
+        threads.append(threading.current_thread())
+        return result
+    monkeypatch.setattr(asgi_app, name, planner)
+    kwargs = {'json': {'target': 'tv'}} if method == 'POST' else {}
+    response = run(call(method, path, **kwargs))
+    assert response.status_code == result[2]
+    assert threads and threads[0] is not threading.main_thread()
+
+
+def test_health_reads_state_off_the_event_loop(monkeypatch):
+    threads = []
+    original = app.health_payload
+
+    def health_payload():
+        threads.append(threading.current_thread())
+        return original()
+    monkeypatch.setattr(asgi_app, 'health_payload', health_payload)
+    response = run(call('GET', '/health'))
+    assert response.status_code == 200
+    assert response.json()['serving_mode'] == 'asgi'
+    assert threads[0] is not threading.main_thread()
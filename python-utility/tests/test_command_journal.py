@@ -0,0 +1,179 @@
+"""Command journal state machine: record -> sending -> sent/failed/pending -> replaying -> ..."""
+
+import time
+
+import pytest
+import requests
+
+import app
+from journal import CommandJournal, CommandReplayer, launch_queued
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return CommandJournal(tmp_path / 'commands.db')
+
+
+@pytest.fixture
+def api(journal, monkeypatch):
+    """The default account's client with a private journal and a replayer that is never started"""
+    api = app.st_api
+    monkeypatch.setattr(api, 'journal', journal)
+    monkeypatch.setattr(api, 'replayer', CommandReplayer(api, journal))
+    monkeypatch.setattr(api, 'state_changed', lambda device_id: None)
+    return api
+
+
+def state(journal, entry_id):
+    return journal._connection().execute("SELECT state FROM commands WHERE id = ?", (entry_id,)).fetchone()['state']
+
+
+def server_error():
+    response = requests.Response()
+    response.status_code = 503
+    return requests.exceptions.HTTPError('503 Server Error', response=response)
+
+
+LAUNCH = {'commands': [{'component': 'main', 'capability': 'switch', 'command': 'on'}]}
+
+
+def test_record_then_finish(journal):
+    entry_id, queued = journal.record('device-1', LAUNCH, 'launch', 60)
+    assert not queued
+    assert state(journal, entry_id) == 'sending'
+    journal.finish([entry_id], 'sent')
+    assert state(journal, entry_id) == 'sent'
+
+
+def test_commands_queue_behind_pending_entries(journal):
+    first, _ = journal.record('device-1', LAUNCH, 'launch', 60)
+    assert journal.defer([first], 'connection refused')
+    second, queued = journal.record('device-1', LAUNCH, 'launch', 60)
+    assert queued
+    assert state(journal, second) == 'pending'
+    # Other devices are not held up
+    _, queued = journal.record('device-2', LAUNCH, 'launch', 60)
+    assert not queued
+
+
+def test_no_replay_deadline_is_never_queued(journal):
+    first, _ = journal.record('device-1', LAUNCH, 'launch', 60)
+    journal.defer([first], 'connection refused')
+    entry_id, queued = journal.record('device-1', LAUNCH, 'launch', 0)
+    assert not queued
+    assert state(journal, entry_id) == 'sending'
+
+
+def test_defer_past_deadline_expires(journal):
+    entry_id, _ = journal.record('device-1', LAUNCH, 'launch', 0.01)
+    assert not journal.defer([entry_id], 'connection refused')
+    assert state(journal, entry_id) == 'expired'
+
+
+def test_claim_merges_pending_entries_per_device(journal, monkeypatch):
+    monkeypatch.setattr(app.config, 'JOURNAL_RETRY_BACKOFF', 0)
+    ids = [journal.record('device-1', LAUNCH, 'launch', 60)[0] for _ in range(2)]
+    journal.defer(ids, 'connection refused')
+    batches = journal.claim(max_commands=10)
+    assert len(batches) == 1
+    assert batches[0]['entry_ids'] == ids
+    assert len(batches[0]['commands']) == 2
+    assert {state(journal, i) for i in ids} == {'replaying'}
+    # A device being replayed is not claimed twice
+    assert journal.claim(max_commands=10) == []
+
+
+def test_stale_sending_entries_are_reclaimed(journal, monkeypatch):
+    entry_id, _ = journal.record('device-1', LAUNCH, 'launch', 600)
+    monkeypatch.setattr(CommandJournal, 'stale_after', -1)
+    assert [b['entry_ids'] for b in journal.claim(max_commands=10)] == [[entry_id]]
+
+
+def test_deliver_marks_sent(api, journal, monkeypatch):
+    monkeypatch.setattr(api, '_post_commands', lambda device_id, payload: {'results': []})
+    assert api._deliver('device-1', LAUNCH, 'launch', 60) == {'results': []}
+    assert state(journal, 1) == 'sent'
+
+
+def test_deliver_defers_replayable_errors(api, journal, monkeypatch):
+    def fail(device_id, payload):
+        raise server_error()
+    monkeypatch.setattr(api, '_post_commands', fail)
+    result = api._deliver('device-1', LAUNCH, 'launch', 60)
+    assert launch_queued(result)
+    assert state(journal, result['journal_id']) == 'pending'
+
+
+def test_deliver_fails_rejected_commands(api, journal, monkeypatch):
+    def reject(device_id, payload):
+        response = requests.Response()
+        response.status_code = 422
+        raise requests.exceptions.HTTPError('422 Unprocessable', response=response)
+    monkeypatch.setattr(api, '_post_commands', reject)
+    with pytest.raises(requests.exceptions.HTTPError):
+        api._deliver('device-1', LAUNCH, 'launch', 60)
+    assert state(journal, 1) == 'failed'
+
+
+@pytest.mark.parametrize('error', [ValueError('No authentication token available'), TimeoutError('token lock busy')])
+def test_deliver_fails_entry_on_local_errors(api, journal, monkeypatch, error):
+    def fail(device_id, payload):
+        raise error
+    monkeypatch.setattr(api, '_post_commands', fail)
+    with pytest.raises(type(error)):
+        api._deliver('device-1', LAUNCH, 'launch', 60)
+    # The caller was told it failed, so the replayer must never send it
+    assert state(journal, 1) == 'failed'
+    assert journal.claim(max_commands=10) == []
+
+
+def test_replay_success_marks_sent(api, journal, monkeypatch):
+    monkeypatch.setattr(app.config, 'JOURNAL_RETRY_BACKOFF', 0)
+    monkeypatch.setattr(api, '_post_commands', lambda device_id, payload: {'results': []})
+    entry_id, _ = journal.record('device-1', LAUNCH, 'launch', 60)
+    journal.defer([entry_id], 'connection refused')
+    api.replayer.drain()
+    assert state(journal, entry_id) == 'sent'
+    assert journal.counters['replayed'] == 1
+
+
+def test_replay_defers_on_local_errors(api, journal, monkeypatch):
+    monkeypatch.setattr(app.config, 'JOURNAL_RETRY_BACKOFF', 0)
+    entry_id, _ = journal.record('device-1', LAUNCH, 'launch', 60)
+    journal.defer([entry_id], 'connection refused')
+    batch = journal.claim(max_commands=10)[0]
+
+    def fail(device_id, payload):
+        raise ValueError('No authentication token available')
+    monkeypatch.setattr(api, '_post_commands', fail)
+    api.replayer._replay(batch)
+    assert state(journal, entry_id) == 'pending'
+    assert 'No authentication token' in api.replayer.last_error
+
+
+def test_replay_drops_local_errors_past_deadline(api, journal, monkeypatch):
+    monkeypatch.setattr(app.config, 'JOURNAL_RETRY_BACKOFF', 0)
+    entry_id, _ = journal.record('device-1', LAUNCH, 'launch', 0.2)
+    journal.defer([entry_id], 'connection refused')
+    batch = journal.claim(max_commands=10)[0]
+    time.sleep(0.25)
+
+    def fail(device_id, payload):
+        raise TimeoutError('token lock busy')
+    monkeypatch.setattr(api, '_post_commands', fail)
+    api.replayer._replay(batch)
+    assert state(journal, entry_id) == 'expired'
+
+
+def test_async_deliver_fails_entry_on_local_errors(api, journal, monkeypatch):
+    import asyncio
+    import asgi_app
+
+    async_api = asgi_app.async_api
+
+    async def fail(device_id, payload):
+        raise ValueError('No authentication token available')
+    monkeypatch.setattr(async_api, '_post_commands', fail)
+    with pytest.raises(ValueError):
+        asyncio.run(async_api._deliver('device-1', LAUNCH, 'launch', 60))
+    assert state(journal, 1) == 'failed'
@@ -0,0 +1,146 @@
+"""DeviceCatalog: paged listing, ETag revalidation, truncation, indexes and sharing between workers"""
+
+import pytest
+import requests
+
+import app as app_module
+from discovery import DeviceCatalog
+from smartthings import SmartThingsAPI
+
+BASE = app_module.config.ST_API_BASE_URL
+
+
+class Response:
+    def __init__(self, status_code=200, body=None, headers=None):
+        self.status_code = status_code
+        self.body = body or {}
+        self.headers = headers or {}
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f'HTTP {self.status_code}', response=self)
+
+
+class FakeHTTP:
+    def __init__(self, routes):
+        self.routes = routes
+        self.calls = []
+
+    def get(self, url, call=None, headers=None):
+        self.calls.append((url, dict(headers or {})))
+        route = self.routes[url]
+        if isinstance(route, Exception):
+            raise route
+        return route(headers) if callable(route) else route
+
+
+class FakeAPI:
+    parse_capabilities = staticmethod(SmartThingsAPI.parse_capabilities)
+
+    def __init__(self, routes):
+        self.http = FakeHTTP(routes)
+        self.primed = {}
+        self.capability_cache = self
+
+    def get_headers(self):
+        return {'Authorization': 'Bearer test'}
+
+    def prime(self, device_id, components):
+        self.primed[device_id] = components
+
+
+def device(device_id, label, room='room-1', manufacturer='Samsung Electronics', capabilities=('switch',)):
+    return {
+        'deviceId': device_id, 'label': label, 'name': label, 'manufacturerName': manufacturer,
+        'locationId': 'loc-1', 'roomId': room,
+        'components': [{'id': 'main', 'capabilities': [{'id': c} for c in capabilities]}]
+    }
+
+
+def page(items, next_url=None):
+    return Response(body={'items': items, '_links': {'next': {'href': next_url}} if next_url else {}},
+                    headers={'ETag': '"v1"'})
+
+
+ROOMS = {f'{BASE}/locations/loc-1/rooms': Response(body={'items': [{'roomId': 'room-1', 'name': 'Living Room'}]})}
+
+
+@pytest.fixture
+def listing():
+    return dict(ROOMS, **{
+        f'{BASE}/devices': page([device('d1', 'Living Room TV', capabilities=('switch', 'custom.launchapp'))], 'page-2'),
+        'page-2': page([device('d2', 'Bedroom Lamp', room='room-2', manufacturer='IKEA')])
+    })
+
+
+def test_lists_every_page_and_indexes_devices(tmp_path, listing):
+    api = FakeAPI(listing)
+    catalog = DeviceCatalog(api, tmp_path / 'catalog.json')
+    assert catalog.ensure_fresh() == 'listed'
+    assert set(catalog.devices) == {'d1', 'd2'}
+    assert catalog.stats()['truncated'] is False
+    assert [d['device_id'] for d in catalog.query(capabilities=['custom.launchapp'])] == ['d1']
+    assert [d['device_id'] for d in catalog.query(room='living room')] == ['d1']
+    assert [d['device_id'] for d in catalog.query(label='lamp', manufacturer='ikea')] == ['d2']
+    assert [d['device_id'] for d in catalog.query(text='bedroom')] == ['d2']
+    assert catalog.query(label='tv', manufacturer='ikea') == []
+    assert api.primed['d1'] == {'main': ['custom.launchapp', 'switch']}
+
+
+def test_stops_at_max_pages_and_marks_listing_truncated(tmp_path, listing, monkeypatch, caplog):
+    monkeypatch.setattr(app_module.config, 'DISCOVERY_MAX_PAGES', 1)
+    catalog = DeviceCatalog(FakeAPI(listing), tmp_path / 'catalog.json')
+    assert catalog.ensure_fresh() == 'listed'
+    assert set(catalog.devices) == {'d1'}
+    assert catalog.stats()['truncated'] is True
+    assert catalog.document['truncated'] is True
+    assert 'DISCOVERY_MAX_PAGES' in caplog.text
+
+
+def test_discovery_response_reports_truncation(monkeypatch, listing, tmp_path):
+    monkeypatch.setattr(app_module.config, 'DISCOVERY_MAX_PAGES', 1)
+    catalog = DeviceCatalog(FakeAPI(listing), tmp_path / 'catalog.json')
+    monkeypatch.setitem(app_module.device_catalogs, app_module.DEFAULT_ACCOUNT, catalog)
+    payload, status_code = app_module.discovery_payload({})
+    assert status_code == 200
+    assert payload['truncated'] is True
+    assert payload['total'] == 1
+
+
+def test_expired_listing_is_revalidated_with_etag(tmp_path, listing, monkeypatch):
+    api = FakeAPI(listing)
+    catalog = DeviceCatalog(api, tmp_path / 'catalog.json')
+    catalog.ensure_fresh()
+    assert catalog.ensure_fresh() == 'hit'
+    monkeypatch.setattr(app_module.config, 'DISCOVERY_TTL', 0)
+    api.http.routes[f'{BASE}/devices'] = lambda headers: Response(304) if headers.get('If-None-Match') == '"v1"' else page([])
+    assert catalog.ensure_fresh() == 'revalidated'
+    assert set(catalog.devices) == {'d1', 'd2'}
+
+
+def test_failed_revalidation_serves_stale_listing(tmp_path, listing, monkeypatch):
+    api = FakeAPI(listing)
+    catalog = DeviceCatalog(api, tmp_path / 'catalog.json')
+    catalog.ensure_fresh()
+    monkeypatch.setattr(app_module.config, 'DISCOVERY_TTL', 0)
+    api.http.routes[f'{BASE}/devices'] = requests.exceptions.ConnectionError('down')
+    assert catalog.ensure_fresh() == 'stale'
+    assert set(catalog.devices) == {'d1', 'd2'}
+
+
+def test_first_listing_failure_raises(tmp_path):
+    api = FakeAPI({f'{BASE}/devices': requests.exceptions.ConnectionError('down')})
+    with pytest.raises(requests.exceptions.ConnectionError):
+        DeviceCatalog(api, tmp_path / 'catalog.json').ensure_fresh()
+
+
+def test_other_worker_picks_up_saved_listing(tmp_path, listing):
+    DeviceCatalog(FakeAPI(listing), tmp_path / 'catalog.json').ensure_fresh()
+    other_api = FakeAPI({})
+    other = DeviceCatalog(other_api, tmp_path / 'catalog.json')
+    assert other.ensure_fresh() == 'hit'
+    assert set(other.devices) == {'d1', 'd2'}
+    assert other_api.http.calls == []
@@ -0,0 +1,148 @@
+"""DeviceRegistry: target lookup, command templates, sources and hot reload of the registry file"""
+
+import json
+import threading
+
+import pytest
+
+import app as app_module
+from credentials import DEFAULT_ACCOUNT
+from registry import DeviceEntry, DeviceRegistry, build_launch_payload
+from storage import atomic_write_json
+
+DOCUMENT = {
+    'default_target': 'Living',
+    'devices': {
+        'Living': {'device_id': 'AAAA-1111', 'name': 'Living Room TV', 'aliases': ['Lounge', 'bbbb-2222']},
+        'bedroom': {'device_id': 'BBBB-2222', 'app_id': 'bedroom-app', 'account': 'Smith',
+                    'commands': {
+                        'launch': [{'capability': 'custom.launchapp', 'command': 'launchApp', 'arguments': ['{app_id}']}],
+                        'off': [{'capability': 'switch', 'command': 'off'}]
+                    }}
+    }
+}
+
+
+@pytest.fixture(autouse=True)
+def reload_every_call(monkeypatch):
+    monkeypatch.setattr(app_module.config, 'DEVICE_REGISTRY_RELOAD_INTERVAL', 0)
+
+
+@pytest.fixture
+def registry_file(tmp_path):
+    path = tmp_path / 'devices.json'
+    atomic_write_json(path, DOCUMENT)
+    return path
+
+
+def test_lookup_by_name_alias_and_device_id(registry_file):
+    registry = DeviceRegistry(registry_file)
+    assert registry.get('living').key == 'living'
+    assert registry.get('LOUNGE').key == 'living'
+    assert registry.get('aaaa-1111').key == 'living'
+    assert registry.get(None).key == 'living'  # default_target
+    assert registry.get('nowhere') is None
+    assert registry.targets() == ['bedroom', 'living']
+    assert registry.source == str(registry_file)
+
+
+def test_alias_wins_over_another_devices_id(registry_file):
+    registry = DeviceRegistry(registry_file)
+    # "bbbb-2222" is bedroom's device ID but also an alias of living
+    assert registry.get('bbbb-2222').key == 'living'
+
+
+def test_accounts_and_device_ids(registry_file):
+    registry = DeviceRegistry(registry_file)
+    assert registry.get('bedroom').account == 'smith'
+    assert registry.get('living').account == DEFAULT_ACCOUNT
+    assert registry.device_ids() == ['AAAA-1111', 'BBBB-2222']
+    assert registry.device_ids('smith') == ['BBBB-2222']
+
+
+def test_command_templates(registry_file):
+    registry = DeviceRegistry(registry_file)
+    bedroom = registry.get('bedroom')
+    assert bedroom.build_payload('launch') == {'commands': [
+        {'component': 'main', 'capability': 'custom.launchapp', 'command': 'launchApp', 'arguments': ['bedroom-app']}
+    ]}
+    assert bedroom.build_payload('launch', 'other-app')['commands'][0]['arguments'] == ['other-app']
+    assert bedroom.build_payload('off') == {'commands': [{'component': 'main', 'capability': 'switch', 'command': 'off'}]}
+    assert bedroom.build_payload('reboot') is None
+    # Without a template, launch is power on + launchApp
+    living = registry.get('living')
+    assert living.build_payload('launch', 'x') == build_launch_payload('x')
+    assert living.build_payload('off') is None
+
+
+@pytest.mark.parametrize('data, message', [
+    ({'name': 'No ID'}, 'no device_id'),
+    ({'device_id': 'X', 'local': {'mac': 'aa:bb:cc:dd:ee:ff'}}, 'without a host'),
+])
+def test_invalid_entries_are_rejected(data, message):
+    with pytest.raises(ValueError, match=message):
+        DeviceEntry.from_dict('tv', data)
+
+
+def test_file_changes_are_picked_up(registry_file):
+    registry = DeviceRegistry(registry_file)
+    document = json.loads(json.dumps(DOCUMENT))
+    document['devices']['kitchen'] = {'device_id': 'CCCC-3333'}
+    atomic_write_json(registry_file, document)
+    assert registry.get('kitchen').device_id == 'CCCC-3333'
+
+
+def test_invalid_file_keeps_previous_registry(registry_file):
+    registry = DeviceRegistry(registry_file)
+    registry_file.write_text('{"devices": {"broken": {}}}')
+    assert registry.get('living') is not None
+    assert registry.get('broken') is None
+    registry_file.write_text('not json')
+    assert registry.targets() == ['bedroom', 'living']
+
+
+def test_reload_interval_limits_file_checks(registry_file, monkeypatch):
+    monkeypatch.setattr(app_module.config, 'DEVICE_REGISTRY_RELOAD_INTERVAL', 3600)
+    registry = DeviceRegistry(registry_file)
+    registry.get('living')  # Schedules the next check an hour from now
+    atomic_write_json(registry_file, {'devices': {'kitchen': {'device_id': 'CCCC-3333'}}})
+    assert registry.get('kitchen') is None
+    assert registry.reload() is True
+    assert registry.get('kitchen') is not None
+
+
+def test_inline_json_and_legacy_fallback(tmp_path, monkeypatch):
+    inline = DeviceRegistry(tmp_path / 'missing.json', json.dumps(DOCUMENT))
+    assert inline.source == 'DEVICE_REGISTRY'
+    assert inline.get('lounge').key == 'living'
+    monkeypatch.setattr(app_module.config, 'TV_DEVICE_ID_S95', 'S95-ID')
+    monkeypatch.setattr(app_module.config, 'TV_DEVICE_ID_M7', '')
+    legacy = DeviceRegistry(tmp_path / 'missing.json')
+    assert legacy.source == 'environment'
+    assert legacy.targets() == ['s95']
+    assert legacy.get(None).device_id == 'S95-ID'
+
+
+def test_readers_never_see_a_partial_registry_during_reloads(registry_file):
+    registry = DeviceRegistry(registry_file)
+    stop = threading.Event()
+    missing = []
+
+    def read():
+        while not stop.is_set():
+            if registry.get('living') is None or registry.get('lounge') is None:
+                missing.append(True)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    for index in range(50):
+        document = json.loads(json.dumps(DOCUMENT))
+        document['devices'][f'extra{index}'] = {'device_id': f'EXTRA-{index}'}
+        atomic_write_json(registry_file, document, fsync=False)
+        registry.reload()
+    stop.set()
+    for reader in readers:
+        reader.join()
+    assert missing == []
+    assert 'extra49' in registry.targets()
@@ -0,0 +1,114 @@
+"""DNS cache: scoped to the SmartThings hosts of the pooled clients, never patched into socket"""
+
+import asyncio
+import socket
+import threading
+
+import pytest
+import requests
+
+import asgi_app
+import dns_cache
+from http_client import PooledHTTPClient
+
+
+def fake_resolver(calls):
+    def resolve(host, port, family=0, type=0, proto=0, flags=0):
+        calls.append(host)
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port)),
+                (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))]
+    return resolve
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    calls = []
+    cache = dns_cache.DNSCache(300, ['https://api.example.test/v1'])
+    monkeypatch.setattr(cache, '_resolve', fake_resolver(calls))
+    cache.calls = calls
+    return cache
+
+
+def test_import_leaves_getaddrinfo_alone():
+    assert socket.getaddrinfo is dns_cache.dns_cache._resolve
+
+
+def test_lookups_are_cached(cache):
+    assert cache.addresses('api.example.test', 443) == ['127.0.0.1']
+    assert cache.addresses('api.example.test', 443) == ['127.0.0.1']
+    assert cache.calls == ['api.example.test']
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_other_hosts_are_not_cached(cache):
+    cache.getaddrinfo('tv.lan', 8001)
+    cache.getaddrinfo('tv.lan', 8001)
+    assert cache.calls == ['tv.lan', 'tv.lan']
+    assert not cache.caches('tv.lan')
+
+
+def test_stale_addresses_served_when_lookup_fails(cache, monkeypatch):
+    cache.addresses('api.example.test', 443)
+    cache._entries = {key: (0, result) for key, (_, result) in cache._entries.items()}
+
+    def fail(*args):
+        raise socket.gaierror('lookup failed')
+    monkeypatch.setattr(cache, '_resolve', fail)
+    assert cache.addresses('api.example.test', 443) == ['127.0.0.1']
+    assert cache.stale_served == 1
+
+
+def test_session_connections_use_the_cache(cache, monkeypatch):
+    """requests through a pooled client resolve the cached host without touching socket.getaddrinfo"""
+    monkeypatch.setattr(dns_cache, 'dns_cache', cache)
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+    session = PooledHTTPClient()._build_session()
+    with pytest.raises(requests.exceptions.RequestException):
+        session.get(f'http://api.example.test:{port}/', timeout=0.5)
+    conn, _ = server.accept()
+    assert b'Host: api.example.test' in conn.recv(1024)
+    conn.close()
+    server.close()
+    assert cache.calls == ['api.example.test']
+
+
+def test_async_backend_uses_the_cache(cache, monkeypatch):
+    monkeypatch.setattr(asgi_app, 'dns_cache', cache)
+    connected = []
+
+    class Backend:
+        async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+            connected.append(host)
+            return host
+
+    backend = asgi_app.CachedDNSBackend(Backend())
+    assert asyncio.run(backend.connect_tcp('api.example.test', 443)) == '127.0.0.1'
+    assert asyncio.run(backend.connect_tcp('tv.lan', 8001)) == 'tv.lan'
+    assert connected == ['127.0.0.1', 'tv.lan']
+
+
+def test_import_starts_no_background_threads():
+    names = [thread.name for thread in threading.enumerate()]
+    assert not [name for name in names if name.startswith(('token-refresher', 'upstream-warmer', 'command-replayer'))]
+
+
+def test_async_transport_uses_cached_backend():
+    import asgi_app
+
+    transport = asgi_app.cached_dns_transport()
+    assert isinstance(transport._pool._network_backend, asgi_app.CachedDNSBackend)
+
+
+def test_async_transport_without_backend_is_left_alone(monkeypatch):
+    import asgi_app
+
+    class Transport:
+        _pool = None
+
+        def __init__(self, **kwargs):
+            pass
+    monkeypatch.setattr(asgi_app.httpx, 'AsyncHTTPTransport', Transport)
+    assert isinstance(asgi_app.cached_dns_transport(), Transport)
@@ -0,0 +1,122 @@
+"""Hub channel line protocol: parsing, reply format, authentication and explicit startup"""
+
+import socket
+import time
+
+import pytest
+
+import app
+from hub_channel import HubChannel
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_parse_target_and_fields():
+    seq, op, fields = HubChannel.parse('7 LAUNCH s95 app=org.example%20app async=1')
+    assert (seq, op) == ('7', 'launch')
+    assert fields == {'target': 's95', 'app': 'org.example app', 'async': '1'}
+
+
+def test_parse_without_target():
+    assert HubChannel.parse('3 ping') == ('3', 'ping', {})
+
+
+@pytest.mark.parametrize('line', ['launch s95', '7', 'x launch', '7 launch s95 m7'])
+def test_parse_rejects_malformed_lines(line):
+    with pytest.raises(ValueError):
+        HubChannel.parse(line)
+
+
+def test_minimal_reply_skips_success_and_empty_values():
+    reply = HubChannel.format_reply('5', 200, {'success': True, 'status': 'launched', 'deduplicated': None, 'queued': True})
+    assert reply == b'5 200 status=launched queued=1\n'
+
+
+def test_minimal_reply_encodes_values():
+    reply = HubChannel.format_reply('5', 404, {'success': False, 'error': 'Unknown target s 95'})
+    assert reply == b'5 404 error=Unknown%20target%20s%2095\n'
+
+
+def test_full_reply_is_compact_json():
+    assert HubChannel.format_reply('9', 200, {'success': True, 'device': 'TV'}, minimal=False) == \
+        b'9 200 {"success":true,"device":"TV"}\n'
+
+
+def test_import_does_not_start_the_channel():
+    assert not app.hub_channel.running
+
+
+class Connection:
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.file = self.sock.makefile('rwb')
+
+    def send(self, line):
+        self.file.write(line.encode() + b'\n')
+        self.file.flush()
+        return self.file.readline().decode().rstrip('\n')
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+@pytest.fixture
+def channel(monkeypatch):
+    """A channel on a free local port whose launches are recorded instead of sent"""
+    monkeypatch.setattr(app.config, 'HUB_CHANNEL_HOST', '127.0.0.1')
+    launches = []
+
+    def launch(fields):
+        launches.append(fields)
+        return {'success': True, 'status': 'launched'}, 200, fields.get('ack') != 'full'
+
+    hub = HubChannel(free_port(), launch)
+    hub.launches = launches
+    hub.start()
+    deadline = time.time() + 5
+    while not hub.listening and time.time() < deadline:
+        time.sleep(0.01)
+    assert hub.listening
+    return hub
+
+
+def test_launch_over_open_channel(channel, monkeypatch):
+    monkeypatch.setattr(app.config, 'HUB_CHANNEL_TOKEN', '')
+    conn = Connection(channel.port)
+    assert conn.send('1 ping') == '1 200'
+    assert conn.send('2 launch s95 action=launch idem=k1') == '2 200 status=launched'
+    assert conn.send('3 launch s95 ack=full') == '3 200 {"success":true,"status":"launched"}'
+    assert conn.send('4 frob') == "4 400 error=Unknown%20operation%20%27frob%27"
+    conn.close()
+    assert channel.launches[0] == {'target': 's95', 'action': 'launch', 'idem': 'k1'}
+
+
+def test_token_required_before_launch(channel, monkeypatch):
+    monkeypatch.setattr(app.config, 'HUB_CHANNEL_TOKEN', 'channel-secret')
+    conn = Connection(channel.port)
+    assert conn.send('1 launch s95').startswith('1 401 ')
+    # The connection is closed after a failed authentication
+    assert conn.file.readline() == b''
+    conn.close()
+    assert channel.launches == []
+
+
+def test_wrong_token_is_rejected(channel, monkeypatch):
+    monkeypatch.setattr(app.config, 'HUB_CHANNEL_TOKEN', 'channel-secret')
+    conn = Connection(channel.port)
+    assert conn.send('1 auth token=nope').startswith('1 401 ')
+    conn.close()
+
+
+def test_authenticated_connection_can_launch(channel, monkeypatch):
+    monkeypatch.setattr(app.config, 'HUB_CHANNEL_TOKEN', 'channel-secret')
+    conn = Connection(channel.port)
+    assert conn.send('1 auth token=channel-secret') == '1 200'
+    assert conn.send('2 launch s95') == '2 200 status=launched'
+    conn.close()
+    assert len(channel.launches) == 1
@@ -0,0 +1,84 @@
+import fcntl
+import hashlib
+import threading
+import time
+
+import pytest
+
+import app as app_module
+from app import launch_payload
+from launches import LaunchDeduplicator
+
+
+@pytest.fixture
+def short_waits(monkeypatch):
+    monkeypatch.setattr(app_module.config, 'HTTP_CONNECT_TIMEOUT', 0.1)
+    monkeypatch.setattr(app_module.config, 'HTTP_READ_TIMEOUT', 0.1)
+
+
+def hold_lock(state_dir, key):
+    digest = hashlib.sha1(key.encode()).hexdigest()
+    lock_file = open(state_dir / f'{digest}.lock', 'a')
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    return lock_file
+
+
+def test_fresh_launch_and_replay(tmp_path):
+    dedup = LaunchDeduplicator(tmp_path)
+    calls = []
+
+    def launch():
+        calls.append(1)
+        return True, {'ok': True}
+    assert dedup.run('k', 5, launch) == (True, {'ok': True}, None)
+    assert dedup.run('k', 5, launch) == (True, {'ok': True}, 'replayed')
+    assert len(calls) == 1
+
+
+def test_lock_held_by_another_worker_is_in_progress(tmp_path, short_waits):
+    dedup = LaunchDeduplicator(tmp_path)
+    lock_file = hold_lock(tmp_path, 'k')
+    calls = []
+    try:
+        success, result, state = dedup.run('k', 5, lambda: calls.append(1) or (True, {}))
+    finally:
+        lock_file.close()
+    assert (success, state) == (False, 'in_progress')
+    assert 'in progress' in result
+    assert calls == []
+    # The failure is not replayed: the next launch goes ahead once the lock is free
+    assert dedup.run('k', 5, lambda: (True, {'ok': True})) == (True, {'ok': True}, None)
+
+
+def test_timeout_from_the_launch_itself_propagates(tmp_path):
+    dedup = LaunchDeduplicator(tmp_path)
+
+    def launch():
+        raise TimeoutError('Timed out waiting for lock tokens.lock')
+    with pytest.raises(TimeoutError):
+        dedup.run('k', 5, launch)
+    assert dedup.stats()['in_flight'] == 0
+
+
+def test_waiter_that_gives_up_is_in_progress(short_waits):
+    dedup = LaunchDeduplicator()
+    release = threading.Event()
+    leader = threading.Thread(target=dedup.run, args=('k', 5, lambda: release.wait(5) and (True, {})))
+    leader.start()
+    try:
+        while dedup.stats()['in_flight'] == 0:
+            time.sleep(0.01)
+        success, _, state = dedup.run('k', 5, lambda: (True, {}))
+    finally:
+        release.set()
+        leader.join()
+    assert (success, state) == (False, 'in_progress')
+
+
+@pytest.mark.parametrize('minimal', [False, True])
+def test_in_progress_is_a_409(minimal):
+    payload, status_code = launch_payload({'device_name': 'Test TV'}, False, 'Identical launch still in progress', 'in_progress', minimal)
+    assert status_code == 409
+    assert payload['success'] is False
+    _, status_code = launch_payload({'device_name': 'Test TV'}, False, 'HTTP 500', None, minimal)
+    assert status_code == 500
@@ -0,0 +1,103 @@
+import pytest
+
+import app as app_module
+from app import plan_launch
+from settings import parse_bool
+
+
+@pytest.mark.parametrize('value, expected', [
+    (True, True), (False, False), (1, True), (0, False),
+    ('true', True), ('False', False), ('1', True), ('0', False), (' yes ', True), ('no', False),
+    ('maybe', None), ('', None), (2, None), (None, None), ([], None),
+])
+def test_parse_bool(value, expected):
+    assert parse_bool(value) is expected
+
+
+def test_parse_bool_default():
+    assert parse_bool('maybe', False) is False
+    assert parse_bool(None, True) is True
+
+
+@pytest.mark.parametrize('value, expected', [
+    (True, True), (False, False), ('false', False), ('0', False), ('true', True), (0, False),
+])
+def test_plan_launch_smart_values(value, expected):
+    plan, error, status_code = plan_launch({'smart': value})
+    assert error is None
+    assert plan['smart'] is expected
+
+
+def test_plan_launch_smart_default(monkeypatch):
+    monkeypatch.setattr(app_module.config, 'SMART_LAUNCH', True)
+    plan, _, _ = plan_launch({})
+    assert plan['smart'] is True
+    plan, _, _ = plan_launch({'smart': None})
+    assert plan['smart'] is True
+
+
+@pytest.mark.parametrize('value', ['maybe', 2, [], {'on': True}])
+def test_plan_launch_rejects_non_boolean_smart(value):
+    plan, error, status_code = plan_launch({'smart': value})
+    assert plan is None
+    assert status_code == 400
+    assert 'smart' in error
+
+
+def test_launch_route_rejects_non_boolean_smart():
+    response = app_module.app.test_client().post('/launch-tv-app', json={'smart': 'sometimes'})
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+
+
+def test_hub_channel_smart_field_is_validated():
+    payload, status_code, _ = app_module.hub_channel_launch({'smart': 'sometimes'})
+    assert status_code == 400
+    assert 'smart' in payload['error']
+
+
+def test_plan_batch_default_deadline():
+    batch, error, _ = app_module.plan_batch({'targets': ['tv']})
+    assert error is None
+    assert batch['deadline'] == app_module.config.BATCH_DEFAULT_DEADLINE
+
+
+@pytest.mark.parametrize('value, expected', [(5, 5.0), ('2.5', 2.5), (0.1, 0.1)])
+def test_plan_batch_deadline(value, expected):
+    batch, error, _ = app_module.plan_batch({'targets': ['tv'], 'deadline': value})
+    assert error is None
+    assert batch['deadline'] == expected
+
+
+def test_plan_batch_deadline_within_launch_budget(monkeypatch):
+    monkeypatch.setattr(app_module.config, 'LAUNCH_TIME_BUDGET', 28)
+    batch, error, status_code = app_module.plan_batch({'targets': ['tv'], 'deadline': 3600})
+    assert batch is None
+    assert status_code == 400
+    assert 'LAUNCH_TIME_BUDGET' in error
+    batch, error, _ = app_module.plan_batch({'targets': ['tv'], 'deadline': 28})
+    assert batch['deadline'] == 28
+
+
+def test_plan_batch_default_deadline_capped(monkeypatch):
+    monkeypatch.setattr(app_module.config, 'LAUNCH_TIME_BUDGET', 5)
+    monkeypatch.setattr(app_module.config, 'BATCH_DEFAULT_DEADLINE', 60)
+    batch, _, _ = app_module.plan_batch({'targets': ['tv']})
+    assert batch['deadline'] == 5
+    monkeypatch.setattr(app_module.config, 'LAUNCH_TIME_BUDGET', 0)
+    batch, _, _ = app_module.plan_batch({'targets': ['tv'], 'deadline': 3600})
+    assert batch['deadline'] == 3600
+
+
+@pytest.mark.parametrize('value', [0, '0', -1, float('nan'), 'NaN', float('inf'), '-inf', 'soon', [], True])
+def test_plan_batch_rejects_bad_deadline(value):
+    batch, error, status_code = app_module.plan_batch({'targets': ['tv'], 'deadline': value})
+    assert batch is None
+    assert status_code == 400
+    assert 'deadline' in error
+
+
+def test_plan_batch_requires_launches():
+    batch, error, status_code = app_module.plan_batch({'targets': []})
+    assert batch is None
+    assert status_code == 400
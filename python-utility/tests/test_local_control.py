@@ -0,0 +1,81 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import app as app_module
+from local_control import LocalControlError, LocalTVTransport
+
+
+@pytest.fixture
+def api(monkeypatch):
+    api = app_module.st_api
+    calls = []
+
+    def cloud(device_id, app_id, payload, replay_deadline=None):
+        calls.append(device_id)
+        return True, {'transport': 'cloud'}
+    monkeypatch.setattr(api, '_launch_app', cloud)
+    monkeypatch.setattr(api, 'cloud_calls', calls, raising=False)
+    return api
+
+
+def failing_local(seconds):
+    def launch_app(device_id, app_id, payload, deadline=None):
+        launch_app.deadline = deadline
+        time.sleep(seconds)
+        return False, 'TV did not wake'
+    return launch_app
+
+
+def test_cloud_fallback_after_local_failure(api, monkeypatch):
+    monkeypatch.setattr(api.local, 'launch_app', failing_local(0))
+    success, result = api.launch_app('device-tv', 'test-app')
+    assert success is True
+    assert result['transport'] == 'cloud'
+    assert api.cloud_calls == ['device-tv']
+
+
+def test_local_deadline_leaves_room_for_the_cloud(api, monkeypatch):
+    local = failing_local(0)
+    monkeypatch.setattr(api.local, 'launch_app', local)
+    monkeypatch.setattr(app_module.config, 'LAUNCH_TIME_BUDGET', 28)
+    before = time.monotonic()
+    api.launch_app('device-tv', 'test-app')
+    reserve = app_module.config.HTTP_CONNECT_TIMEOUT + app_module.config.HTTP_READ_TIMEOUT
+    assert local.deadline <= before + 28 - reserve + 0.1
+
+
+def test_cloud_fallback_skipped_when_budget_is_used_up(api, monkeypatch):
+    monkeypatch.setattr(api.local, 'launch_app', failing_local(0.2))
+    monkeypatch.setattr(app_module.config, 'HTTP_CONNECT_TIMEOUT', 0.1)
+    monkeypatch.setattr(app_module.config, 'HTTP_READ_TIMEOUT', 0.1)
+    monkeypatch.setattr(app_module.config, 'LAUNCH_TIME_BUDGET', 0.25)
+    success, result = api.launch_app('device-tv', 'test-app')
+    assert success is False
+    assert 'LAUNCH_TIME_BUDGET' in result
+    assert api.cloud_calls == []
+
+
+def test_budget_zero_always_falls_back(api, monkeypatch):
+    local = failing_local(0)
+    monkeypatch.setattr(api.local, 'launch_app', local)
+    monkeypatch.setattr(app_module.config, 'LAUNCH_TIME_BUDGET', 0)
+    success, _ = api.launch_app('device-tv', 'test-app')
+    assert success is True
+    assert local.deadline is None
+
+
+def test_wake_wait_ends_at_the_deadline(monkeypatch):
+    transport = LocalTVTransport()
+    polls = []
+    monkeypatch.setattr(transport, '_power_state', lambda base_url, timeout=None: polls.append(timeout) or 'standby')
+    monkeypatch.setattr(LocalTVTransport, 'wake', staticmethod(lambda mac, broadcast: None))
+    monkeypatch.setattr(app_module.config, 'LOCAL_TV_WAKE_TIMEOUT', 30)
+    monkeypatch.setattr(app_module.config, 'LOCAL_TV_TIMEOUT', 0.1)
+    entry = SimpleNamespace(name='Test TV', local={'host': '192.0.2.1', 'mac': 'aa:bb:cc:dd:ee:ff'})
+    started = time.monotonic()
+    with pytest.raises(LocalControlError, match='did not wake'):
+        transport._launch(entry, True, 'test-app', started + 0.7)
+    assert time.monotonic() - started < 1
+    assert all(timeout <= 0.1 for timeout in polls[1:])
@@ -0,0 +1,207 @@
+"""Circuit breaker, token bucket and the per-endpoint UpstreamGuard that combines them"""
+
+import threading
+import time
+
+import pytest
+
+import app as app_module
+from resilience import CircuitBreaker, TokenBucket, UpstreamGuard, UpstreamUnavailable, retry_after_seconds
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture
+def breaker_config(monkeypatch):
+    for name, value in {'BREAKER_WINDOW': 30, 'BREAKER_MIN_CALLS': 4, 'BREAKER_ERROR_RATE': 0.5,
+                        'BREAKER_OPEN_SECONDS': 10, 'BREAKER_HALF_OPEN_PROBES': 1}.items():
+        monkeypatch.setattr(app_module.config, name, value)
+
+
+def trip(breaker):
+    for failed in (True, False, True, True):
+        breaker.record(failed)
+
+
+def test_breaker_stays_closed_below_min_calls(clock, breaker_config):
+    breaker = CircuitBreaker('device_command')
+    for _ in range(3):
+        breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow() == (True, 0.0)
+
+
+def test_breaker_opens_at_error_rate_and_fails_fast(clock, breaker_config):
+    breaker = CircuitBreaker('device_command')
+    trip(breaker)
+    assert breaker.state == CircuitBreaker.OPEN
+    allowed, retry_in = breaker.allow()
+    assert not allowed and retry_in == pytest.approx(10)
+    assert breaker.stats()['rejected'] == 1
+    assert breaker.stats()['times_opened'] == 1
+
+
+def test_breaker_ignores_failures_outside_the_window(clock, breaker_config):
+    breaker = CircuitBreaker('device_command')
+    for _ in range(3):
+        breaker.record(True)
+    clock.advance(31)
+    for _ in range(3):
+        breaker.record(False)
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.stats()['window_calls'] == 4
+
+
+def test_half_open_probe_success_closes(clock, breaker_config):
+    breaker = CircuitBreaker('device_command')
+    trip(breaker)
+    clock.advance(10)
+    assert breaker.allow() == (True, 0.0)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()[0] is False  # Only one probe at a time
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.stats()['window_calls'] == 0
+
+
+def test_half_open_probe_failure_reopens(clock, breaker_config):
+    breaker = CircuitBreaker('device_command')
+    trip(breaker)
+    clock.advance(10)
+    breaker.allow()
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.stats()['times_opened'] == 2
+
+
+def test_half_open_probe_without_verdict_frees_the_slot(clock, breaker_config):
+    breaker = CircuitBreaker('device_command')
+    trip(breaker)
+    clock.advance(10)
+    breaker.allow()
+    breaker.record(None)  # e.g. a 429
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow() == (True, 0.0)
+
+
+def test_half_open_admits_one_probe_under_concurrency(clock, breaker_config):
+    breaker = CircuitBreaker('device_command')
+    trip(breaker)
+    clock.advance(10)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(breaker.allow()[0])) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 1
+
+
+def test_bucket_allows_burst_then_asks_callers_to_wait(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    assert [bucket.reserve(max_wait=5) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve(max_wait=5) == pytest.approx(0.5)
+    assert bucket.reserve(max_wait=5) == pytest.approx(1.0)  # Queued behind the previous reservation
+    assert bucket.stats()['throttled'] == 2
+
+
+def test_bucket_refuses_waits_longer_than_max_wait(clock):
+    bucket = TokenBucket(rate=1, burst=1)
+    bucket.reserve(max_wait=0)
+    assert bucket.reserve(max_wait=0.5) is None
+    assert bucket.stats()['rejected'] == 1
+    clock.advance(1)
+    assert bucket.reserve(max_wait=0) == 0.0
+
+
+def test_bucket_pause_holds_every_call(clock):
+    bucket = TokenBucket(rate=100, burst=10)
+    bucket.pause(3)
+    assert bucket.reserve(max_wait=5) == pytest.approx(3)
+    assert bucket.reserve(max_wait=1) is None
+    clock.advance(3)
+    assert bucket.reserve(max_wait=1) < 0.1
+
+
+def test_bucket_rate_zero_only_honours_pauses(clock):
+    bucket = TokenBucket(rate=0, burst=1)
+    assert all(bucket.reserve(max_wait=0) == 0.0 for _ in range(50))
+    bucket.pause(2)
+    assert bucket.reserve(max_wait=1) is None
+
+
+def test_bucket_hands_out_burst_exactly_once_under_concurrency(clock):
+    bucket = TokenBucket(rate=0.001, burst=5)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(bucket.reserve(max_wait=0))) for _ in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(0.0) == 5
+    assert results.count(None) == 45
+
+
+@pytest.mark.parametrize('headers, expected', [
+    ({'Retry-After': '7'}, 7.0),
+    ({'Retry-After': '-3'}, 0.0),
+    ({'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '2500'}, 2.5),
+    ({'X-RateLimit-Remaining': '4', 'X-RateLimit-Reset': '2500'}, None),
+    ({}, None),
+])
+def test_retry_after_seconds(headers, expected):
+    assert retry_after_seconds(headers) == expected
+
+
+def test_guard_rejects_calls_while_circuit_is_open(clock, breaker_config):
+    guard = UpstreamGuard()
+    for status_code in (500, 200, 503, None):
+        guard.before('device_command')
+        guard.after('device_command', status_code)
+    with pytest.raises(UpstreamUnavailable) as error:
+        guard.before('device_command')
+    assert error.value.reason == 'circuit_open'
+    assert guard.open_circuits() == ['device_command']
+    # Other endpoints have their own breaker
+    assert guard.before('device_status') == 0.0
+
+
+def test_guard_counts_4xx_as_healthy_and_429_as_no_verdict(clock, breaker_config):
+    guard = UpstreamGuard()
+    for _ in range(10):
+        guard.before('device_command')
+        guard.after('device_command', 404)
+    guard.before('device_command')
+    guard.after('device_command', 429)
+    stats = guard.stats()['device_command']
+    assert stats['circuit']['state'] == 'closed'
+    assert stats['circuit']['window_failures'] == 0
+    assert stats['rate_limit']['paused_for'] == pytest.approx(TokenBucket.DEFAULT_PAUSE)
+
+
+def test_guard_rejects_when_rate_limit_wait_is_too_long(clock, breaker_config, monkeypatch):
+    monkeypatch.setattr(app_module.config, 'UPSTREAM_RATE_MAX_WAIT', 1)
+    guard = UpstreamGuard()
+    guard.before('device_command')
+    guard.after('device_command', 429, {'Retry-After': '30'})
+    with pytest.raises(UpstreamUnavailable) as error:
+        guard.before('device_command')
+    assert error.value.reason == 'rate_limited'
+    assert error.value.retry_after == pytest.approx(30)
@@ -0,0 +1,156 @@
+"""DeviceStateMirror: resyncs, webhook events, gaps that force a resync and sharing between workers"""
+
+import threading
+import time
+
+import pytest
+
+import app as app_module
+from device_state import DeviceStateMirror
+
+STATUS = {'components': {'main': {
+    'switch': {'switch': {'value': 'off', 'timestamp': '2026-01-01T00:00:00Z'}},
+    'audioVolume': {'volume': {'value': 10, 'timestamp': '2026-01-01T00:00:00Z'}}
+}}}
+
+
+def event(attribute='switch', value='on', capability='switch', event_time=None, device_id='tv-1'):
+    return {'eventType': 'DEVICE_EVENT', 'eventTime': event_time or iso(time.time()), 'deviceEvent': {
+        'deviceId': device_id, 'componentId': 'main', 'capability': capability,
+        'attribute': attribute, 'value': value
+    }}
+
+
+def iso(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)) + f'.{int(seconds % 1 * 1000):03d}Z'
+
+
+def value(mirror, capability='switch', attribute='switch', device_id='tv-1'):
+    snapshot, _ = mirror.snapshot(device_id)
+    return snapshot['components']['main'][capability][attribute]['value'] if snapshot else None
+
+
+@pytest.fixture(autouse=True)
+def mirror_config(monkeypatch):
+    monkeypatch.setattr(app_module.config, 'STATE_MIRROR', True)
+    monkeypatch.setattr(app_module.config, 'MIRROR_RESYNC_INTERVAL', 3600)
+    monkeypatch.setattr(app_module.config, 'MIRROR_EVENT_GRACE', 30)
+
+
+@pytest.fixture(params=['memory', 'files'])
+def mirror(request, tmp_path):
+    return DeviceStateMirror(tmp_path / 'mirror' if request.param == 'files' else None)
+
+
+def test_disabled_mirror_serves_nothing(mirror, monkeypatch):
+    mirror.resync('tv-1', STATUS, time.time())
+    monkeypatch.setattr(app_module.config, 'STATE_MIRROR', False)
+    assert mirror.snapshot('tv-1') == (None, None)
+    assert mirror.apply_events([event()]) == 0
+
+
+def test_resync_then_events_patch_the_snapshot(mirror):
+    assert mirror.snapshot('tv-1') == (None, None)
+    mirror.resync('tv-1', STATUS, time.time())
+    assert value(mirror) == 'off'
+    assert mirror.apply_events([event(value='on'), event('volume', 25, 'audioVolume')]) == 2
+    assert value(mirror) == 'on'
+    assert value(mirror, 'audioVolume', 'volume') == 25
+    assert mirror.stats()['events'] == 2
+
+
+def test_events_for_unsynced_devices_are_ignored(mirror):
+    assert mirror.apply_events([event(device_id='unknown')]) == 0
+    assert mirror.stats()['untracked'] == 1
+    assert mirror.snapshot('unknown') == (None, None)
+
+
+def test_out_of_order_events_are_skipped(mirror):
+    mirror.resync('tv-1', STATUS, time.time())
+    now = time.time()
+    mirror.apply_events([event(value='on', event_time=iso(now))])
+    mirror.apply_events([event(value='off', event_time=iso(now - 5))])
+    assert value(mirror) == 'on'
+    assert mirror.stats()['out_of_order'] == 1
+
+
+def test_resync_keeps_events_newer_than_the_fetched_document(mirror):
+    mirror.resync('tv-1', STATUS, time.time())
+    fetched_at = time.time()
+    mirror.apply_events([event(value='on', event_time=iso(fetched_at + 1))])
+    # A status document read before that event arrives late
+    mirror.resync('tv-1', STATUS, fetched_at)
+    assert value(mirror) == 'on'
+    assert value(mirror, 'audioVolume', 'volume') == 10
+
+
+def test_command_without_confirming_event_forces_resync(mirror, monkeypatch):
+    mirror.resync('tv-1', STATUS, time.time())
+    mirror.expect_event('tv-1')
+    assert value(mirror) == 'off'  # Still within the grace period
+    monkeypatch.setattr(app_module.config, 'MIRROR_EVENT_GRACE', 0)
+    time.sleep(0.01)
+    assert mirror.snapshot('tv-1') == (None, None)
+    mirror.apply_events([event(value='on')])
+    assert value(mirror) == 'on'
+
+
+def test_resync_interval(mirror, monkeypatch):
+    mirror.resync('tv-1', STATUS, time.time() - 10)
+    monkeypatch.setattr(app_module.config, 'MIRROR_RESYNC_INTERVAL', 5)
+    assert mirror.snapshot('tv-1') == (None, None)
+    mirror.resync('tv-1', STATUS, time.time())
+    assert value(mirror) == 'off'
+
+
+def test_gap_for_every_device_clears_only_with_a_later_resync(mirror):
+    before = time.time()
+    mirror.resync('tv-1', STATUS, before)
+    mirror.resync('tv-2', STATUS, before)
+    time.sleep(0.01)
+    mirror.mark_gap(None, 'resubscribed')
+    assert mirror.snapshot('tv-1') == (None, None)
+    assert mirror.snapshot('tv-2') == (None, None)
+    mirror.resync('tv-1', STATUS, before)  # Read before the gap: not enough
+    assert mirror.snapshot('tv-1') == (None, None)
+    mirror.resync('tv-1', STATUS, time.time())
+    assert value(mirror) == 'off'
+    assert mirror.snapshot('tv-2') == (None, None)
+
+
+def test_other_workers_see_events_through_the_state_directory(tmp_path):
+    receiver = DeviceStateMirror(tmp_path / 'mirror')
+    other = DeviceStateMirror(tmp_path / 'mirror')
+    receiver.resync('tv-1', STATUS, time.time())
+    other.resync('tv-1', STATUS, time.time())
+    receiver.apply_events([event(value='on')])
+    assert value(other) == 'on'
+
+
+def test_new_worker_resyncs_before_serving_older_state(tmp_path):
+    DeviceStateMirror(tmp_path / 'mirror').resync('tv-1', STATUS, time.time())
+    time.sleep(0.01)
+    restarted = DeviceStateMirror(tmp_path / 'mirror')
+    assert restarted.snapshot('tv-1') == (None, None)
+    restarted.resync('tv-1', STATUS, time.time())
+    assert value(restarted) == 'off'
+
+
+def test_concurrent_events_from_several_workers_are_all_applied(tmp_path):
+    workers = [DeviceStateMirror(tmp_path / 'mirror') for _ in range(4)]
+    workers[0].resync('tv-1', STATUS, time.time())
+    for worker in workers[1:]:
+        worker.resync('tv-1', STATUS, time.time())
+    now = time.time()
+
+    def send(index, worker):
+        for n in range(10):
+            worker.apply_events([event(f'attr{index}_{n}', n, 'custom', event_time=iso(now))])
+
+    threads = [threading.Thread(target=send, args=(i, w)) for i, w in enumerate(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    snapshot, _ = workers[0].snapshot('tv-1')
+    assert len(snapshot['components']['main']['custom']) == 40
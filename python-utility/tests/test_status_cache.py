@@ -0,0 +1,175 @@
+"""DeviceStatusCache: TTL hits, stale-while-revalidate, coalescing and invalidation of in-flight fetches"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from device_state import DeviceStatusCache
+
+
+class Loader:
+    """Returns status-1, status-2, ... and can hold each fetch until released"""
+
+    def __init__(self, gate=None):
+        self.calls = 0
+        self.gate = gate
+        self.started = threading.Event()
+
+    def __call__(self, key):
+        self.calls += 1
+        call = self.calls
+        self.started.set()
+        if self.gate is not None and call == 1:
+            self.gate.wait(5)
+        return f'status-{call}'
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_fresh_entries_are_hits():
+    cache = DeviceStatusCache(default_ttl=60, stale_seconds=0)
+    loader = Loader()
+    assert cache.get('tv', loader) == ('status-1', 'miss')
+    assert cache.get('tv', loader) == ('status-1', 'hit')
+    assert loader.calls == 1
+    assert cache.stats()['hit_ratio'] == 0.5
+
+
+def test_zero_ttl_bypasses_the_cache():
+    cache = DeviceStatusCache(default_ttl=60, stale_seconds=0)
+    loader = Loader()
+    assert cache.get('tv', loader, ttl=0) == ('status-1', 'bypass')
+    assert cache.get('tv', loader, ttl=0) == ('status-2', 'bypass')
+
+
+def test_stale_entry_is_served_while_one_fetch_revalidates():
+    cache = DeviceStatusCache(default_ttl=0.05, stale_seconds=60)
+    loader = Loader()
+    cache.get('tv', loader)
+    time.sleep(0.06)
+    assert cache.get('tv', loader) == ('status-1', 'stale')
+    assert cache.get('tv', loader)[0] == 'status-1'
+    wait_for(lambda: cache.peek('tv', 60)[0] == 'status-2')
+    assert loader.calls == 2
+    assert cache.stats()['revalidations'] == 1
+
+
+def test_expired_entry_past_stale_window_is_a_miss():
+    cache = DeviceStatusCache(default_ttl=0.01, stale_seconds=0.01)
+    loader = Loader()
+    cache.get('tv', loader)
+    time.sleep(0.03)
+    assert cache.get('tv', loader) == ('status-2', 'miss')
+
+
+def test_concurrent_misses_share_one_fetch():
+    gate = threading.Event()
+    cache = DeviceStatusCache(default_ttl=60, stale_seconds=0)
+    loader = Loader(gate)
+    results = []
+    leader = threading.Thread(target=lambda: results.append(cache.get('tv', loader)))
+    leader.start()
+    loader.started.wait(5)
+    waiter = threading.Thread(target=lambda: results.append(cache.get('tv', loader)))
+    waiter.start()
+    wait_for(lambda: cache.stats()['coalesced'] == 1)
+    gate.set()
+    leader.join()
+    waiter.join()
+    assert sorted(results) == [('status-1', 'coalesced'), ('status-1', 'miss')]
+    assert loader.calls == 1
+
+
+def test_failed_fetch_is_not_cached():
+    cache = DeviceStatusCache(default_ttl=60, stale_seconds=0)
+
+    def broken(key):
+        raise RuntimeError('upstream down')
+    assert cache.get('tv', broken) == (None, 'miss')
+    assert cache.get('tv', Loader()) == ('status-1', 'miss')
+    assert cache.stats()['errors'] == 1
+
+
+def test_invalidate_drops_the_entry():
+    cache = DeviceStatusCache(default_ttl=60, stale_seconds=0)
+    loader = Loader()
+    cache.get('tv', loader)
+    cache.invalidate('tv')
+    assert cache.get('tv', loader) == ('status-2', 'miss')
+
+
+def test_waiters_of_an_invalidated_fetch_fetch_again():
+    gate = threading.Event()
+    cache = DeviceStatusCache(default_ttl=60, stale_seconds=0)
+    loader = Loader(gate)
+    results = {}
+    leader = threading.Thread(target=lambda: results.setdefault('leader', cache.get('tv', loader)))
+    leader.start()
+    loader.started.wait(5)
+    waiter = threading.Thread(target=lambda: results.setdefault('waiter', cache.get('tv', loader)))
+    waiter.start()
+    wait_for(lambda: cache.stats()['coalesced'] == 1)
+    cache.invalidate('tv')  # A command was sent while status-1 was being read
+    gate.set()
+    leader.join()
+    waiter.join()
+    assert results['waiter'] == ('status-2', 'miss')
+    # The pre-command read was not cached; the waiter's fresh read was
+    assert cache.peek('tv', 60)[0] == 'status-2'
+    assert loader.calls == 2
+
+
+def test_async_waiters_of_an_invalidated_fetch_fetch_again():
+    cache = DeviceStatusCache(default_ttl=60, stale_seconds=0)
+    calls = []
+
+    async def loader(key):
+        calls.append(key)
+        if len(calls) == 1:
+            await asyncio.sleep(0.05)
+        return f'status-{len(calls)}'
+
+    async def scenario():
+        leader = asyncio.create_task(cache.aget('tv', loader))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(cache.aget('tv', loader))
+        await asyncio.sleep(0.01)
+        cache.invalidate('tv')
+        return await leader, await waiter
+
+    leader, waiter = asyncio.run(scenario())
+    assert leader == ('status-1', 'miss')
+    assert waiter == ('status-2', 'miss')
+    assert cache.peek('tv', 60)[0] == 'status-2'
+
+
+def test_async_misses_share_one_fetch():
+    cache = DeviceStatusCache(default_ttl=60, stale_seconds=0)
+    calls = []
+
+    async def loader(key):
+        calls.append(key)
+        await asyncio.sleep(0.02)
+        return 'on'
+
+    async def scenario():
+        return await asyncio.gather(*(cache.aget('tv', loader) for _ in range(5)))
+
+    results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert sorted(state for _, state in results) == ['coalesced'] * 4 + ['miss']
+
+
+@pytest.mark.parametrize('max_age, expected', [(60, 'status-1'), (0, None)])
+def test_peek_respects_max_age(max_age, expected):
+    cache = DeviceStatusCache(default_ttl=60, stale_seconds=0)
+    cache.get('tv', Loader())
+    time.sleep(0.01)
+    assert cache.peek('tv', max_age)[0] == expected
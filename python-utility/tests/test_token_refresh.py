@@ -0,0 +1,74 @@
+"""Request-path token refresh: the slot and lock waits share TOKEN_REQUEST_WAIT and end in a 503"""
+
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+import app as app_module
+from resilience import TokenUnavailable
+
+
+@pytest.fixture
+def api(monkeypatch):
+    api = app_module.st_api
+    monkeypatch.setattr(api, 'use_oauth', True)
+    monkeypatch.setattr(api, 'refresh_token', 'refresh-token')
+    monkeypatch.setattr(api, 'access_token', 'old-token')
+    monkeypatch.setattr(api, 'token_expires_at', datetime.now().timestamp() - 60)
+    monkeypatch.setattr(api, 'ensure_tokens_loaded', lambda: None)
+    monkeypatch.setattr(api, '_reload_if_changed', lambda: None)
+    monkeypatch.setattr(app_module.config, 'TOKEN_REQUEST_WAIT', 0.2)
+    return api
+
+
+@pytest.fixture
+def lock_held(api):
+    """Another thread of this worker holds the token lock until the test ends"""
+    release = threading.Event()
+    locked = threading.Event()
+
+    def hold():
+        with api.token_store.lock():
+            locked.set()
+            release.wait(5)
+    holder = threading.Thread(target=hold)
+    holder.start()
+    locked.wait(5)
+    yield
+    release.set()
+    holder.join()
+
+
+def test_request_refresh_gives_up_after_token_request_wait(api, lock_held):
+    started = time.monotonic()
+    with pytest.raises(TokenUnavailable):
+        api.refresh_oauth_token(trigger='request', wait=0.2)
+    assert time.monotonic() - started < 1
+    assert api.refresh_history[-1]['outcome'] == 'lock_timeout'
+
+
+def test_background_refresh_timeout_returns_false(api, lock_held, monkeypatch):
+    monkeypatch.setattr(app_module.config, 'TOKEN_LOCK_TIMEOUT', 0.2)
+    assert api.refresh_oauth_token(trigger='background') is False
+
+
+def test_get_headers_raises_when_token_has_expired(api, lock_held):
+    with pytest.raises(TokenUnavailable):
+        api.get_headers()
+
+
+def test_get_headers_keeps_token_inside_expiry_buffer(api, lock_held, monkeypatch):
+    monkeypatch.setattr(api, 'token_expires_at', datetime.now().timestamp() + 60)
+    assert api.get_headers()['Authorization'] == 'Bearer old-token'
+
+
+def test_launch_answers_503_while_token_is_busy(monkeypatch):
+    def busy():
+        raise TokenUnavailable('OAuth token is being refreshed, try again shortly')
+    monkeypatch.setattr(app_module.st_api, 'get_headers', busy)
+    monkeypatch.setattr(app_module.config, 'LAUNCH_DEDUP_WINDOW', 0)
+    response = app_module.app.test_client().post('/launch-tv-app', json={'target': 'tv'})
+    assert response.status_code == 503
+    assert response.get_json()['success'] is False
@@ -0,0 +1,46 @@
+"""Webhook access control: the route is closed unless ST_WEBHOOK_TOKEN is set and matched"""
+
+import pytest
+
+import app
+
+PING = {'lifecycle': 'PING', 'pingData': {'challenge': 'abc'}}
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def test_webhook_disabled_without_token(client, monkeypatch):
+    monkeypatch.setattr(app.config, 'ST_WEBHOOK_TOKEN', '')
+    response = client.post('/smartthings/webhook', json=PING)
+    assert response.status_code == 503
+    assert 'ST_WEBHOOK_TOKEN' in response.get_json()['error']
+
+
+@pytest.mark.parametrize('query', ['', '?token=wrong-token-value'])
+def test_webhook_rejects_missing_or_wrong_token(client, monkeypatch, query):
+    monkeypatch.setattr(app.config, 'ST_WEBHOOK_TOKEN', 'webhook-secret-token')
+    response = client.post(f'/smartthings/webhook{query}', json=PING)
+    assert response.status_code == 403
+
+
+def test_webhook_accepts_matching_token(client, monkeypatch):
+    monkeypatch.setattr(app.config, 'ST_WEBHOOK_TOKEN', 'webhook-secret-token')
+    response = client.post('/smartthings/webhook?token=webhook-secret-token', json=PING)
+    assert response.status_code == 200
+    assert response.get_json() == {'pingData': {'challenge': 'abc'}}
+
+
+def test_events_are_not_applied_without_token(client, monkeypatch):
+    monkeypatch.setattr(app.config, 'ST_WEBHOOK_TOKEN', '')
+    applied = []
+    monkeypatch.setattr(app, 'handle_lifecycle', lambda data, api: applied.append(data) or ({}, 200))
+    client.post('/smartthings/webhook', json={'lifecycle': 'EVENT', 'eventData': {'events': []}})
+    assert applied == []
+
+
+def test_webhook_token_is_redacted_from_logs(monkeypatch):
+    monkeypatch.setattr(app.config, 'ST_WEBHOOK_TOKEN', 'webhook-secret-token')
+    assert 'webhook-secret-token' not in app.log_redactor.redact('POST /smartthings/webhook?token=webhook-secret-token')
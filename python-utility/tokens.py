@@ -0,0 +1,185 @@
+"""
+OAuth token file shared by the workers and the background refresher
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from settings import config
+from storage import atomic_write_json, file_lock
+
+logger = logging.getLogger(__name__)
+
+class TokenStore:
+    """OAuth token file shared by all worker processes
+    
+    Writes go to a temp file that is atomically renamed over TOKEN_FILE, so
+    readers never see a partial document. An exclusive flock on a sidecar
+    lock file serialises refreshes across workers; a thread lock does the
+    same within one worker.
+    """
+    
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock_path = self.path.with_name(self.path.name + '.lock')
+        self._thread_lock = threading.RLock()
+        self._signature = None
+    
+    def _stat_signature(self):
+        """Identify the on-disk version of the token file (None if missing)"""
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+    
+    def exists(self):
+        return self.path.exists()
+    
+    def changed(self):
+        """True if another process has replaced the file since we last read or wrote it"""
+        return self._stat_signature() != self._signature
+    
+    def load(self):
+        """Read the token document, or None if there is no file yet"""
+        signature = self._stat_signature()
+        if signature is None:
+            self._signature = None
+            return None
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        self._signature = signature
+        return data
+    
+    def save(self, data):
+        """Atomically replace the token file with data"""
+        atomic_write_json(self.path, data)
+        self._signature = self._stat_signature()
+    
+    @contextmanager
+    def lock(self, timeout=None):
+        """Hold the cross-worker token lock for the duration of the block"""
+        timeout = config.TOKEN_LOCK_TIMEOUT if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        # Both waits share the timeout, so a caller never waits longer than it asked for
+        if not self._thread_lock.acquire(timeout=timeout):
+            raise TimeoutError(f"Timed out waiting for lock {self.lock_path}")
+        try:
+            with file_lock(self.lock_path, max(0.0, deadline - time.monotonic())):
+                yield
+        finally:
+            self._thread_lock.release()
+
+class TokenRefreshScheduler:
+    """Background thread that refreshes the OAuth token ahead of expiry
+    
+    The refresh is scheduled TOKEN_REFRESH_LEAD seconds (plus random jitter)
+    before the token expires, so request handlers normally find a fresh
+    token and never wait on /oauth/token. Failures are retried with
+    exponential backoff. stagger moves one account's refresh earlier than
+    the others' (see AccountManager) so accounts authorized together do not
+    all refresh at the same moment.
+    """
+    
+    IDLE_POLL_SECONDS = 300  # Re-check interval while there is nothing to refresh
+    
+    def __init__(self, api, stagger=0.0):
+        self.api = api
+        self.stagger = stagger
+        self._wake = threading.Event()
+        self._thread = None
+        self._jitter_for = None
+        self._jitter = 0.0
+        self.next_refresh_at = None
+        self.consecutive_failures = 0
+    
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+    
+    def start(self):
+        """Start the scheduler thread (no-op if already running in this process)"""
+        if self.running:
+            return
+        self._thread = threading.Thread(target=self._run, name=f'token-refresher-{self.api.account}', daemon=True)
+        self._thread.start()
+        logger.info(f"Background token refresh scheduler started (account {self.api.account})")
+    
+    def wake(self):
+        """Ask the scheduler to refresh now instead of at its planned time"""
+        self._wake.set()
+    
+    def _seconds_until_due(self):
+        """Seconds until the next refresh, 0 if due now, None if nothing to refresh"""
+        api = self.api
+        if not api.use_oauth or not api.refresh_token:
+            return None
+        if not api.access_token or not api.token_expires_at:
+            return 0
+        # Pick the jitter once per token so re-evaluation does not move the target
+        if self._jitter_for != api.token_expires_at:
+            self._jitter_for = api.token_expires_at
+            self._jitter = random.uniform(0, config.TOKEN_REFRESH_JITTER)
+        refresh_at = api.token_expires_at - config.TOKEN_REFRESH_LEAD - self.stagger - self._jitter
+        return max(0.0, refresh_at - datetime.now().timestamp())
+    
+    def _backoff_seconds(self):
+        delay = config.TOKEN_REFRESH_RETRY_BASE * (2 ** (self.consecutive_failures - 1))
+        delay = min(delay, config.TOKEN_REFRESH_RETRY_MAX)
+        return delay * random.uniform(0.5, 1.0)
+    
+    def _run(self):
+        # A worker's first refresh runs here instead of at import; it is labelled 'startup'
+        trigger = 'startup'
+        while True:
+            try:
+                self.api.ensure_tokens_loaded()
+                self.api._reload_if_changed()
+                delay = self._seconds_until_due()
+                if delay is None or delay > 0:
+                    trigger = 'background'
+                    delay = self.IDLE_POLL_SECONDS if delay is None else delay
+                    self.next_refresh_at = datetime.now().timestamp() + delay
+                    woken = self._wake.wait(delay)
+                    self._wake.clear()
+                    if not woken:
+                        # Re-evaluate: another worker may have refreshed meanwhile
+                        continue
+                    if not self.api.refresh_token:
+                        continue
+                
+                self.next_refresh_at = None
+                refreshed = self.api.refresh_oauth_token(trigger=trigger)
+                trigger = 'background'
+                if refreshed:
+                    self.consecutive_failures = 0
+                    continue
+                
+                self.consecutive_failures += 1
+                backoff = self._backoff_seconds()
+                logger.warning(f"Background token refresh failed ({self.consecutive_failures} in a row), retrying in {backoff:.1f}s")
+                self.next_refresh_at = datetime.now().timestamp() + backoff
+                self._wake.wait(backoff)
+                self._wake.clear()
+            except Exception:
+                logger.exception("Unexpected error in token refresh scheduler")
+                time.sleep(config.TOKEN_REFRESH_RETRY_BASE)
+    
+    def status(self):
+        return {
+            'running': self.running,
+            'next_refresh_at': datetime.fromtimestamp(self.next_refresh_at).isoformat() if self.next_refresh_at else None,
+            'consecutive_failures': self.consecutive_failures,
+            'refresh_lead_seconds': config.TOKEN_REFRESH_LEAD,
+            'stagger_seconds': self.stagger,
+            'jitter_seconds': round(self._jitter, 1)
+        }
+
+# Caps concurrent /oauth/token calls from this worker across all accounts
+token_refresh_slots = threading.BoundedSemaphore(max(1, config.TOKEN_REFRESH_CONCURRENCY))